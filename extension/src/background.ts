@@ -6,7 +6,6 @@ import {
   UPDATE_INTERVAL_MS,
 } from "./config";
 import validator_set from "./validator_set.json";
-import { isInPartition } from "./webcat/cache";
 import { WebcatDatabase } from "./webcat/db";
 import { WebcatRequestHandler } from "./webcat/handler";
 import { setErrorIcon } from "./webcat/ui";
@@ -36,16 +35,9 @@ browser.tabs.onCreated.addListener((tab) => {
 browser.windows.onRemoved.addListener(async () => {
   const windows = await browser.windows.getAll();
   if (windows.filter((win) => win.incognito).length === 0) {
-    for (const key of db.origins.keys()) {
-      if (isInPartition(key, { incognito: true })) {
-        db.origins.delete(key);
-      }
-    }
-    for (const value of db.nonOrigins.values()) {
-      if (isInPartition(value, { incognito: true })) {
-        db.nonOrigins.delete(value);
-      }
-    }
+    db.origins.deletePartition({ incognito: true });
+    db.nonOrigins.deletePartition({ incognito: true });
+    db.cspVerdicts.deletePartition({ incognito: true });
   }
 });
 
@@ -19,6 +19,34 @@ export class KVStore {
     return browser.storage[area].remove(keys);
   }
 
+  async remove(keys: string[], area: "local" | "session" = "local") {
+    return browser.storage[area].remove(keys);
+  }
+
+  async getAll(prefix: string = "", area: "local" | "session" = "local") {
+    if (browser.storage[area]["getKeys"]) {
+      // Only what has the prefix, rather than the whole storage area
+      const keys = (await browser.storage[area].getKeys()).filter((key) =>
+        key.startsWith(prefix),
+      );
+      return keys.length > 0
+        ? ((await browser.storage[area].get(keys)) as {
+            [key: string]: unknown;
+          })
+        : {};
+    }
+    const items = (await browser.storage[area].get(null)) as {
+      [key: string]: unknown;
+    };
+    const result = {} as { [key: string]: unknown };
+    for (const key in items) {
+      if (key.startsWith(prefix)) {
+        result[key] = items[key];
+      }
+    }
+    return result;
+  }
+
   async getKeys(prefix: string = "", area: "local" | "session" = "local") {
     let keys: string[];
     if (browser.storage[area]["getKeys"]) {
@@ -63,6 +91,25 @@ export class NamespacedKVStore extends KVStore {
     return this.#store.clear(`${this.#namespace}:${prefix}`, area);
   }
 
+  async remove(keys: string[], area: "local" | "session" = "local") {
+    return this.#store.remove(
+      keys.map((key) => `${this.#namespace}:${key}`),
+      area,
+    );
+  }
+
+  async getAll(prefix: string = "", area: "local" | "session" = "local") {
+    const items = await this.#store.getAll(
+      `${this.#namespace}:${prefix}`,
+      area,
+    );
+    const result = {} as { [key: string]: unknown };
+    for (const key in items) {
+      result[key.substring(this.#namespace.length + 1)] = items[key];
+    }
+    return result;
+  }
+
   async getKeys(prefix: string = "", area: "local" | "session" = "local") {
     const namespacedKeys = await this.#store.getKeys(
       `${this.#namespace}:${prefix}`,
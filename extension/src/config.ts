@@ -4,12 +4,46 @@ export const enrollment_name = "/.well-known/webcat/enrollment.json";
 export const manifest_name = "/.well-known/webcat/manifest.json";
 export const bundle_name = "/.well-known/webcat/bundle.json";
 export const bundle_prev_name = "/.well-known/webcat/bundle-prev.json";
-// Here it's full metadata, potentially with 100kb of manifests each
-export const lru_cache_size = __IS_TESTING__ ? 2 : 32;
+// Here it's full metadata, potentially with 100kb of manifests each, so
+// verified origins are also kept within a budget of their estimated size
+export const lru_cache_size = __IS_TESTING__ ? 2 : 256;
+export const origin_cache_bytes = 32 * 1024 * 1024;
 // Items here are just the size in bytes for a domain
 export const lru_set_size = 8192;
+// Verdicts of CSP validation, a few per verified manifest
+export const csp_cache_size = 1024;
+// Testing builds can be pointed at the ports of one parallel test worker by
+// shipping a data/test-slot.json next to the manifest.
+interface TestSlot {
+  endpoint: string;
+  httpPort: string;
+  httpsPort: string;
+}
+function loadTestSlot(): TestSlot {
+  const slot: TestSlot = {
+    endpoint: "http://localhost:1234/",
+    httpPort: "8080",
+    httpsPort: "8443",
+  };
+  if (!__IS_TESTING__ || typeof browser === "undefined") {
+    return slot;
+  }
+  try {
+    // Synchronous so that every module sees the final values at import time
+    const xhr = new XMLHttpRequest();
+    xhr.open("GET", browser.runtime.getURL("data/test-slot.json"), false);
+    xhr.send();
+    if (xhr.status === 200 || (xhr.status === 0 && xhr.responseText)) {
+      Object.assign(slot, JSON.parse(xhr.responseText));
+    }
+  } catch {
+    // No slot file: keep the defaults
+  }
+  return slot;
+}
+export const testSlot = loadTestSlot();
 export const endpoint = __IS_TESTING__
-  ? "http://localhost:1234/"
+  ? testSlot.endpoint
   : "https://webcat.freedom.press/";
 // During alpha, update every hour. Wall-clock based so that sleep/suspend
 // doesn't silently postpone updates.
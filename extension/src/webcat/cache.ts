@@ -33,9 +33,74 @@ export function isInPartition<
   return Object.keys(partition).length === 0;
 }
 
+type Partition = { [index: string]: { toString(): string } };
+
+function partitionAttributes(key: unknown): string[] {
+  if (typeof key !== "string") return [];
+  const q = key.indexOf("?");
+  return q < 0 || q === key.length - 1 ? [] : key.substring(q + 1).split(",");
+}
+
+/**
+ * Keys of a cache by the partition attributes encoded in them (see
+ * CacheKey), so that the keys of a partition are found without parsing
+ * every key. Keys that aren't CacheKey strings are not indexed.
+ */
+export class PartitionIndex<K> {
+  // "name=value", encoded as in CacheKey -> keys with that attribute
+  private byAttribute = new Map<string, Set<K>>();
+
+  add(key: K): void {
+    for (const attr of partitionAttributes(key)) {
+      let keys = this.byAttribute.get(attr);
+      if (!keys) {
+        keys = new Set<K>();
+        this.byAttribute.set(attr, keys);
+      }
+      keys.add(key);
+    }
+  }
+
+  delete(key: K): void {
+    for (const attr of partitionAttributes(key)) {
+      const keys = this.byAttribute.get(attr);
+      if (keys?.delete(key) && keys.size === 0) {
+        this.byAttribute.delete(attr);
+      }
+    }
+  }
+
+  clear(): void {
+    this.byAttribute.clear();
+  }
+
+  /**
+   * Keys having every attribute of the partition, which may name only some
+   * of them, e.g. { incognito: true }. As with isInPartition, the empty
+   * partition matches every key; the index doesn't know them, so they come
+   * from all().
+   */
+  keys(partition: Partition, all: () => K[]): K[] {
+    const sets: Set<K>[] = [];
+    for (const name of Object.keys(partition)) {
+      const attr = `${encodeURIComponent(name)}=${encodeURIComponent(partition[name].toString())}`;
+      const keys = this.byAttribute.get(attr);
+      if (!keys) return [];
+      sets.push(keys);
+    }
+    if (sets.length === 0) return all();
+    sets.sort((a, b) => a.size - b.size);
+    const [smallest, ...others] = sets;
+    return Array.from(smallest).filter((key) =>
+      others.every((keys) => keys.has(key)),
+    );
+  }
+}
+
 export class LRUCache<K, V> {
   private cache: Map<K, V>;
   private limit: number;
+  private partitions = new PartitionIndex<K>();
 
   constructor(limit: number) {
     this.limit = limit;
@@ -55,12 +120,15 @@ export class LRUCache<K, V> {
     if (this.cache.has(key)) {
       // Remove the old value to update its position
       this.cache.delete(key);
-    } else if (this.cache.size >= this.limit) {
-      // Remove the least recently used key (first key in the Map)
-      const oldestKey = this.cache.keys().next().value;
-      if (oldestKey !== undefined) {
-        this.cache.delete(oldestKey);
+    } else {
+      if (this.cache.size >= this.limit) {
+        // Remove the least recently used key (first key in the Map)
+        const oldestKey = this.cache.keys().next().value;
+        if (oldestKey !== undefined) {
+          this.delete(oldestKey);
+        }
       }
+      this.partitions.add(key);
     }
     this.cache.set(key, value);
   }
@@ -73,18 +141,184 @@ export class LRUCache<K, V> {
     return Array.from(this.cache.keys());
   }
 
+  keysInPartition(partition: Partition): K[] {
+    return this.partitions.keys(partition, () => this.keys());
+  }
+
   delete(key: K): void {
+    if (this.cache.delete(key)) {
+      this.partitions.delete(key);
+    }
+  }
+
+  deletePartition(partition: Partition): void {
+    for (const key of this.keysInPartition(partition)) {
+      this.delete(key);
+    }
+  }
+
+  clear(): void {
+    this.cache.clear();
+    this.partitions.clear();
+  }
+}
+
+export interface CacheStats {
+  hits: number;
+  misses: number;
+  evictions: number;
+  entries: number;
+  bytes: number;
+  maxEntries: number;
+  maxBytes: number;
+}
+
+interface BudgetedEntry<V> {
+  value: V;
+  bytes: number;
+  cost: number;
+  priority: number;
+}
+
+/**
+ * LRUCache that also keeps the estimated size of its values within a byte
+ * budget. Past maxEntries the least recently used entry goes, as in
+ * LRUCache; past maxBytes entries are evicted by GreedyDual-Size priority,
+ * which ages with every eviction and favours keeping entries that are
+ * expensive to rebuild per byte they take. The newest entry is never
+ * evicted to make room for itself.
+ */
+export class BudgetedLRUCache<K, V> {
+  private cache = new Map<K, BudgetedEntry<V>>();
+  private partitions = new PartitionIndex<K>();
+  private bytes = 0;
+  // GreedyDual's L: the priority of the last entry evicted for size
+  private inflation = 0;
+  private hits = 0;
+  private misses = 0;
+  private evictions = 0;
+
+  /**
+   * @param maxEntries - Most entries kept.
+   * @param maxBytes - Budget for the sum of the entries' estimated sizes.
+   * @param weigh - Estimated size in bytes of a value, and what rebuilding
+   *   it costs, in any unit as long as it's the same for every value.
+   */
+  constructor(
+    public maxEntries: number,
+    public maxBytes: number,
+    private weigh: (value: V) => { bytes: number; cost: number },
+  ) {}
+
+  get(key: K): V | undefined {
+    const entry = this.cache.get(key);
+    if (!entry) {
+      this.misses++;
+      return undefined;
+    }
+    this.hits++;
     this.cache.delete(key);
+    entry.priority = this.inflation + entry.cost / entry.bytes;
+    this.cache.set(key, entry);
+    return entry.value;
+  }
+
+  /**
+   * The value of key, without counting a hit or miss or making it more
+   * recently used.
+   */
+  peek(key: K): V | undefined {
+    return this.cache.get(key)?.value;
+  }
+
+  set(key: K, value: V): void {
+    this.delete(key);
+    const { bytes, cost } = this.weigh(value);
+    const entry = {
+      value,
+      bytes: Math.max(bytes, 1),
+      cost,
+      priority: 0,
+    };
+    entry.priority = this.inflation + entry.cost / entry.bytes;
+    this.cache.set(key, entry);
+    this.partitions.add(key);
+    this.bytes += entry.bytes;
+    while (this.cache.size > this.maxEntries) {
+      // The least recently used key (first key in the Map)
+      this.evict(this.cache.keys().next().value as K);
+    }
+    while (this.bytes > this.maxBytes && this.cache.size > 1) {
+      let victim: K | undefined;
+      let lowest = Infinity;
+      for (const [k, e] of this.cache) {
+        // Strictly lower, so that ties go to the least recently used
+        if (k !== key && e.priority < lowest) {
+          victim = k;
+          lowest = e.priority;
+        }
+      }
+      this.inflation = lowest;
+      this.evict(victim as K);
+    }
+  }
+
+  has(key: K): boolean {
+    return this.cache.has(key);
+  }
+
+  keys(): K[] {
+    return Array.from(this.cache.keys());
+  }
+
+  keysInPartition(partition: Partition): K[] {
+    return this.partitions.keys(partition, () => this.keys());
+  }
+
+  delete(key: K): void {
+    const entry = this.cache.get(key);
+    if (entry) {
+      this.bytes -= entry.bytes;
+      this.cache.delete(key);
+      this.partitions.delete(key);
+    }
+  }
+
+  deletePartition(partition: Partition): void {
+    for (const key of this.keysInPartition(partition)) {
+      this.delete(key);
+    }
   }
 
   clear(): void {
     this.cache.clear();
+    this.partitions.clear();
+    this.bytes = 0;
+    this.inflation = 0;
+  }
+
+  stats(): CacheStats {
+    return {
+      hits: this.hits,
+      misses: this.misses,
+      evictions: this.evictions,
+      entries: this.cache.size,
+      bytes: this.bytes,
+      maxEntries: this.maxEntries,
+      maxBytes: this.maxBytes,
+    };
+  }
+
+  private evict(key: K): void {
+    this.delete(key);
+    this.evictions++;
   }
 }
 
 export class LRUSet<T> {
   private cache: Set<T>;
   private limit: number;
+  private partitions = new PartitionIndex<T>();
 
   constructor(limit: number) {
     this.limit = limit;
@@ -103,12 +337,15 @@ export class LRUSet<T> {
     if (this.cache.has(value)) {
       // Remove the old value to update its position
       this.cache.delete(value);
-    } else if (this.cache.size >= this.limit) {
-      // Remove the least recently used value (first item in the Set)
-      const oldestValue = this.cache.values().next().value;
-      if (oldestValue !== undefined) {
-        this.cache.delete(oldestValue);
+    } else {
+      if (this.cache.size >= this.limit) {
+        // Remove the least recently used value (first item in the Set)
+        const oldestValue = this.cache.values().next().value;
+        if (oldestValue !== undefined) {
+          this.delete(oldestValue);
+        }
       }
+      this.partitions.add(value);
     }
     this.cache.add(value);
   }
@@ -117,11 +354,99 @@ export class LRUSet<T> {
     return Array.from(this.cache.values());
   }
 
+  valuesInPartition(partition: Partition): T[] {
+    return this.partitions.keys(partition, () => this.values());
+  }
+
   delete(value: T): void {
-    this.cache.delete(value);
+    if (this.cache.delete(value)) {
+      this.partitions.delete(value);
+    }
+  }
+
+  deletePartition(partition: Partition): void {
+    for (const value of this.valuesInPartition(partition)) {
+      this.delete(value);
+    }
   }
 
   clear(): void {
     this.cache.clear();
+    this.partitions.clear();
+  }
+}
+
+/**
+ * 32-bit FNV-1a of a hostname, over its UTF-16 code units (hostnames are
+ * ASCII once punycoded).
+ */
+export function hostHash(host: string): number {
+  let h = 0x811c9dc5;
+  for (let i = 0; i < host.length; i++) {
+    h ^= host.charCodeAt(i);
+    h = Math.imul(h, 0x01000193);
+  }
+  return h >>> 0;
+}
+
+/**
+ * Approximate membership of the enrolled hosts: their sorted 32-bit hashes,
+ * 4 bytes per host. A miss means the host is definitely not enrolled; a hit
+ * may be a collision (about n / 2^32 of the time) and has to be confirmed
+ * in storage. Colliding hosts are kept once each, so removing one never
+ * hides the others.
+ */
+export class HostIndex {
+  private hashes: Uint32Array;
+
+  constructor(hosts: Iterable<string> = []) {
+    this.hashes = Uint32Array.from(hosts, hostHash).sort();
+  }
+
+  get size(): number {
+    return this.hashes.length;
+  }
+
+  has(host: string): boolean {
+    const hash = hostHash(host);
+    const hashes = this.hashes;
+    let low = 0;
+    let high = hashes.length;
+    while (low < high) {
+      const mid = (low + high) >>> 1;
+      if (hashes[mid] < hash) low = mid + 1;
+      else high = mid;
+    }
+    return low < hashes.length && hashes[low] === hash;
+  }
+
+  /**
+   * Add hosts that are now enrolled. Adding an enrolled host again only
+   * costs a duplicate entry, never a false negative.
+   */
+  add(hosts: readonly string[]): void {
+    if (hosts.length === 0) return;
+    const merged = new Uint32Array(this.hashes.length + hosts.length);
+    merged.set(this.hashes);
+    merged.set(hosts.map(hostHash), this.hashes.length);
+    this.hashes = merged.sort();
+  }
+
+  /**
+   * Remove hosts that were enrolled, one entry each.
+   */
+  remove(hosts: readonly string[]): void {
+    if (hosts.length === 0) return;
+    const pending = new Map<number, number>();
+    for (const host of hosts) {
+      const hash = hostHash(host);
+      pending.set(hash, (pending.get(hash) ?? 0) + 1);
+    }
+    this.hashes = this.hashes.filter((hash) => {
+      const count = pending.get(hash);
+      if (!count) return true;
+      pending.set(hash, count - 1);
+      return false;
+    });
   }
 }
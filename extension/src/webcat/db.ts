@@ -1,28 +1,89 @@
 import { NamespacedKVStore } from "../browser/kvstore";
-import { lru_cache_size, lru_set_size } from "../config";
-import { CacheKey, LRUCache, LRUSet } from "./cache";
-import { BlockMeta, Database } from "./interfaces/database";
+import {
+  csp_cache_size,
+  lru_cache_size,
+  lru_set_size,
+  origin_cache_bytes,
+} from "../config";
+import {
+  BudgetedLRUCache,
+  CacheKey,
+  HostIndex,
+  LRUCache,
+  LRUSet,
+} from "./cache";
+import { Uint8ArrayToHex } from "./encoding";
+import {
+  BlockMeta,
+  CSPPartition,
+  CSPVerdict,
+  Database,
+  Leaf,
+  VerifiedManifest,
+} from "./interfaces/database";
 import { CachePartition } from "./interfaces/originstate";
 import { OriginStateHolder } from "./originstate";
-import { extractHostname, extractRawHash } from "./parsers";
+import {
+  encodeRawHash,
+  extractHostname,
+  extractRawHash,
+  hostnameToKey,
+} from "./parsers";
 
 const META_KEY = "block_meta";
 
+/**
+ * Rough heap footprint of a cached origin: its manifest's file list, as
+ * UTF-16 strings plus per-property overhead, and the rest of the bundle.
+ */
+export function estimateOriginBytes(holder: OriginStateHolder): number {
+  const { bundle, manifest } = holder.current;
+  let bytes = 1024;
+  const files = (manifest ?? bundle?.manifest)?.files ?? {};
+  for (const path in files) {
+    bytes += 2 * (path.length + files[path].length) + 64;
+  }
+  if (bundle) {
+    bytes +=
+      2 *
+      (JSON.stringify(bundle.enrollment).length +
+        JSON.stringify(bundle.signatures).length);
+  }
+  return bytes;
+}
+
+function weighOrigin(holder: OriginStateHolder) {
+  return {
+    bytes: estimateOriginBytes(holder),
+    // Fetching and verifying its bundle again
+    cost: holder.rebuildMs ?? 1,
+  };
+}
+
 export class WebcatDatabase extends NamespacedKVStore implements Database {
-  readonly origins = new LRUCache<CacheKey<CachePartition>, OriginStateHolder>(
-    lru_cache_size,
-  );
+  readonly origins = new BudgetedLRUCache<
+    CacheKey<CachePartition>,
+    OriginStateHolder
+  >(lru_cache_size, origin_cache_bytes, weighOrigin);
   readonly nonOrigins = new LRUSet<CacheKey<CachePartition>>(lru_set_size);
+  readonly cspVerdicts = new LRUCache<CacheKey<CSPPartition>, CSPVerdict>(
+    csp_cache_size,
+  );
   readonly enrollments = this.namespace("enrollments");
+  readonly verifiedManifests = this.namespace("verified_manifests");
+  // Answers most lookups of non-enrolled hosts without storage I/O. Loaded
+  // from storage on first use, then kept in step with the list; a load
+  // that overlapped with a write of the list is discarded
+  #index: HostIndex | null = null;
+  #indexLoad: Promise<HostIndex | null> | null = null;
+  #listVersion = 0;
+  #listWrites = 0;
 
   constructor(namespace = "WEBCAT") {
     super(namespace);
   }
 
-  async updateList(
-    leaves: readonly (readonly [string, string])[],
-    meta: BlockMeta,
-  ): Promise<void> {
+  async updateList(leaves: readonly Leaf[], meta: BlockMeta): Promise<void> {
     const batch: Record<string, unknown> = {};
     for (const [reverseKey, hexHash] of leaves) {
       const hostname = extractHostname(reverseKey);
@@ -30,30 +91,162 @@ export class WebcatDatabase extends NamespacedKVStore implements Database {
       batch[hostname] = Array.from(rawHash);
     }
 
-    await this.enrollments.clear();
-    await this.enrollments.set(batch);
-    await this.set({ [META_KEY]: meta });
+    this.#index = null;
+    await this.#writeList(async () => {
+      await this.enrollments.clear();
+      await this.enrollments.set(batch);
+      await this.verifiedManifests.clear();
+      await this.set({ [META_KEY]: meta });
+    });
+    this.#index = new HostIndex(Object.keys(batch));
 
     this.origins.clear();
     this.nonOrigins.clear();
+    this.cspVerdicts.clear();
 
     console.log(`[webcat] Replaced list with ${leaves.length} entries`);
   }
 
+  /**
+   * Apply a verified list delta in place: only the changed and removed
+   * enrollments are written, and only their cache entries are dropped.
+   * @param changed - Added or modified leaves.
+   * @param removed - Canonical keys of removed leaves.
+   * @param meta - Block the resulting list belongs to.
+   */
+  async applyDelta(
+    changed: readonly Leaf[],
+    removed: readonly string[],
+    meta: BlockMeta,
+  ): Promise<void> {
+    const batch: Record<string, unknown> = {};
+    for (const [reverseKey, hexHash] of changed) {
+      batch[extractHostname(reverseKey)] = Array.from(
+        extractRawHash(hexHash),
+      );
+    }
+    const removedHosts = removed.map(extractHostname);
+    // Manifests verified under the enrollments being replaced or removed
+    const previous = await Promise.all(
+      [...Object.keys(batch), ...removedHosts].map((host) =>
+        this.enrollments.get(host),
+      ),
+    );
+    const replaced = new Set(
+      previous
+        .filter((stored) => stored)
+        .map((stored) => Uint8ArrayToHex(new Uint8Array(stored))),
+    );
+
+    // Added before storage is written and removed after, so that a lookup
+    // in between at worst goes to storage
+    this.#index?.add(Object.keys(batch));
+    await this.#writeList(async () => {
+      await this.enrollments.remove(removedHosts);
+      await this.enrollments.set(batch);
+      await this.set({ [META_KEY]: meta });
+    });
+    this.#index?.remove(removedHosts);
+    await this.#pruneVerifiedManifests(replaced);
+
+    const affected = new Set([...Object.keys(batch), ...removedHosts]);
+    const isAffected = (key: string) =>
+      affected.has(decodeURIComponent(key.split("?")[0]));
+    this.origins.keys().filter(isAffected).forEach((key) => {
+      this.origins.delete(key);
+    });
+    this.nonOrigins.values().filter(isAffected).forEach((key) => {
+      this.nonOrigins.delete(key);
+    });
+    // Any policy may allow, or be rejected for, one of the changed hosts
+    this.cspVerdicts.clear();
+
+    console.log(
+      `[webcat] Applied list delta: ${changed.length} changed, ${removed.length} removed`,
+    );
+  }
+
+  /**
+   * Rebuild the stored list as leaves, sorted by key.
+   */
+  async listLeaves(): Promise<Leaf[]> {
+    const stored = await this.enrollments.getAll();
+    return Object.entries(stored)
+      .map(
+        ([hostname, rawHash]) =>
+          [
+            hostnameToKey(hostname),
+            encodeRawHash(new Uint8Array(rawHash as number[])),
+          ] as const,
+      )
+      .sort(([a], [b]) => (a < b ? -1 : a > b ? 1 : 0));
+  }
+
   async getBlockMeta(): Promise<BlockMeta | null> {
     return (await this.get(META_KEY)) ?? null;
   }
 
+  async setBlockMeta(meta: BlockMeta): Promise<void> {
+    await this.set({ [META_KEY]: meta });
+  }
+
   async listAllFQDNs(): Promise<string[]> {
     return await this.enrollments.getKeys();
   }
 
+  /**
+   * A manifest verified earlier, unless its enrollment's max_age has passed
+   * since.
+   * @param key - Enrollment hash and manifest hash, see verifyManifest.
+   */
+  async getVerifiedManifest(key: string): Promise<VerifiedManifest | null> {
+    const record = (await this.verifiedManifests.get(key)) as
+      | VerifiedManifest
+      | undefined;
+    if (!record) {
+      return null;
+    }
+    if (Date.now() - record.verifiedAt > record.maxAge * 1000) {
+      await this.verifiedManifests.remove([key]);
+      return null;
+    }
+    return record;
+  }
+
+  async setVerifiedManifest(
+    key: string,
+    record: VerifiedManifest,
+  ): Promise<void> {
+    await this.verifiedManifests.set({ [key]: record });
+  }
+
+  /**
+   * Remove verified manifests that expired, or whose enrollment hash is in
+   * enrollments, so that the namespace doesn't grow between full lists.
+   */
+  async #pruneVerifiedManifests(enrollments: Set<string>): Promise<void> {
+    const records = (await this.verifiedManifests.getAll()) as Record<
+      string,
+      VerifiedManifest
+    >;
+    const now = Date.now();
+    const stale = Object.keys(records).filter(
+      (key) =>
+        enrollments.has(key.split(":")[0]) ||
+        now - records[key].verifiedAt > records[key].maxAge * 1000,
+    );
+    if (stale.length > 0) {
+      await this.verifiedManifests.remove(stale);
+    }
+  }
+
   async getFQDNEnrollment(
     fqdn: string,
     cachePartition: CachePartition,
   ): Promise<Uint8Array> {
-    // 1. Positive-cache hit
-    const originState = this.origins.get(CacheKey(fqdn, cachePartition));
+    // 1. Positive-cache hit. Peeked, as most lookups here are for hosts a
+    // page refers to rather than origins being loaded
+    const originState = this.origins.peek(CacheKey(fqdn, cachePartition));
     if (originState) {
       const cached = originState.current.enrollment_hash;
       if (!cached) {
@@ -64,12 +257,18 @@ export class WebcatDatabase extends NamespacedKVStore implements Database {
       return cached;
     }
 
-    // 2. Negative-cache hit
+    // 2. Not in the index of enrolled hosts
+    const index = this.#index ?? (await this.#loadIndex());
+    if (index && !index.has(fqdn)) {
+      return new Uint8Array();
+    }
+
+    // 3. Negative-cache hit, for index collisions
     if (this.nonOrigins.has(CacheKey(fqdn, cachePartition))) {
       return new Uint8Array();
     }
 
-    // 3. Storage lookup
+    // 4. Storage lookup
     const stored = await this.enrollments.get(fqdn);
     if (stored) {
       return new Uint8Array(stored);
@@ -79,6 +278,42 @@ export class WebcatDatabase extends NamespacedKVStore implements Database {
     }
   }
 
+  /**
+   * Write the stored list, marking it as changing for #loadIndex from the
+   * first write until the last one is done.
+   */
+  async #writeList(write: () => Promise<void>): Promise<void> {
+    this.#listVersion++;
+    this.#listWrites++;
+    try {
+      await write();
+    } finally {
+      this.#listWrites--;
+      this.#listVersion++;
+    }
+  }
+
+  /**
+   * Build the index from the stored list; null if the list was being
+   * written in the meantime, in which case the lookup goes to storage.
+   */
+  #loadIndex(): Promise<HostIndex | null> {
+    this.#indexLoad ??= (async () => {
+      const version = this.#listVersion;
+      try {
+        const index = new HostIndex(await this.enrollments.getKeys());
+        if (version !== this.#listVersion || this.#listWrites > 0) {
+          return null;
+        }
+        this.#index = index;
+        return index;
+      } finally {
+        this.#indexLoad = null;
+      }
+    })();
+    return this.#indexLoad;
+  }
+
   async setLastChecked(): Promise<void> {
     await this.set({ lastChecked: Date.now() }, "session");
   }
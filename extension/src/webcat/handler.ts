@@ -17,6 +17,7 @@ import { OriginStateVerifiedManifest } from "./originstate";
 import { validateOrigin } from "./request";
 import { FRAME_TYPES } from "./resources";
 import { ResponseValidator } from "./response";
+import { traced } from "./testing";
 import { errorpage } from "./ui";
 import { getFQDN, isExtensionRequest, isNewerSemver } from "./utils";
 
@@ -131,7 +132,11 @@ export class WebcatRequestHandler extends RequestHandler {
       return;
     }
 
-    await this.#responseValidator.validateContent(details);
+    await traced(
+      "validateContent",
+      () => this.#responseValidator.validateContent(details),
+      { url: details.url },
+    );
   }
 
   async #onHeaders(event: RequestEvent<HeadersReceivedDetails>) {
@@ -147,7 +152,11 @@ export class WebcatRequestHandler extends RequestHandler {
       throw new Error("missing pendingOrigin in request state");
     }
 
-    const result = await this.#responseValidator.validateHeaders(details);
+    const result = await traced(
+      "validateHeaders",
+      () => this.#responseValidator.validateHeaders(details),
+      { url: details.url },
+    );
     if (result instanceof WebcatError) {
       logger.error(
         `Error when parsing response headers: ${result}: ${result.details?.join(", ")}`,
@@ -229,7 +238,7 @@ export class WebcatRequestHandler extends RequestHandler {
     }
     const incoming = (holder.current as OriginStateVerifiedManifest).manifest
       .version;
-    const existing = this.#db.origins.get(CacheKey(fqdn, cachePartition));
+    const existing = this.#db.origins.peek(CacheKey(fqdn, cachePartition));
     if (existing && existing.current.status === "verified_manifest") {
       const current = (existing.current as OriginStateVerifiedManifest).manifest
         .version;
@@ -237,6 +246,7 @@ export class WebcatRequestHandler extends RequestHandler {
         return;
       }
     }
+    holder.rebuildMs ??= performance.now() - holder.created;
     this.#db.origins.set(CacheKey(fqdn, cachePartition), holder);
   }
 
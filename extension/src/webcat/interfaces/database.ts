@@ -1,20 +1,56 @@
-import { CacheKey, LRUCache, LRUSet } from "../cache";
+import { BudgetedLRUCache, CacheKey, LRUCache, LRUSet } from "../cache";
 import { CachePartition, OriginStateHolder } from "./originstate";
 
 export interface BlockMeta {
   blockTime: number;
   rootHash: string;
+  // Needed to request list deltas; missing for lists applied before it was
+  // recorded
+  height?: number;
+  // Hex app hash of the block, to skip downloading an unchanged list
+  appHash?: string;
+  // Validator of the block response, sent back as If-None-Match
+  blockETag?: string;
 }
 
+export type Leaf = readonly [string, string];
+
+// A manifest whose signatures were verified, persisted across sessions
+export interface VerifiedManifest {
+  // Hex SHA-256 of the canonicalized signatures it was verified with
+  signatures: string;
+  // Milliseconds since the epoch
+  verifiedAt: number;
+  // Of the enrollment, in seconds
+  maxAge: number;
+}
+
+// Memoized outcome of validateCSP for one policy of one manifest: the
+// enrolled hosts it allows, or why it was rejected
+export type CSPVerdict = { sources: string[] } | { error: string };
+
+// Hex SHA-256 of the manifest's default_csp and extra_csp
+export type CSPPartition = { incognito: boolean; manifest: string };
+
 export interface Database {
-  readonly origins: LRUCache<CacheKey<CachePartition>, OriginStateHolder>;
+  readonly origins: BudgetedLRUCache<
+    CacheKey<CachePartition>,
+    OriginStateHolder
+  >;
   readonly nonOrigins: LRUSet<CacheKey<CachePartition>>;
-  updateList(
-    leaves: readonly (readonly [string, string])[],
+  readonly cspVerdicts: LRUCache<CacheKey<CSPPartition>, CSPVerdict>;
+  updateList(leaves: readonly Leaf[], meta: BlockMeta): Promise<void>;
+  applyDelta(
+    changed: readonly Leaf[],
+    removed: readonly string[],
     meta: BlockMeta,
   ): Promise<void>;
+  listLeaves(): Promise<Leaf[]>;
   getBlockMeta(): Promise<BlockMeta | null>;
+  setBlockMeta(meta: BlockMeta): Promise<void>;
   listAllFQDNs(): Promise<string[]>;
+  getVerifiedManifest(key: string): Promise<VerifiedManifest | null>;
+  setVerifiedManifest(key: string, record: VerifiedManifest): Promise<void>;
   getFQDNEnrollment(
     fqdn: string,
     cachePartition: CachePartition,
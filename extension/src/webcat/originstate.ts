@@ -1,6 +1,6 @@
 import { bundle_name, bundle_prev_name } from "../config";
 import { canonicalize } from "./canonicalize";
-import { stringToUint8Array } from "./encoding";
+import { stringToUint8Array, Uint8ArrayToHex } from "./encoding";
 import {
   Bundle,
   Enrollment,
@@ -15,6 +15,7 @@ import {
   CachePartition,
   OriginStateHolder as IOriginStateHolder,
 } from "./interfaces/originstate";
+import { emitTestEvent, traced } from "./testing";
 import { arraysEqual } from "./utils";
 import { SHA256 } from "./utils";
 import { validateCSP, validateSigstoreEnrollment } from "./validators";
@@ -25,6 +26,12 @@ import {
   verifySigsumManifest,
 } from "./validators";
 
+async function hexDigest(value: object): Promise<string> {
+  return Uint8ArrayToHex(
+    new Uint8Array(await SHA256(stringToUint8Array(canonicalize(value)))),
+  );
+}
+
 type BundleFetch = {
   promise: Promise<Response>;
   error?: WebcatError;
@@ -103,6 +110,10 @@ export class BundleFetcher implements Iterable<BundleFetch> {
 
 export class OriginStateHolder implements IOriginStateHolder {
   public stale: boolean = false;
+  // When validation of the origin started, and how long it took until the
+  // manifest was verified: what dropping it from the cache would cost
+  public readonly created = performance.now();
+  public rebuildMs?: number;
 
   constructor(
     public current:
@@ -344,26 +355,45 @@ export class OriginStateVerifiedEnrollment extends OriginStateBase {
     }
 
     let verify_error: WebcatError | null = null;
+    // A const stays narrowed inside the traced callbacks
+    const enrollment = this.enrollment;
+
+    // The same manifest and signatures under the same enrollment were
+    // verified before, possibly in an earlier session: only their digests
+    // are compared, until max_age has passed since
+    const key = `${Uint8ArrayToHex(this.enrollment_hash)}:${await hexDigest(manifest)}`;
+    const signatures_digest = await hexDigest(signatures);
+    const known = await db.getVerifiedManifest(key);
+    const reused = known?.signatures === signatures_digest;
+    if (reused) {
+      emitTestEvent("manifest_reused", { fqdn: this.fqdn });
+    } else {
+      switch (enrollment.type) {
+        case EnrollmentTypes.Sigsum:
+          verify_error = await traced("verifySigsumManifest", () =>
+            verifySigsumManifest(
+              enrollment,
+              manifest,
+              signatures as SigsumSignatures,
+            ),
+          );
+          break;
+
+        case EnrollmentTypes.Sigstore:
+          verify_error = await traced("verifySigstoreManifest", () =>
+            verifySigstoreManifest(
+              enrollment,
+              manifest,
+              signatures as SigstoreSignatures,
+            ),
+          );
+          break;
 
-    switch (this.enrollment.type) {
-      case EnrollmentTypes.Sigsum:
-        verify_error = await verifySigsumManifest(
-          this.enrollment,
-          manifest,
-          signatures as SigsumSignatures,
-        );
-        break;
-
-      case EnrollmentTypes.Sigstore:
-        verify_error = await verifySigstoreManifest(
-          this.enrollment,
-          manifest,
-          signatures as SigstoreSignatures,
-        );
-        break;
-
-      default:
-        verify_error = new WebcatError(WebcatErrorCode.Enrollment.TYPE_INVALID);
+        default:
+          verify_error = new WebcatError(
+            WebcatErrorCode.Enrollment.TYPE_INVALID,
+          );
+      }
     }
 
     if (verify_error) {
@@ -375,18 +405,34 @@ export class OriginStateVerifiedEnrollment extends OriginStateBase {
       return new OriginStateFailed(this, format_error);
     }
 
+    if (!reused) {
+      await db.setVerifiedManifest(key, {
+        signatures: signatures_digest,
+        verifiedAt: Date.now(),
+        maxAge: enrollment.max_age,
+      });
+    }
+
     // ValidateCSP will populate this based on hosts presents in both
     // the CSP policies specified AND the enrollment list
     // If an enrolled CSP policy has non-enrolled hosts, then it will throw
     const valid_sources: Set<string> = new Set();
+    // Verdicts are memoized per policy string of this set of policies
+    const csp_digest = await hexDigest({
+      default_csp: manifest.default_csp,
+      extra_csp: manifest.extra_csp ?? {},
+    });
 
     // Validate the default CSP
     try {
-      await validateCSP(
-        db,
-        manifest.default_csp,
-        valid_sources,
-        this.cachePartition,
+      await traced("validateCSP", () =>
+        validateCSP(
+          db,
+          manifest.default_csp,
+          valid_sources,
+          this.cachePartition,
+          csp_digest,
+        ),
       );
     } catch (e) {
       //return new OriginStateFailed(this, `failed parsing default_csp: ${e}`);
@@ -403,7 +449,18 @@ export class OriginStateVerifiedEnrollment extends OriginStateBase {
       if (manifest.extra_csp.hasOwnProperty(path)) {
         const csp = manifest.extra_csp[path];
         try {
-          await validateCSP(db, csp, valid_sources, this.cachePartition);
+          await traced(
+            "validateCSP",
+            () =>
+              validateCSP(
+                db,
+                csp,
+                valid_sources,
+                this.cachePartition,
+                csp_digest,
+              ),
+            { path },
+          );
         } catch (e) {
           return new OriginStateFailed(
             this,
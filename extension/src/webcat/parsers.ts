@@ -1,6 +1,6 @@
 // From https://github.com/helmetjs/content-security-policy-parser/blob/main/mod.ts
 
-import { hexToUint8Array } from "./encoding";
+import { hexToUint8Array, Uint8ArrayToHex } from "./encoding";
 
 type ParsedContentSecurityPolicy = Map<string, string[]>;
 
@@ -91,6 +91,16 @@ export function extractHostname(key: string): string {
   return labels.reverse().join(".");
 }
 
+// Inverse of extractHostname
+export function hostnameToKey(hostname: string): string {
+  return `canonical/.${hostname.split(".").reverse().join(".")}`;
+}
+
+// Inverse of extractRawHash
+export function encodeRawHash(rawHash: Uint8Array): string {
+  return Uint8ArrayToHex(new Uint8Array([0x0a, rawHash.length, ...rawHash]));
+}
+
 export function extractRawHash(hexValue: string): Uint8Array {
   const bytes = hexToUint8Array(hexValue);
 
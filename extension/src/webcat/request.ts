@@ -1,4 +1,5 @@
 import { BeforeRequestDetails } from "../browser/requests";
+import { testSlot } from "../config";
 import { CacheKey } from "./cache";
 import { Database } from "./interfaces/database";
 import { WebcatError, WebcatErrorCode } from "./interfaces/errors";
@@ -13,7 +14,9 @@ import { setIcon } from "./ui";
 
 declare const __IS_TESTING__: boolean;
 
-const allowedPorts = __IS_TESTING__ ? ["8080", "8443", ""] : ["80", "443", ""];
+const allowedPorts = __IS_TESTING__
+  ? [testSlot.httpPort, testSlot.httpsPort, ""]
+  : ["80", "443", ""];
 
 export function validateProtocolAndPort(urlobj: URL): boolean {
   if (
@@ -33,7 +36,7 @@ export function enforceHTTPS(urlobj: URL): string | undefined {
   ) {
     urlobj.protocol = "https:";
     if (__IS_TESTING__) {
-      urlobj.port = "8443";
+      urlobj.port = testSlot.httpsPort;
     }
     return urlobj.toString();
   }
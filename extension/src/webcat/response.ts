@@ -23,6 +23,7 @@ import {
   OriginStateVerifiedManifest,
 } from "./originstate";
 import { PASS_THROUGH_TYPES } from "./resources";
+import { emitTestEvent, trackFilter, traced } from "./testing";
 import { errorpage, setOKIcon } from "./ui";
 import {
   arraysEqual,
@@ -133,13 +134,21 @@ export class ResponseValidator {
         } catch {
           return new WebcatError(WebcatErrorCode.Headers.ENROLLMENT_MALFORMED);
         }
-        details.state.pendingOrigin.current = await (
-          details.state.pendingOrigin.current as OriginStateInitial
-        ).verifyEnrollment(this.#db, enrollment, delegation);
+        const initial = details.state.pendingOrigin
+          .current as OriginStateInitial;
+        details.state.pendingOrigin.current = await traced(
+          "verifyEnrollment",
+          () => initial.verifyEnrollment(this.#db, enrollment, delegation),
+          { url: details.url },
+        );
       } else {
-        details.state.pendingOrigin.current = await (
-          details.state.pendingOrigin.current as OriginStateInitial
-        ).verifyEnrollment(this.#db, undefined, delegation);
+        const initial = details.state.pendingOrigin
+          .current as OriginStateInitial;
+        details.state.pendingOrigin.current = await traced(
+          "verifyEnrollment",
+          () => initial.verifyEnrollment(this.#db, undefined, delegation),
+          { url: details.url },
+        );
       }
 
       if (details.state.pendingOrigin.current.status === "failed") {
@@ -149,9 +158,13 @@ export class ResponseValidator {
       logger.debug("Header parsing complete", details);
 
       // Step 3: Populate and validate the manifest
-      details.state.pendingOrigin.current = await (
-        details.state.pendingOrigin.current as OriginStateVerifiedEnrollment
-      ).verifyManifest(this.#db);
+      const enrolled = details.state.pendingOrigin
+        .current as OriginStateVerifiedEnrollment;
+      details.state.pendingOrigin.current = await traced(
+        "verifyManifest",
+        () => enrolled.verifyManifest(this.#db),
+        { url: details.url },
+      );
       if (details.state.pendingOrigin.current.status === "failed") {
         return (details.state.pendingOrigin.current as OriginStateFailed).error;
       }
@@ -165,6 +178,10 @@ export class ResponseValidator {
       }
 
       logger.info(`Metadata for ${details.url} loaded`, details);
+      emitTestEvent("origin_verified", {
+        fqdn: details.state.pendingOrigin.current.fqdn,
+        url: details.url,
+      });
     }
 
     // Now, we should have the manifest, and can validate the CSP based on path
@@ -337,6 +354,7 @@ export class ResponseValidator {
 
     let manifest!: Manifest;
     const filter = browser.webRequest.filterResponseData(details.requestId);
+    trackFilter(filter, details.url);
     const source: Promise<ArrayBuffer>[] = [];
     filter.onstart = () => {
       assertVerifiedManifest(originStateHolder);
@@ -381,26 +399,32 @@ export class ResponseValidator {
 
     let writeQueue: Promise<void> = Promise.resolve();
     let markerSeen = false;
+    // The network response, as received
+    const body: ArrayBuffer[] = [];
+    let bodyLength = 0;
     filter.ondata = (event: { data: ArrayBuffer }) => {
-      // The data here is usually chunked; normally it would be streamed down as
-      // we get it but since we can hash the content only at the end, we have to
-      // wait until we have everything before deciding if the response content
-      // matches the manifest or not. So we are saving it and we will build a
-      // blob later. If the data is the marker, flush all buffered data;
-      // anything received up to that point is from this or other extensions, not
-      // the network.
+      // The data here is usually chunked. It can't be streamed down before the
+      // whole response matched the manifest, so the chunks are held until
+      // end-of-stream, then hashed in one native WebCrypto call.
+      // If the data is the marker, flush all buffered data; anything received
+      // up to that point is from this or other extensions, not the network.
+      // Pass-through types get no marker.
       if (arraysEqual(this.#marker, new Uint8Array(event.data))) {
         source.forEach((hook) => {
           writeQueue = writeQueue.then(async () => filter.write(await hook));
         });
         source.length = 0;
         markerSeen = true;
+      } else if (markerSeen || PASS_THROUGH_TYPES.has(details.type)) {
+        body.push(event.data);
+        bodyLength += event.data.byteLength;
       } else {
         source.push(Promise.resolve(event.data));
       }
     };
 
-    filter.onstop = async () => {
+    // Hashing and writing back the complete response
+    const verifyContent = async () => {
       if (!markerSeen && !PASS_THROUGH_TYPES.has(details.type)) {
         // The request terminated early, before headers were received,
         // possibly because the user navigated away. Close without
@@ -422,8 +446,6 @@ export class ResponseValidator {
         filter.close();
         return;
       }
-      const blob = await new Blob(await Promise.all(source)).arrayBuffer();
-
       // Following order of priority:
       // - If there's an exact match, that should be the hash
       // - If the paths ends in /, and there was no exact match, then use default_index
@@ -448,14 +470,21 @@ export class ResponseValidator {
         return;
       }
 
-      const content_hash = await SHA256(blob);
+      // Join the chunks, back to front, releasing each once copied so that
+      // the body is held about once rather than twice
+      const chunks = body.length;
+      const content = new Uint8Array(bodyLength);
+      let offset = bodyLength;
+      let chunk: ArrayBuffer | undefined;
+      while ((chunk = body.pop()) !== undefined) {
+        offset -= chunk.byteLength;
+        content.set(new Uint8Array(chunk), offset);
+      }
+      const content_hash = new Uint8Array(await SHA256(content.buffer));
       // Sometimes answers gets cached and we get an empty result, we shouldn't mark those as a hash mismatch
       if (
-        !arraysEqual(
-          base64UrlToUint8Array(manifest_hash),
-          new Uint8Array(content_hash),
-        ) &&
-        blob.byteLength !== 0
+        !arraysEqual(base64UrlToUint8Array(manifest_hash), content_hash) &&
+        bodyLength !== 0
       ) {
         deny(filter);
         filter.close();
@@ -464,17 +493,22 @@ export class ResponseValidator {
           new WebcatError(WebcatErrorCode.File.MISMATCH, [
             pathname,
             String(manifest_hash),
-            String(Uint8ArrayToBase64Url(new Uint8Array(content_hash))),
+            String(Uint8ArrayToBase64Url(content_hash)),
           ]),
         );
         return;
       }
 
-      // If everything is OK then we can just write the raw blob back
+      // If everything is OK then we can just write the raw chunks back
       logger.info(`${pathname} verified.`, details);
+      emitTestEvent("file_verified", {
+        url: details.url,
+        chunks,
+        bytes: bodyLength,
+      });
 
       await writeQueue;
-      filter.write(blob);
+      filter.write(content);
       // close() ensures that nothing can be added afterwards; disconnect() just stops the filter and not the response
       // see https://developer.mozilla.org/en-US/docs/Mozilla/Add-ons/WebExtensions/API/webRequest/StreamFilter
       filter.close();
@@ -483,6 +517,8 @@ export class ResponseValidator {
       }
       // Redirect the main frame to an error page
     };
+    filter.onstop = () =>
+      traced("validateContent.onstop", verifyContent, { url: details.url });
   }
 
   markContent(details: HeadersReceivedDetails) {
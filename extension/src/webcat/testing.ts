@@ -0,0 +1,84 @@
+declare const __IS_TESTING__: boolean;
+
+// Prefix of the console lines that the integration tests parse as events
+export const TEST_EVENT_PREFIX = "__WEBCAT_TEST_EVENT__";
+
+/**
+ * Report an event to the integration tests through the extension console.
+ * No-op outside of testing builds.
+ * @param event - Event name.
+ * @param data - JSON-serializable event payload.
+ */
+export function emitTestEvent(
+  event: string,
+  data: Record<string, unknown> = {},
+): void {
+  if (__IS_TESTING__) {
+    console.info(TEST_EVENT_PREFIX, JSON.stringify({ event, ...data }));
+  }
+}
+
+let openFilters = 0;
+
+/**
+ * Count a response filter as open until it is closed, disconnected or fails,
+ * reporting the number of open filters on every change. The tests wait for it
+ * to drop to zero instead of sleeping after the last response was served.
+ */
+export function trackFilter(
+  filter: browser.webRequest.StreamFilter,
+  url: string,
+): void {
+  if (!__IS_TESTING__) {
+    return;
+  }
+  let done = false;
+  const finish = () => {
+    if (!done) {
+      done = true;
+      openFilters--;
+      emitTestEvent("filters", { open: openFilters, url });
+    }
+  };
+  const close = filter.close.bind(filter);
+  const disconnect = filter.disconnect.bind(filter);
+  filter.close = () => {
+    close();
+    finish();
+  };
+  filter.disconnect = () => {
+    disconnect();
+    finish();
+  };
+  filter.onerror = finish;
+  openFilters++;
+  emitTestEvent("filters", { open: openFilters, url });
+}
+
+/**
+ * Run `fn` and record it as a performance.measure span named `name`, so that
+ * the integration tests can see where a navigation spends its time (see
+ * Browser.collect_extension_trace). Opt-in: spans are only recorded in testing
+ * builds, once the tests set `globalThis.__WEBCAT_TRACE__`.
+ * @param name - Span name, usually the traced function.
+ * @param fn - Work to time.
+ * @param detail - JSON-serializable span metadata, such as the request URL.
+ */
+export async function traced<T>(
+  name: string,
+  fn: () => Promise<T>,
+  detail: Record<string, unknown> = {},
+): Promise<T> {
+  if (
+    !__IS_TESTING__ ||
+    !(globalThis as { __WEBCAT_TRACE__?: boolean }).__WEBCAT_TRACE__
+  ) {
+    return fn();
+  }
+  const start = performance.now();
+  try {
+    return await fn();
+  } finally {
+    performance.measure(name, { start, end: performance.now(), detail });
+  }
+}
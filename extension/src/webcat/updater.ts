@@ -7,8 +7,13 @@ import {
   WebcatLeavesFile,
 } from "@freedomofpress/ics23/dist/webcat";
 
-import { hexToUint8Array, Uint8ArrayToBase64 } from "./encoding";
-import { Database } from "./interfaces/database";
+import {
+  hexToUint8Array,
+  Uint8ArrayToBase64,
+  Uint8ArrayToHex,
+} from "./encoding";
+import { BlockMeta, Database, Leaf } from "./interfaces/database";
+import { emitTestEvent } from "./testing";
 import { arraysEqual } from "./utils";
 
 declare const __IS_TESTING__: boolean;
@@ -24,6 +29,16 @@ export class UpdateEvent extends Event {
   }
 }
 
+// Changes to the list since block `since`, with the proof for the resulting
+// list; served by the update endpoint as list-delta.json?since=<height>
+export interface WebcatLeavesDelta {
+  since: string;
+  height: string;
+  changed: Leaf[];
+  removed: string[];
+  proof: WebcatLeavesFile["proof"];
+}
+
 export type EnrollmentUpdaterOptions = {
   endpoint: string;
   database: Database;
@@ -103,6 +118,7 @@ export class EnrollmentUpdater extends EventTarget {
    * files bundled with the extension are consulted without accessing the network.
    */
   async update(local = false) {
+    const started = performance.now();
     try {
       console.log("[webcat] Running production list updater");
       await this.#db.setLastChecked();
@@ -122,18 +138,19 @@ export class EnrollmentUpdater extends EventTarget {
         blocksUrl = `${this.#endpoint}block.json`;
       }
 
-      const leavesResponse = this.#fetchWithTimeout(leavesUrl);
-      const blockResponse = this.#fetchWithTimeout(blocksUrl);
-
-      // Prevent unhandled rejection if block fetch fails before leaves is awaited
-      leavesResponse.catch(() => {});
-
-      // 2 Await latest block
-      const block = await (await blockResponse).json();
-      console.log("[webcat] Update block fetched");
+      // 2 Fetch the latest block first: when it, or the state it commits
+      // to, didn't change, the list isn't downloaded at all
+      const meta = await this.#db.getBlockMeta();
+      const blockResponse = await this.#fetchWithTimeout(
+        blocksUrl,
+        !local && meta?.blockETag ? { "If-None-Match": meta.blockETag } : {},
+      );
 
       if (__IS_TESTING__) {
-        const reschedule = block.__WEBCAT_TEST_SCHEDULE_UPDATE__;
+        // Sent as a header so that it also arrives with 304 responses
+        const reschedule = Number(
+          blockResponse.headers.get("X-Webcat-Test-Schedule-Update"),
+        );
         if (reschedule) {
           console.log(
             "[webcat] Rescheduling update for test in",
@@ -146,6 +163,16 @@ export class EnrollmentUpdater extends EventTarget {
         }
       }
 
+      if (blockResponse.status === 304) {
+        console.log("[webcat] Block not modified, skipping");
+        emitTestEvent("update_skipped", { reason: "not_modified" });
+        this.#lastUpdateFailed = false;
+        this.dispatchEvent(new UpdateEvent(false, local));
+        return;
+      }
+      const block = await blockResponse.json();
+      console.log("[webcat] Update block fetched");
+
       // 3 Verify block against validatorSet
       const { proto: vset, cryptoIndex } = await importValidators(
         this.#validatorSet,
@@ -168,16 +195,55 @@ export class EnrollmentUpdater extends EventTarget {
         throw new Error("Block verification did not return a time");
       }
 
-      const meta = await this.#db.getBlockMeta();
       if (meta !== null && out.headerTime.seconds <= meta.blockTime) {
         console.log("[webcat] Block already applied, skipping");
+        emitTestEvent("update_skipped", { reason: "applied" });
+        this.#lastUpdateFailed = false;
+        this.dispatchEvent(new UpdateEvent(false, local));
+        return;
+      }
+
+      const height = Number(block.signed_header?.header?.height);
+      const appHash = Uint8ArrayToHex(out.appHash);
+      const newMeta: BlockMeta = {
+        blockTime: Number(out.headerTime.seconds),
+        rootHash: "",
+        height: Number.isSafeInteger(height) ? height : undefined,
+        appHash,
+        blockETag: blockResponse.headers.get("ETag") ?? undefined,
+      };
+
+      // The list is committed to by the app hash, so a newer block with the
+      // same app hash carries the list we already have
+      if (meta !== null && meta.appHash === appHash) {
+        newMeta.rootHash = meta.rootHash;
+        await this.#db.setBlockMeta(newMeta);
+        if (!local) {
+          await this.#db.setLastUpdated();
+        }
+        console.log("[webcat] App hash unchanged, list is up to date");
+        emitTestEvent("update_skipped", { reason: "app_hash" });
         this.#lastUpdateFailed = false;
         this.dispatchEvent(new UpdateEvent(false, local));
         return;
       }
 
+      // 4 With a known height, try the changes since then instead of the
+      // whole list; any failure falls back to the full list
+      const deltaSince = !local ? meta?.height : undefined;
+      if (deltaSince !== undefined) {
+        if (await this.#tryDelta(deltaSince, out.appHash, newMeta)) {
+          this.#lastUpdateFailed = false;
+          return;
+        }
+        console.log("[webcat] List delta unavailable, fetching full list");
+      }
+
       // 5 Fetch leaves file (with timeout)
-      const leaves = (await (await leavesResponse).json()) as WebcatLeavesFile;
+      const leaves = (await (
+        await this.#fetchWithTimeout(leavesUrl)
+      ).json()) as WebcatLeavesFile;
+      const fetched = performance.now();
 
       // 6 Verify leaves file app_hash matches the block one
       if (!arraysEqual(hexToUint8Array(leaves.proof.app_hash), out.appHash)) {
@@ -189,10 +255,19 @@ export class EnrollmentUpdater extends EventTarget {
       if (verifiedLeaves === false) {
         throw new Error("proof did not verify against app hash");
       }
-
-      await this.#db.updateList(verifiedLeaves, {
-        blockTime: Number(out.headerTime.seconds),
-        rootHash: leaves.proof.canonical_root_hash,
+      const verified = performance.now();
+
+      newMeta.rootHash = leaves.proof.canonical_root_hash;
+      await this.#db.updateList(verifiedLeaves, newMeta);
+      const ingested = performance.now();
+      emitTestEvent("list_applied", {
+        local,
+        delta: false,
+        leaves: verifiedLeaves.length,
+        fetch_ms: fetched - started,
+        verify_ms: verified - fetched,
+        ingest_ms: ingested - verified,
+        total_ms: ingested - started,
       });
       if (!local) {
         await this.#db.setLastUpdated();
@@ -210,6 +285,84 @@ export class EnrollmentUpdater extends EventTarget {
     }
   }
 
+  /**
+   * Fetches and applies the delta since block `since`. Returns false, for
+   * the caller to fetch the full list, when it is missing, malformed, for
+   * another block or doesn't verify, and when fetching it fails.
+   */
+  async #tryDelta(
+    since: number,
+    appHash: Uint8Array,
+    meta: BlockMeta,
+  ): Promise<boolean> {
+    try {
+      const response = await this.#fetchWithTimeout(
+        `${this.#endpoint}list-delta.json?since=${since}`,
+      );
+      if (!response.ok) {
+        return false;
+      }
+      const delta = (await response.json()) as WebcatLeavesDelta;
+      return (
+        Number(delta.since) === since &&
+        (await this.#applyDelta(delta, appHash, meta))
+      );
+    } catch (error) {
+      console.warn("[webcat] List delta failed:", error);
+      return false;
+    }
+  }
+
+  /**
+   * Verifies a delta by applying it to the stored list and checking the
+   * proof of the result, then stores only the changes. Returns false when
+   * it is for another app hash or the result doesn't verify, e.g. because
+   * the stored list diverged.
+   */
+  async #applyDelta(
+    delta: WebcatLeavesDelta,
+    appHash: Uint8Array,
+    meta: BlockMeta,
+  ): Promise<boolean> {
+    const started = performance.now();
+    if (!arraysEqual(hexToUint8Array(delta.proof.app_hash), appHash)) {
+      return false;
+    }
+    // The proof covers the whole list, so the merged list is what gets
+    // verified
+    const merged = new Map(await this.#db.listLeaves());
+    for (const key of delta.removed) {
+      merged.delete(key);
+    }
+    for (const [key, value] of delta.changed) {
+      merged.set(key, value);
+    }
+    const leaves = Array.from(merged).sort(([a], [b]) =>
+      a < b ? -1 : a > b ? 1 : 0,
+    );
+    const verified = await verifyWebcatProof({ leaves, proof: delta.proof });
+    if (verified === false) {
+      return false;
+    }
+    const verifiedAt = performance.now();
+
+    meta.rootHash = delta.proof.canonical_root_hash;
+    await this.#db.applyDelta(delta.changed, delta.removed, meta);
+    await this.#db.setLastUpdated();
+    console.log(`[webcat] List delta applied successfully`);
+    emitTestEvent("list_applied", {
+      local: false,
+      delta: true,
+      leaves: leaves.length,
+      changed: delta.changed.length,
+      removed: delta.removed.length,
+      verify_ms: verifiedAt - started,
+      ingest_ms: performance.now() - verifiedAt,
+    });
+    this.dispatchEvent(new UpdateEvent(true));
+    return true;
+  }
+
   /**
    * Retries an update if the previous attempt failed.
    * Unlike update, retryIfFailed never throws.
@@ -272,14 +425,19 @@ export class EnrollmentUpdater extends EventTarget {
 
   async #fetchWithTimeout(
     url: string,
+    headers: HeadersInit = {},
     timeoutMs: number = this.#fetchTimeout,
   ): Promise<Response> {
     const controller = new AbortController();
     const timeoutId = setTimeout(() => controller.abort(), timeoutMs);
 
     try {
+      // The browser negotiates gzip/br itself; conditional requests use the
+      // validators stored with the block meta instead of the HTTP cache, so
+      // a 304 reaches the caller
       const response = await fetch(url, {
         cache: "no-store",
+        headers,
         signal: controller.signal,
       });
       clearTimeout(timeoutId);
@@ -24,6 +24,7 @@ import {
   RawPublicKey,
 } from "@freedomofpress/sigsum/dist/types";
 
+import { CacheKey } from "./cache";
 import { canonicalize } from "./canonicalize";
 import { base64UrlToUint8Array, stringToUint8Array } from "./encoding";
 import {
@@ -39,11 +40,51 @@ import { CachePartition } from "./interfaces/originstate";
 import { parseContentSecurityPolicy } from "./parsers";
 import { getFQDNSafe } from "./utils";
 
+/**
+ * Validate a CSP of a manifest, adding the enrolled hosts it allows to
+ * valid_sources. With the manifest's CSP digest, the verdict is memoized in
+ * db.cspVerdicts, which is cleared whenever the enrollment list changes.
+ * @param manifest_digest - Hex SHA-256 of the manifest's default_csp and
+ *   extra_csp.
+ */
 export async function validateCSP(
   db: Database,
   csp: string,
   valid_sources: Set<string>,
   cachePartition: CachePartition,
+  manifest_digest?: string,
+) {
+  if (manifest_digest === undefined) {
+    return checkCSP(db, csp, valid_sources, cachePartition);
+  }
+
+  const key = CacheKey(csp, {
+    incognito: cachePartition.incognito,
+    manifest: manifest_digest,
+  });
+  let verdict = db.cspVerdicts.get(key);
+  if (!verdict) {
+    const sources = new Set<string>();
+    try {
+      await checkCSP(db, csp, sources, cachePartition);
+      verdict = { sources: [...sources] };
+    } catch (e) {
+      verdict = { error: e instanceof Error ? e.message : String(e) };
+    }
+    db.cspVerdicts.set(key, verdict);
+  }
+
+  if ("error" in verdict) {
+    throw new Error(verdict.error);
+  }
+  verdict.sources.forEach((source) => valid_sources.add(source));
+}
+
+async function checkCSP(
+  db: Database,
+  csp: string,
+  valid_sources: Set<string>,
+  cachePartition: CachePartition,
 ) {
   // See https://github.com/freedomofpress/webcat/issues/9
   // https://github.com/freedomofpress/webcat/issues/3
@@ -0,0 +1,64 @@
+import { bench, describe } from "vitest";
+
+import { CacheKey, isInPartition, LRUSet } from "./../../src/webcat/cache";
+
+// Keys of a cache after long browsing: a tenth of them incognito
+const sizes = [10_000, 100_000];
+
+function keys(size: number) {
+  return Array.from({ length: size }, (_, i) =>
+    CacheKey(`host${i}.example.com`, {
+      incognito: i % 10 === 0,
+      container: `firefox-container-${i % 4}`,
+    }),
+  );
+}
+
+function filled(all: string[]) {
+  const set = new LRUSet<string>(all.length);
+  all.forEach((key) => set.add(key));
+  return set;
+}
+
+for (const size of sizes) {
+  const all = keys(size);
+  const set = filled(all);
+
+  describe(`keys of a partition, ${size} keys`, () => {
+    bench("isInPartition scan", () => {
+      set.values().filter((key) =>
+        isInPartition(key as CacheKey<{ incognito: boolean }>, {
+          incognito: true,
+        }),
+      );
+    });
+
+    bench("partition index", () => {
+      set.valuesInPartition({ incognito: true });
+    });
+  });
+
+  // Each round fills a fresh cache, so the fill alone is the baseline
+  describe(`purge of a partition, ${size} keys`, () => {
+    bench("fill only", () => {
+      filled(all);
+    });
+
+    bench("fill, isInPartition scan", () => {
+      const set = filled(all);
+      for (const key of set.values()) {
+        if (
+          isInPartition(key as CacheKey<{ incognito: boolean }>, {
+            incognito: true,
+          })
+        ) {
+          set.delete(key);
+        }
+      }
+    });
+
+    bench("fill, deletePartition", () => {
+      filled(all).deletePartition({ incognito: true });
+    });
+  });
+}
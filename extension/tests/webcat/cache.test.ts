@@ -1,6 +1,15 @@
 import { describe, expect, it } from "vitest";
 
-import { LRUCache, LRUSet } from "./../../src/webcat/cache";
+import {
+  BudgetedLRUCache,
+  CacheKey,
+  HostIndex,
+  hostHash,
+  isInPartition,
+  LRUCache,
+  LRUSet,
+  PartitionIndex,
+} from "./../../src/webcat/cache";
 
 describe("LRUCache", () => {
   it("should return undefined for missing keys", () => {
@@ -97,3 +106,222 @@ describe("LRUSet", () => {
     expect(cache.values()).toEqual([3, 1, 4]);
   });
 });
+
+describe("BudgetedLRUCache", () => {
+  // Values are [bytes, cost]
+  const weigh = ([bytes, cost]: number[]) => ({ bytes, cost });
+
+  it("should evict the least recently used entry past maxEntries", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(2, 1000, weigh);
+    cache.set("a", [10, 1]);
+    cache.set("b", [10, 1]);
+    cache.get("a");
+    cache.set("c", [10, 1]);
+    expect(cache.keys()).toEqual(["a", "c"]);
+  });
+
+  it("should peek without counting or reordering", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(2, 1000, weigh);
+    cache.set("a", [10, 1]);
+    cache.set("b", [10, 1]);
+    expect(cache.peek("a")).toEqual([10, 1]);
+    expect(cache.peek("missing")).toBeUndefined();
+    cache.set("c", [10, 1]); // "a" is still the least recently used
+    expect(cache.keys()).toEqual(["b", "c"]);
+    expect(cache.stats()).toMatchObject({ hits: 0, misses: 0 });
+  });
+
+  it("should stay within the byte budget", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(100, 100, weigh);
+    for (const key of ["a", "b", "c", "d", "e"]) {
+      cache.set(key, [40, 1]);
+    }
+    expect(cache.keys()).toEqual(["d", "e"]);
+    expect(cache.stats().bytes).toBe(80);
+    cache.delete("d");
+    expect(cache.stats().bytes).toBe(40);
+  });
+
+  it("should evict cheap entries per byte first", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(100, 100, weigh);
+    cache.set("expensive", [40, 100]);
+    cache.set("cheap", [40, 1]);
+    cache.set("new", [40, 1]);
+    expect(cache.keys()).toEqual(["expensive", "new"]);
+  });
+
+  it("should age entries that are not used again", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(100, 100, weigh);
+    cache.set("expensive", [50, 2]);
+    for (let i = 0; i < 10; i++) {
+      cache.set(`cheap${i}`, [50, 1]);
+    }
+    expect(cache.has("expensive")).toBe(false);
+  });
+
+  it("should keep a new entry larger than the budget", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(100, 100, weigh);
+    cache.set("a", [40, 1]);
+    cache.set("huge", [400, 1]);
+    expect(cache.keys()).toEqual(["huge"]);
+  });
+
+  it("should count hits, misses and evictions", () => {
+    const cache = new BudgetedLRUCache<string, number[]>(1, 1000, weigh);
+    cache.set("a", [10, 1]);
+    cache.get("a");
+    cache.get("b");
+    cache.set("b", [10, 1]);
+    expect(cache.stats()).toEqual({
+      hits: 1,
+      misses: 1,
+      evictions: 1,
+      entries: 1,
+      bytes: 10,
+      maxEntries: 1,
+      maxBytes: 1000,
+    });
+  });
+});
+
+describe("HostIndex", () => {
+  // Two hosts with the same 32-bit hash
+  const colliding = ["h84337.example", "h1340180.example"];
+
+  it("should find added hosts and miss others", () => {
+    const index = new HostIndex(["example.com", "a.example.org"]);
+    expect(index.has("example.com")).toBe(true);
+    expect(index.has("a.example.org")).toBe(true);
+    expect(index.has("b.example.org")).toBe(false);
+    expect(index.has("")).toBe(false);
+    expect(new HostIndex().has("example.com")).toBe(false);
+  });
+
+  it("should add and remove hosts", () => {
+    const index = new HostIndex(["keep.com", "drop.com"]);
+    index.add(["new.com"]);
+    index.remove(["drop.com"]);
+    expect(index.has("keep.com")).toBe(true);
+    expect(index.has("new.com")).toBe(true);
+    expect(index.has("drop.com")).toBe(false);
+    expect(index.size).toBe(2);
+  });
+
+  it("should keep a colliding host when the other is removed", () => {
+    expect(hostHash(colliding[0])).toBe(hostHash(colliding[1]));
+    const index = new HostIndex(colliding);
+    index.remove([colliding[0]]);
+    expect(index.has(colliding[1])).toBe(true);
+    index.remove([colliding[1]]);
+    expect(index.has(colliding[1])).toBe(false);
+  });
+});
+
+describe("PartitionIndex", () => {
+  const key = (host: string, incognito: boolean, container = "default") =>
+    CacheKey(host, { incognito, container });
+
+  it("should find the keys of a partition like isInPartition", () => {
+    const keys = [
+      key("a.com", true),
+      key("b.com", false),
+      key("c.com", true, "work"),
+      key("d.com", false, "a=b,c"),
+    ];
+    const index = new PartitionIndex<string>();
+    keys.forEach((k) => index.add(k));
+    for (const partition of [
+      { incognito: true },
+      { incognito: false },
+      { incognito: true, container: "work" },
+      { container: "missing" },
+      {},
+    ]) {
+      expect(index.keys(partition, () => keys).sort()).toEqual(
+        keys.filter((k) => isInPartition(k, partition)).sort(),
+      );
+    }
+    // Values are compared encoded, as CacheKey writes them
+    expect(index.keys({ container: "a=b,c" }, () => keys)).toEqual([keys[3]]);
+  });
+
+  it("should forget deleted keys", () => {
+    const index = new PartitionIndex<string>();
+    index.add(key("a.com", true));
+    index.add(key("b.com", true));
+    index.delete(key("a.com", true));
+    expect(index.keys({ incognito: true }, () => [])).toEqual([
+      key("b.com", true),
+    ]);
+    index.clear();
+    expect(index.keys({ incognito: true }, () => [])).toEqual([]);
+  });
+});
+
+describe("Partition purges", () => {
+  const key = (host: string, incognito: boolean) =>
+    CacheKey(host, { incognito });
+
+  it("should match every key with the empty partition", () => {
+    const cache = new LRUCache<string, number>(3);
+    cache.set(key("a.com", true), 1);
+    cache.set("plain", 2);
+    expect(cache.keysInPartition({})).toEqual(cache.keys());
+    expect(cache.keys().every((k) => isInPartition(k as never, {}))).toBe(
+      true,
+    );
+    cache.deletePartition({});
+    expect(cache.keys()).toEqual([]);
+
+    const set = new LRUSet<string>(3);
+    set.add(key("a.com", false));
+    set.deletePartition({});
+    expect(set.values()).toEqual([]);
+  });
+
+  it("should delete a partition of an LRUCache", () => {
+    const cache = new LRUCache<string, number>(3);
+    cache.set(key("a.com", true), 1);
+    cache.set(key("b.com", false), 2);
+    cache.set(key("c.com", true), 3);
+    cache.deletePartition({ incognito: true });
+    expect(cache.keys()).toEqual([key("b.com", false)]);
+    expect(cache.keysInPartition({ incognito: true })).toEqual([]);
+  });
+
+  it("should not find evicted keys in their partition", () => {
+    const cache = new LRUCache<string, number>(2);
+    cache.set(key("a.com", true), 1);
+    cache.set(key("b.com", true), 2);
+    cache.set(key("c.com", true), 3); // "a.com" is evicted
+    expect(cache.keysInPartition({ incognito: true })).toEqual([
+      key("b.com", true),
+      key("c.com", true),
+    ]);
+  });
+
+  it("should delete a partition of an LRUSet", () => {
+    const set = new LRUSet<string>(2);
+    set.add(key("a.com", true));
+    set.add(key("b.com", false));
+    set.add(key("c.com", true)); // "a.com" is evicted
+    expect(set.valuesInPartition({ incognito: true })).toEqual([
+      key("c.com", true),
+    ]);
+    set.deletePartition({ incognito: true });
+    expect(set.values()).toEqual([key("b.com", false)]);
+  });
+
+  it("should delete a partition of a BudgetedLRUCache", () => {
+    const cache = new BudgetedLRUCache<string, number>(10, 100, (value) => ({
+      bytes: value,
+      cost: 1,
+    }));
+    cache.set(key("a.com", true), 10);
+    cache.set(key("b.com", false), 20);
+    cache.set(key("c.com", true), 30);
+    cache.deletePartition({ incognito: true });
+    expect(cache.keys()).toEqual([key("b.com", false)]);
+    expect(cache.stats().bytes).toBe(20);
+  });
+});
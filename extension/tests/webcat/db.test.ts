@@ -32,6 +32,8 @@ function fakeLeaf(fqdn: string, payload: number[]): [string, string] {
 function makeFakeStore() {
   let storage: Record<string, any> = {};
   return {
+    getKeys: undefined as (() => Promise<string[]>) | undefined,
+    keys: () => Object.keys(storage),
     get: vi.fn(async (keyOrNull: string | null) => {
       if (keyOrNull === null) return { ...storage };
       if (typeof keyOrNull === "string") {
@@ -105,6 +107,146 @@ describe("WebcatDatabase", () => {
     expect(meta).toBeNull();
   });
 
+  it("applyDelta writes changed and drops removed entries", async () => {
+    await db.updateList(
+      [fakeLeaf("keep.com", [1]), fakeLeaf("drop.com", [2])],
+      { blockTime: 100, height: 1 },
+    );
+    await db.applyDelta(
+      [fakeLeaf("keep.com", [3]), fakeLeaf("new.com", [4])],
+      [fakeLeaf("drop.com", [])[0]],
+      { blockTime: 200, height: 2 },
+    );
+
+    expect(Array.from(await db.getFQDNEnrollment("keep.com"))).toEqual([3]);
+    expect(Array.from(await db.getFQDNEnrollment("new.com"))).toEqual([4]);
+    expect((await db.getFQDNEnrollment("drop.com")).length).toBe(0);
+    expect(await db.getBlockMeta()).toEqual({ blockTime: 200, height: 2 });
+  });
+
+  it("listLeaves returns the stored list sorted by key", async () => {
+    const leaves = [
+      fakeLeaf("b.example.com", [0xbe, 0xef]),
+      fakeLeaf("a.example.com", [0xca, 0xfe]),
+      fakeLeaf("example.org", [1]),
+    ];
+    await db.updateList(leaves, { blockTime: 100 });
+
+    expect(await db.listLeaves()).toEqual([leaves[1], leaves[0], leaves[2]]);
+  });
+
+  it("listLeaves reads only the enrollments when keys can be listed", async () => {
+    const local = (globalThis as any).browser.storage.local;
+    local.getKeys = vi.fn(async () => local.keys());
+    await db.updateList([fakeLeaf("example.com", [1])], { blockTime: 100 });
+    await db.setVerifiedManifest("e:m", {
+      signatures: "ab",
+      verifiedAt: Date.now(),
+      maxAge: 60,
+    });
+    local.get.mockClear();
+
+    expect(await db.listLeaves()).toEqual([fakeLeaf("example.com", [1])]);
+    expect(local.get).toHaveBeenCalledTimes(1);
+    expect(local.get).toHaveBeenCalledWith(["WEBCAT:enrollments:example.com"]);
+  });
+
+  it("getFQDNEnrollment answers non-enrolled hosts from the index", async () => {
+    await db.updateList([fakeLeaf("example.com", [1])], { blockTime: 100 });
+    const local = (globalThis as any).browser.storage.local;
+    local.get.mockClear();
+
+    expect((await db.getFQDNEnrollment("other.org")).length).toBe(0);
+    expect((await db.getFQDNEnrollment("example.org")).length).toBe(0);
+    expect(local.get).not.toHaveBeenCalled();
+    expect(Array.from(await db.getFQDNEnrollment("example.com"))).toEqual([1]);
+  });
+
+  it("getFQDNEnrollment loads the index from a list stored earlier", async () => {
+    await db.updateList([fakeLeaf("example.com", [1])], { blockTime: 100 });
+    const restarted = new WebcatDatabase();
+
+    expect((await restarted.getFQDNEnrollment("other.org")).length).toBe(0);
+    expect(Array.from(await restarted.getFQDNEnrollment("example.com"))).toEqual(
+      [1],
+    );
+  });
+
+  it("applyDelta keeps the index in step", async () => {
+    await db.updateList([fakeLeaf("drop.com", [1])], { blockTime: 100 });
+    expect(Array.from(await db.getFQDNEnrollment("drop.com"))).toEqual([1]);
+    await db.applyDelta(
+      [fakeLeaf("new.com", [2])],
+      [fakeLeaf("drop.com", [])[0]],
+      { blockTime: 200, height: 2 },
+    );
+
+    expect(Array.from(await db.getFQDNEnrollment("new.com"))).toEqual([2]);
+    expect((await db.getFQDNEnrollment("drop.com")).length).toBe(0);
+  });
+
+  it("getFQDNEnrollment does not load an index while a delta is written", async () => {
+    await db.updateList([fakeLeaf("example.com", [1])], { blockTime: 100 });
+    const restarted = new WebcatDatabase();
+    const local = (globalThis as any).browser.storage.local;
+    const set = local.set.getMockImplementation();
+    let release!: () => void;
+    const written = new Promise<void>((resolve) => (release = resolve));
+    local.set.mockImplementationOnce(async (items: Record<string, any>) => {
+      await written;
+      return set(items);
+    });
+
+    const delta = restarted.applyDelta([fakeLeaf("new.com", [2])], [], {
+      blockTime: 200,
+      height: 2,
+    });
+    // Loads the index from the list as it was before the delta
+    expect((await restarted.getFQDNEnrollment("other.org")).length).toBe(0);
+    release();
+    await delta;
+
+    expect(Array.from(await restarted.getFQDNEnrollment("new.com"))).toEqual([
+      2,
+    ]);
+  });
+
+  it("keeps verified manifests until max_age or the next list", async () => {
+    const record = { signatures: "ab", verifiedAt: Date.now(), maxAge: 60 };
+    await db.setVerifiedManifest("e:m", record);
+    await db.setVerifiedManifest("e:old", {
+      ...record,
+      verifiedAt: Date.now() - 61_000,
+    });
+
+    expect(await db.getVerifiedManifest("e:m")).toEqual(record);
+    expect(await db.getVerifiedManifest("e:old")).toBeNull();
+    expect(await db.getVerifiedManifest("e:other")).toBeNull();
+
+    await db.updateList([fakeLeaf("example.com", [1])], { blockTime: 100 });
+    expect(await db.getVerifiedManifest("e:m")).toBeNull();
+  });
+
+  it("applyDelta prunes expired manifests and those of changed hosts", async () => {
+    await db.updateList(
+      [fakeLeaf("changed.com", [1]), fakeLeaf("kept.com", [2])],
+      { blockTime: 100, height: 1 },
+    );
+    const record = { signatures: "ab", verifiedAt: Date.now(), maxAge: 60 };
+    await db.setVerifiedManifest("01:m", record);
+    await db.setVerifiedManifest("02:m", record);
+    await db.setVerifiedManifest("02:old", {
+      ...record,
+      verifiedAt: Date.now() - 61_000,
+    });
+    await db.applyDelta([fakeLeaf("changed.com", [3])], [], {
+      blockTime: 200,
+      height: 2,
+    });
+
+    expect(await db.verifiedManifests.getKeys()).toEqual(["02:m"]);
+  });
+
   it("getFQDNEnrollment returns empty Uint8Array for unknown fqdn", async () => {
     const result = await db.getFQDNEnrollment("nope.org");
     expect(result).toBeInstanceOf(Uint8Array);
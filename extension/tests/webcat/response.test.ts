@@ -64,6 +64,8 @@ vi.mock("../../src/webcat/db", () => {
         getLastChecked: vi.fn(async () => Date.now()),
 
         updateList: vi.fn(),
+        getVerifiedManifest: vi.fn(async () => null),
+        setVerifiedManifest: vi.fn(),
         getBlockMeta: vi.fn(async () => ({
           blockTime: 1337,
           rootHash: "deadbeef",
@@ -577,6 +579,31 @@ describe("OriginStateVerifiedEnrollment.verifyManifest", () => {
       WebcatErrorCode.Manifest.EXPIRED,
     );
   });
+
+  it("reuses a manifest verified before with the same signatures", async () => {
+    const sigsum = await import("@freedomofpress/sigsum/dist/verify");
+    const verify = sigsum.verifyMessageWithCompiledPolicy as Mock;
+
+    await verifiedEnrollment.verifyManifest(db, manifest, signatures);
+    const [key, record] = (db.setVerifiedManifest as Mock).mock.calls[0];
+    expect(record).toMatchObject({ maxAge: enrollment.max_age });
+
+    verify.mockClear();
+    (db.getVerifiedManifest as Mock).mockImplementation(async (k: string) =>
+      k === key ? record : null,
+    );
+    const res = await verifiedEnrollment.verifyManifest(
+      db,
+      manifest,
+      signatures,
+    );
+    expect(res).toBeInstanceOf(OriginStateVerifiedManifest);
+    expect(verify).not.toHaveBeenCalled();
+
+    const other = { ...signatures, [SIGNER3]: "signature3" };
+    await verifiedEnrollment.verifyManifest(db, manifest, other);
+    expect(verify).toHaveBeenCalled();
+  });
 });
 
 //
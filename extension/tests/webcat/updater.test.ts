@@ -30,6 +30,7 @@ vi.mock("@freedomofpress/ics23/dist/webcat", () => ({
 vi.mock("../../src/webcat/encoding", () => ({
   hexToUint8Array: vi.fn(() => new Uint8Array([1, 2, 3])),
   Uint8ArrayToBase64: vi.fn(() => "AQID"),
+  Uint8ArrayToHex: vi.fn(() => "010203"),
   stringToUint8Array: vi.fn((s: string) => new TextEncoder().encode(s)),
   Uint8ArrayToBase64Url: vi.fn(() => "AQID"),
 }));
@@ -60,13 +61,20 @@ function createMockDb() {
     setLastUpdated: vi.fn(),
     getLastUpdated: vi.fn(),
     getBlockMeta: vi.fn(),
+    setBlockMeta: vi.fn(),
     updateList: vi.fn(),
+    applyDelta: vi.fn(),
+    listLeaves: vi.fn(() => []),
   };
 }
 
 // Create a mock fetch that returns valid block and leaves responses
 function setupFetchMock() {
-  const blockJson = { height: "100", commit: {} };
+  const blockJson = {
+    height: "100",
+    signed_header: { header: { height: "8" } },
+    commit: {},
+  };
   const leavesJson = {
     proof: {
       app_hash: "010203",
@@ -74,17 +82,40 @@ function setupFetchMock() {
     },
     leaves: [],
   };
+  const deltaJson = {
+    since: 7,
+    height: 8,
+    changed: [["canonical/.com.example", "0a01ff"]],
+    removed: ["canonical/.org.example"],
+    proof: leavesJson.proof,
+  };
+  const responses = {
+    deltaAvailable: true,
+    deltaBroken: false,
+    blockStatus: 200,
+  };
 
   globalThis.fetch = vi.fn((url: string) => {
-    const body = (url as string).includes("block.json")
-      ? blockJson
-      : leavesJson;
+    const isBlock = (url as string).includes("block.json");
+    const isDelta = (url as string).includes("list-delta.json");
+    const body = isBlock ? blockJson : isDelta ? deltaJson : leavesJson;
+    const status = isBlock
+      ? responses.blockStatus
+      : isDelta && !responses.deltaAvailable
+        ? 404
+        : 200;
     return Promise.resolve({
-      json: () => Promise.resolve(body),
+      ok: status === 200,
+      status,
+      headers: new Headers(isBlock ? { ETag: '"b8"' } : {}),
+      json: () =>
+        isDelta && responses.deltaBroken
+          ? Promise.reject(new SyntaxError("Unexpected end of JSON input"))
+          : Promise.resolve(body),
     } as Response);
   });
 
-  return { blockJson, leavesJson };
+  return { blockJson, leavesJson, deltaJson, responses };
 }
 
 describe("isDue", () => {
@@ -228,15 +259,159 @@ describe("update", () => {
     expect(db.updateList).toHaveBeenCalledWith([["example.com", "abc123"]], {
       blockTime: 1000,
       rootHash: "aabbcc",
+      height: 8,
+      appHash: "010203",
+      blockETag: '"b8"',
     });
   });
 
+  it("sends the stored block ETag and skips when not modified", async () => {
+    setupFetchMock().responses.blockStatus = 304;
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, blockETag: '"b7"' });
+
+    await updater.update();
+
+    expect(fetch).toHaveBeenCalledTimes(1);
+    expect(fetch).toHaveBeenCalledWith(
+      "https://example.com/block.json",
+      expect.objectContaining({ headers: { "If-None-Match": '"b7"' } }),
+    );
+    expect(db.updateList).not.toHaveBeenCalled();
+  });
+
+  it("does not send an ETag for bundled updates", async () => {
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, blockETag: '"b7"' });
+
+    await updater.update(true);
+
+    expect(fetch).toHaveBeenCalledWith(
+      "moz-extension://test-id/data/block.json",
+      expect.objectContaining({ headers: {} }),
+    );
+  });
+
+  it("skips the list download when the app hash is unchanged", async () => {
+    db.getBlockMeta.mockResolvedValue({
+      blockTime: 900,
+      rootHash: "aabbcc",
+      height: 7,
+      appHash: "010203",
+    });
+
+    await updater.update();
+
+    expect(fetch).toHaveBeenCalledTimes(1);
+    expect(db.updateList).not.toHaveBeenCalled();
+    expect(db.setBlockMeta).toHaveBeenCalledWith({
+      blockTime: 1000,
+      rootHash: "aabbcc",
+      height: 8,
+      appHash: "010203",
+      blockETag: '"b8"',
+    });
+    expect(db.setLastUpdated).toHaveBeenCalled();
+  });
+
+  it("applies a delta when the stored list has a height", async () => {
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(fetch).toHaveBeenCalledWith(
+      "https://example.com/list-delta.json?since=7",
+      expect.any(Object),
+    );
+    expect(fetch).not.toHaveBeenCalledWith(
+      "https://example.com/list.json",
+      expect.any(Object),
+    );
+    expect(db.applyDelta).toHaveBeenCalledWith(
+      [["canonical/.com.example", "0a01ff"]],
+      ["canonical/.org.example"],
+      {
+        blockTime: 1000,
+        rootHash: "aabbcc",
+        height: 8,
+        appHash: "010203",
+        blockETag: '"b8"',
+      },
+    );
+    expect(db.updateList).not.toHaveBeenCalled();
+    expect(db.setLastUpdated).toHaveBeenCalled();
+  });
+
+  it("falls back to the full list when no delta is available", async () => {
+    setupFetchMock().responses.deltaAvailable = false;
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(fetch).toHaveBeenCalledWith(
+      "https://example.com/list.json",
+      expect.any(Object),
+    );
+    expect(db.applyDelta).not.toHaveBeenCalled();
+    expect(db.updateList).toHaveBeenCalled();
+  });
+
+  it("falls back to the full list when the delta does not verify", async () => {
+    const { verifyWebcatProof } =
+      await import("@freedomofpress/ics23/dist/webcat");
+    (verifyWebcatProof as ReturnType<typeof vi.fn>).mockResolvedValueOnce(
+      false,
+    );
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(db.applyDelta).not.toHaveBeenCalled();
+    expect(db.updateList).toHaveBeenCalled();
+  });
+
+  it("falls back to the full list when the delta is for another app hash", async () => {
+    const { arraysEqual } = await import("../../src/webcat/utils");
+    (arraysEqual as ReturnType<typeof vi.fn>).mockReturnValueOnce(false);
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(db.applyDelta).not.toHaveBeenCalled();
+    expect(db.updateList).toHaveBeenCalled();
+  });
+
+  it("falls back to the full list when the delta is broken", async () => {
+    setupFetchMock().responses.deltaBroken = true;
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(db.applyDelta).not.toHaveBeenCalled();
+    expect(db.updateList).toHaveBeenCalled();
+  });
+
+  it("falls back to the full list when fetching the delta fails", async () => {
+    const respond = globalThis.fetch as ReturnType<typeof vi.fn>;
+    const impl = respond.getMockImplementation()!;
+    respond.mockImplementation((url: string) =>
+      url.includes("list-delta.json")
+        ? Promise.reject(new DOMException("aborted", "AbortError"))
+        : impl(url),
+    );
+    db.getBlockMeta.mockResolvedValue({ blockTime: 900, height: 7 });
+
+    await updater.update();
+
+    expect(db.applyDelta).not.toHaveBeenCalled();
+    expect(db.updateList).toHaveBeenCalled();
+  });
+
   it("skips update when block is already applied", async () => {
     // Block time from verifyCommit mock returns 1000n
     db.getBlockMeta.mockResolvedValue({ blockTime: 1000 });
 
     await updater.update();
 
+    expect(fetch).toHaveBeenCalledTimes(1);
     expect(db.updateList).not.toHaveBeenCalled();
   });
 
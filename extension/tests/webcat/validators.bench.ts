@@ -0,0 +1,65 @@
+import { bench, describe } from "vitest";
+
+import { LRUCache } from "../../src/webcat/cache";
+import { Database } from "../../src/webcat/interfaces/database";
+import { validateCSP } from "../../src/webcat/validators";
+
+// The policies real apps ship with
+const configs = import.meta.glob<{
+  default_csp: string;
+  extra_csp: Record<string, string>;
+}>("../../../apps/*/webcat.config.json", { eager: true, import: "default" });
+
+const cachePartition = { firstParty: "https://example.com", incognito: false };
+
+// Every host in a policy counts as enrolled, as it must for the app to load
+function database(): Database {
+  return {
+    getFQDNEnrollment: async () => new Uint8Array([0]),
+    cspVerdicts: new LRUCache(1024),
+  } as unknown as Database;
+}
+
+async function validateAll(
+  db: Database,
+  policies: string[],
+  manifest_digest?: string,
+) {
+  const valid_sources = new Set<string>();
+  for (const csp of policies) {
+    // A rejected policy costs its validation all the same
+    await validateCSP(
+      db,
+      csp,
+      valid_sources,
+      cachePartition,
+      manifest_digest,
+    ).catch(() => {});
+  }
+}
+
+for (const [path, config] of Object.entries(configs)) {
+  const app = path.split("/").at(-2);
+  const policies = [
+    config.default_csp,
+    ...Object.values(config.extra_csp ?? {}),
+  ];
+
+  describe(`validateCSP, ${app} (${policies.length} policies)`, () => {
+    const db = database();
+
+    bench("uncached", async () => {
+      await validateAll(db, policies);
+    });
+
+    bench("memoized", async () => {
+      await validateAll(db, policies, "manifest");
+    });
+
+    // As after a list update, which clears the verdicts
+    bench("memoized, cleared", async () => {
+      db.cspVerdicts.clear();
+      await validateAll(db, policies, "manifest");
+    });
+  });
+}
@@ -1,6 +1,7 @@
 // validateCSP.test.ts
 import { beforeEach, describe, expect, it, vi } from "vitest";
 
+import { LRUCache } from "../../src/webcat/cache";
 import { WebcatDatabase } from "../../src/webcat/db";
 import { validateCSP } from "../../src/webcat/validators";
 
@@ -421,3 +422,62 @@ describe("validateCSP", () => {
     ).rejects.toThrow("CSP contains a comma");
   });
 });
+
+describe("validateCSP memoization", () => {
+  const cachePartition = {
+    firstParty: "https://example.com",
+    incognito: false,
+  };
+  const csp = (frame_src: string) =>
+    [
+      "default-src 'self'",
+      "script-src 'self'",
+      "style-src 'self'",
+      "object-src 'none'",
+      `frame-src ${frame_src}`,
+      "worker-src 'self'",
+    ].join("; ");
+  let db: WebcatDatabase;
+
+  beforeEach(() => {
+    db = {
+      getFQDNEnrollment: vi.fn(async (fqdn: string) =>
+        fqdn === "trusted.com" ? new Uint8Array([0, 1]) : new Uint8Array(),
+      ),
+      cspVerdicts: new LRUCache(16),
+    } as unknown as WebcatDatabase;
+  });
+
+  it("should reuse the allowed sources of a policy", async () => {
+    await validateCSP(db, csp("trusted.com"), new Set(), cachePartition, "m");
+    const valid_sources = new Set<string>();
+    await validateCSP(
+      db,
+      csp("trusted.com"),
+      valid_sources,
+      cachePartition,
+      "m",
+    );
+    expect(valid_sources).toEqual(new Set(["trusted.com"]));
+    expect(db.getFQDNEnrollment).toHaveBeenCalledTimes(1);
+  });
+
+  it("should reuse the rejection of a policy", async () => {
+    const message =
+      "frame-src value evil.com, parsed as FQDN: evil.com is not enrolled and thus not allowed.";
+    for (let i = 0; i < 2; i++) {
+      await expect(
+        validateCSP(db, csp("evil.com"), new Set(), cachePartition, "m"),
+      ).rejects.toThrow(message);
+    }
+    expect(db.getFQDNEnrollment).toHaveBeenCalledTimes(1);
+  });
+
+  it("should validate again for another manifest or once cleared", async () => {
+    await validateCSP(db, csp("trusted.com"), new Set(), cachePartition, "m");
+    await validateCSP(db, csp("trusted.com"), new Set(), cachePartition, "n");
+    db.cspVerdicts.clear();
+    await validateCSP(db, csp("trusted.com"), new Set(), cachePartition, "m");
+    expect(db.getFQDNEnrollment).toHaveBeenCalledTimes(3);
+  });
+});
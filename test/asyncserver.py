@@ -0,0 +1,285 @@
+import asyncio
+import email.utils
+import os
+import ssl
+import threading
+from http import HTTPStatus
+from time import time
+from urllib.parse import urlsplit
+
+from helpers import FileCache, Hook, Server
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+# Read size for files served from disk, and the largest DATA payload we queue
+# before waiting for the socket to drain
+CHUNK_SIZE = 64 * 1024
+
+# Connection-specific headers are not allowed in HTTP/2 responses
+HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding", "upgrade", "proxy-connection"}
+
+async def iter_body(body):
+    """Yield the chunks of a response body: bytes, an iterable of bytes, an
+    async iterable of bytes or a Hook, paced by its chunk_delay."""
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        if body:
+            yield bytes(body)
+    elif isinstance(body, FileCache.Entry):
+        async for chunk in read_file(body.path):
+            yield chunk
+    elif isinstance(body, Hook):
+        if isinstance(body.data, os.PathLike):
+            chunks = read_file(body.data, body.chunk_size)
+        else:
+            chunks = iter_body(body.chunks())
+        async for chunk in chunks:
+            yield chunk
+            if body.chunk_delay:
+                await asyncio.sleep(body.chunk_delay)
+    elif hasattr(body, "__aiter__"):
+        async for chunk in body:
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+            await asyncio.sleep(0)
+
+async def read_file(path, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+
+class AsyncServer(Server):
+    """Drop-in replacement for Server running on an asyncio loop in a
+    background thread. It serves the same root/headers/hooks with keep-alive,
+    HTTP/2 over TLS when the h2 package is installed, streamed hook bodies,
+    and hook delays that don't hold up
+    other requests."""
+
+    def __init__(self, *args, http2=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.chunk_size:
+            raise ValueError("chunk_size is only supported by the threaded Server")
+        if self.network:
+            raise ValueError("network is only supported by the threaded Server")
+        self.http2 = http2 and h2 is not None and bool(self.ssl_cert and self.ssl_key)
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._connections = set()
+        self.thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._listen(), self._loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.thread.join()
+        self._loop.close()
+
+    async def _listen(self):
+        context = None
+        if self.ssl_cert and self.ssl_key:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.ssl_cert, self.ssl_key)
+            context.set_alpn_protocols(["h2", "http/1.1"] if self.http2 else ["http/1.1"])
+        self._server = await asyncio.start_server(
+            self._connection, "127.0.0.1", self.port, ssl=context, backlog=1024, reuse_address=True,
+        )
+
+    async def _shutdown(self):
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            ssl_object = writer.get_extra_info("ssl_object")
+            if ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2":
+                await self._serve_h2(reader, writer)
+            else:
+                await self._serve_h1(reader, writer)
+        except (ConnectionError, ssl.SSLError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Server stopping; returning normally keeps asyncio from logging
+            # the cancelled connection task
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _respond(self, method, target, request_headers):
+        """Return (status, headers, body) for a request, honouring hooks the
+        same way Server's handler does."""
+        path = urlsplit(target).path
+        if method not in ("GET", "HEAD"):
+            return HTTPStatus.NOT_IMPLEMENTED, {"Content-Type": "text/plain"} | self.headers, b"Not Implemented"
+        if path in self.hooks:
+            hook = self.hooks[path]
+            if type(hook) is bytes:
+                return HTTPStatus.OK, {"Content-Type": "text/plain"} | self.headers, hook
+            if hook.delay is not None:
+                await asyncio.sleep(hook.delay)
+            headers = {"Content-Type": hook.type} | self.headers
+            if isinstance(hook.data, bytes) and not hook.chunk_delay:
+                return hook.status, headers | hook.headers, hook.data
+            # Streamed; the length is sent when known up front
+            if hook.length is not None:
+                headers["Content-Length"] = str(hook.length)
+            return hook.status, headers | hook.headers, hook
+        return self._file_response(target, request_headers)
+
+    def _file_response(self, target, request_headers):
+        url = urlsplit(target)
+        entry = self.files.get(url.path)
+        if entry is None:
+            if url.path + "/" in self.files.directories:
+                location = url.path + "/" + (f"?{url.query}" if url.query else "")
+                return HTTPStatus.MOVED_PERMANENTLY, {"Location": location} | self.headers, b""
+            return HTTPStatus.NOT_FOUND, {"Content-Type": "text/plain"} | self.headers, b"File not found"
+        if entry.not_modified(request_headers):
+            self.revalidated[url.path] = self.revalidated.get(url.path, 0) + 1
+            return HTTPStatus.NOT_MODIFIED, {"ETag": entry.etag} | self.headers, b""
+        return HTTPStatus.OK, self.headers | entry.headers, entry.data if entry.data is not None else entry
+
+    async def _serve_h1(self, reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            request_line, *lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = request_line.split(" ")
+            except ValueError:
+                return
+            request_headers = {}
+            for line in lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    request_headers[name.strip().lower()] = value.strip()
+            if length := int(request_headers.get("content-length") or 0):
+                await reader.readexactly(length)
+            connection = request_headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+
+            start = time()
+            status, headers, body = await self._respond(method, target, request_headers)
+            status = HTTPStatus(status)
+            sized = isinstance(body, (bytes, bytearray, memoryview))
+            if sized:
+                headers.setdefault("Content-Length", str(len(body)))
+            no_body = method == "HEAD" or status in (HTTPStatus.NOT_MODIFIED, HTTPStatus.NO_CONTENT)
+            chunked = not sized and "Content-Length" not in headers and not no_body
+            response = [
+                f"HTTP/1.1 {status.value} {status.phrase}",
+                f"Server: {self.__class__.__name__}",
+                f"Date: {email.utils.formatdate(usegmt=True)}",
+                *(f"{k}: {v}" for k, v in headers.items()),
+                "Connection: keep-alive" if keep_alive else "Connection: close",
+            ]
+            if chunked:
+                response.append("Transfer-Encoding: chunked")
+            writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+            if no_body:
+                pass
+            elif isinstance(body, FileCache.Entry):
+                # Large files from the cache; falls back to read/write over TLS
+                await writer.drain()
+                with open(body.path, "rb") as f:
+                    await asyncio.get_running_loop().sendfile(writer.transport, f)
+            else:
+                async for chunk in iter_body(body):
+                    if chunked:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    else:
+                        writer.write(chunk)
+                    await writer.drain()
+                if chunked:
+                    writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            self._served(urlsplit(target).path, target, start)
+            if not keep_alive:
+                return
+
+    async def _serve_h2(self, reader, writer):
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        # Streams blocked on flow control wait here for WINDOW_UPDATEs
+        window = asyncio.Condition()
+        streams = set()
+        try:
+            while data := await reader.read(CHUNK_SIZE):
+                try:
+                    events = conn.receive_data(data)
+                except h2.exceptions.ProtocolError:
+                    writer.write(conn.data_to_send())
+                    return
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        stream = asyncio.create_task(
+                            self._h2_stream(conn, writer, window, event.stream_id, dict(event.headers))
+                        )
+                        streams.add(stream)
+                        stream.add_done_callback(streams.discard)
+                    elif isinstance(event, h2.events.DataReceived):
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged,
+                                            h2.events.StreamReset)):
+                        async with window:
+                            window.notify_all()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                writer.write(conn.data_to_send())
+                await writer.drain()
+        finally:
+            for stream in streams:
+                stream.cancel()
+
+    async def _h2_stream(self, conn, writer, window, stream_id, request_headers):
+        method, target = request_headers[":method"], request_headers[":path"]
+        start = time()
+        status, headers, body = await self._respond(method, target, request_headers)
+        sized = isinstance(body, (bytes, bytearray, memoryview))
+        response = [(":status", str(int(status))), ("server", self.__class__.__name__),
+                    ("date", email.utils.formatdate(usegmt=True))]
+        response += [(k.lower(), str(v)) for k, v in headers.items() if k.lower() not in HOP_BY_HOP]
+        if sized and "content-length" not in dict(response):
+            response.append(("content-length", str(len(body))))
+        no_body = method == "HEAD" or int(status) in (HTTPStatus.NOT_MODIFIED, HTTPStatus.NO_CONTENT)
+        try:
+            conn.send_headers(stream_id, response, end_stream=no_body)
+            writer.write(conn.data_to_send())
+            if not no_body:
+                async for chunk in iter_body(body):
+                    while chunk:
+                        size = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size, len(chunk))
+                        if size <= 0:
+                            async with window:
+                                await window.wait()
+                            continue
+                        conn.send_data(stream_id, chunk[:size])
+                        chunk = chunk[size:]
+                        writer.write(conn.data_to_send())
+                        await writer.drain()
+                conn.end_stream(stream_id)
+                writer.write(conn.data_to_send())
+                await writer.drain()
+        except h2.exceptions.H2Error:
+            # The browser reset the stream, e.g. after navigating away
+            return
+        self._served(urlsplit(target).path, target, start)
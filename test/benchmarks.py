@@ -1,8 +1,12 @@
 import json
 import pytest
 
-from time import sleep
-from helpers import Browser, Server
+from pathlib import Path
+
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from helpers import KEEP_EXTENSION_DATA, Browser, Hook, RandomBody, Server
+from synthetic import DEFAULT_CSP
 from tests import EXPECTED_CSP
 
 js_code = """
@@ -22,18 +26,96 @@ js_code = """
     })();
 """
 
+resources_js = """
+    JSON.stringify({
+        timeOrigin: performance.timeOrigin,
+        resources: performance.getEntriesByType('resource').map((e) => e.toJSON()),
+    });
+"""
+
+def resource_type(entry):
+    """The kind of WEBCAT-verified load a resource timing entry is, or None
+    for anything else."""
+    path = urlsplit(entry["name"]).path
+    if path.endswith(".wasm"):
+        return "wasm"
+    if path.endswith(".css"):
+        return "css"
+    if path.endswith(".js"):
+        # Firefox reports worker scripts with initiatorType "other"
+        if "/workers/" in path or entry["initiatorType"] not in ("script", "link"):
+            return "worker"
+        return "script"
+    return None
+
+def resource_breakdown(page, server_timings):
+    """Join a page's resource timing with the server's record of each
+    request. The time from requestStart to responseEnd that the server does
+    not account for is mostly filterResponseData buffering the response
+    until it's verified. Loads served from the browser cache have no server
+    time."""
+    origin = page["timeOrigin"] / 1000
+    unmatched = list(server_timings)
+    resources = []
+    for entry in page["resources"]:
+        kind = resource_type(entry)
+        if kind is None:
+            continue
+        url = urlsplit(entry["name"])
+        target = url.path + (f"?{url.query}" if url.query else "")
+        request_start = entry["requestStart"] or entry["fetchStart"]
+        record = None
+        if entry["transferSize"] > 0:
+            # The server's request closest in time to the browser's
+            requested = origin + request_start / 1000
+            record = min((t for t in unmatched if t["target"] == target),
+                         key=lambda t: abs(t["start"] - requested), default=None)
+        if record is not None:
+            unmatched.remove(record)
+        browser_ms = entry["responseEnd"] - request_start
+        server_ms = (record["end"] - record["start"]) * 1000 if record else None
+        resources.append({
+            "name": target,
+            "type": kind,
+            "initiator": entry["initiatorType"],
+            "transfer_size": entry["transferSize"],
+            "browser_ms": browser_ms,
+            "server_ms": server_ms,
+            "overhead_ms": browser_ms - server_ms if record else None,
+        })
+    by_type = {}
+    for resource in resources:
+        totals = by_type.setdefault(resource["type"], {
+            "count": 0, "server_count": 0, "browser_ms": 0, "server_ms": 0, "overhead_ms": 0,
+        })
+        totals["count"] += 1
+        totals["browser_ms"] += resource["browser_ms"]
+        if resource["server_ms"] is not None:
+            totals["server_count"] += 1
+            totals["server_ms"] += resource["server_ms"]
+            totals["overhead_ms"] += resource["overhead_ms"]
+    for totals in by_type.values():
+        totals["mean_overhead_ms"] = totals["overhead_ms"] / totals["server_count"] if totals["server_count"] else None
+    return resources, by_type
+
 @pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
 @pytest.mark.parametrize("warm", [(False), (True)], ids=["cold", "warm"])
 @pytest.mark.parametrize("addon_installed, enrolled", [(True, True), (True, False), (False, True)], ids=["enrolled", "not_enrolled", "no_extension"])
-def test_benchmark(root, update_server, warm, addon_installed, enrolled, addon_path, request, benchmark):
+def test_benchmark(root, update_server, network, warm, addon_installed, enrolled, addon_path, slot, request, benchmark):
+    breakdowns = []
+
     def setup():
-        server = Server(root=root, headers=EXPECTED_CSP)
+        server = Server(root=root, headers=EXPECTED_CSP, port=slot.http_port, network=network)
         server.start()
         browser = Browser()
-        browser.start(request.config.getoption("--headless"))
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
         if addon_installed:
             browser.install_extension(addon_path)
-            sleep(7)
+            # The console is only attached to wait for the list; RDP
+            # traffic would otherwise end up in the samples
+            browser.attach_extension_console()
+            browser.wait_for_list()
+            browser.detach_extension_console()
         return (), {'browser': browser, 'server': server}
 
     def teardown(browser, server):
@@ -44,15 +126,301 @@ def test_benchmark(root, update_server, warm, addon_installed, enrolled, addon_p
         url = server.url()
         if not enrolled:
             url = url.replace("127.0.0.1", "localhost")
-        browser.navigate(url)
-        sleep(2)
+        browser.navigate(url, wait=True)
         if warm:
-            browser.navigate(url)
-            sleep(2)
+            browser.navigate(url, wait=True)
         result_raw = browser.execute(js_code)
         result = json.loads(result_raw)
+        breakdowns.append(resource_breakdown(json.loads(browser.execute(resources_js)), server.timings))
         return result['startTime']/1000, result['loadEventEnd']/1000, result['webcat_executed']
 
     benchmark.group = "warm" if warm else "cold"
-    result = benchmark.pedantic(run, setup=setup, teardown=teardown, rounds=request.config.getoption("--iterations"))
+    result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    # Per measured round; compare the groups to see where WEBCAT's overhead goes
+    breakdowns = breakdowns[benchmark.extra_info.get("warmup_rounds", 0):]
+    benchmark.extra_info["resources"] = [resources for resources, _ in breakdowns]
+    benchmark.extra_info["overhead_by_type"] = [by_type for _, by_type in breakdowns]
     assert result == (addon_installed and enrolled)
+
+# First load of an enrolled app by a freshly installed extension, against one
+# whose storage survived a browser restart with a verified manifest of the
+# app in it: both fetch the bundle, only the former verifies its signatures.
+# The console stays attached in both, to tell which one happened
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("restarted", [False, True], ids=["cold_install", "cold_restart"])
+def test_restart(root, update_server, network, restarted, addon_path, slot, request, benchmark):
+    reused = []
+
+    def setup():
+        server = Server(root=root, headers=EXPECTED_CSP, port=slot.http_port, network=network)
+        server.start()
+        browser = Browser(additional_configs=KEEP_EXTENSION_DATA)
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        browser.install_extension(addon_path)
+        browser.attach_extension_console()
+        browser.wait_for_list()
+        if restarted:
+            browser.navigate(server.url(), wait=True)
+            browser.wait_until("origin_verified")
+            browser.restart()
+            browser.install_extension(addon_path)
+            browser.attach_extension_console()
+            # The stored list is current: the update server answers 304
+            browser.wait_until("update_skipped", timeout=60, where=lambda e: e["reason"] == "not_modified")
+        return (), {'browser': browser, 'server': server}
+
+    def teardown(browser, server):
+        browser.destroy()
+        server.stop()
+
+    def run(_, browser, server):
+        browser.navigate(server.url(), wait=True)
+        browser.wait_until("origin_verified")
+        reused.append(bool(browser.extension_events("manifest_reused")))
+        result = json.loads(browser.execute(js_code))
+        return result['startTime']/1000, result['loadEventEnd']/1000, result['webcat_executed']
+
+    benchmark.group = "restart"
+    result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    reused = reused[benchmark.extra_info.get("warmup_rounds", 0):]
+    benchmark.extra_info["manifest_reused"] = reused
+    assert result
+    assert reused == [restarted] * len(reused)
+
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("synthetic_leaves", [10_000, 100_000, 1_000_000], ids=["10k", "100k", "1M"])
+def test_list_ingestion(root, update_server, synthetic_leaves, addon_path, slot, request, benchmark):
+    update_server.synthesize(synthetic_leaves)
+    applied = []
+
+    def setup():
+        browser = Browser()
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        return (), {'browser': browser}
+
+    def teardown(browser):
+        browser.destroy()
+
+    def run(_, browser):
+        baseline = peak = browser.rss()
+        browser.install_extension(addon_path)
+        browser.attach_extension_console()
+        deadline = monotonic() + 300
+        while not (events := [e for e in browser.extension_events("list_applied") if not e["local"]]):
+            if monotonic() > deadline:
+                raise RuntimeError("list was not applied within 300s")
+            peak = max(peak, browser.rss())
+            sleep(0.05)
+        applied.append(events[0] | {"peak_rss_delta": peak - baseline})
+        # Timed by the extension: fetch, proof verification and updateList
+        return 0, events[0]["total_ms"]/1000, events[0]["leaves"]
+
+    benchmark.group = "list_ingestion"
+    result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    applied = applied[benchmark.extra_info.get("warmup_rounds", 0):]
+    for key in ("fetch_ms", "verify_ms", "ingest_ms", "peak_rss_delta"):
+        benchmark.extra_info[key] = [a[key] for a in applied]
+    assert result == update_server.leaf_count()
+
+# Cold loads of apps that differ only in how many files their manifest lists:
+# the page loads the same few scripts and stylesheets every time
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("synthetic_app", [10, 100, 1_000, 10_000, 100_000], ids=["10", "100", "1k", "10k", "100k"], indirect=True)
+def test_manifest_scaling(root, update_server, network, synthetic_app, addon_path, slot, request, benchmark):
+    with open(f"{synthetic_app}/.well-known/webcat/bundle.json", "rb") as f:
+        bundle_bytes = len(f.read())
+    rss_deltas = []
+    # One server for every round: its file cache hashes the whole tree
+    server = Server(root=synthetic_app, headers={"content-security-policy": DEFAULT_CSP}, port=slot.http_port,
+                    network=network)
+
+    def setup():
+        browser = Browser()
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        browser.install_extension(addon_path)
+        browser.attach_extension_console()
+        browser.wait_for_list()
+        browser.detach_extension_console()
+        return (), {'browser': browser}
+
+    def teardown(browser):
+        browser.destroy()
+
+    def run(_, browser):
+        baseline = browser.process_memory().get("extension", 0)
+        browser.navigate(server.url(), wait=True)
+        # Mostly the verified manifest the extension now keeps for the origin
+        rss_deltas.append(browser.process_memory().get("extension", 0) - baseline)
+        result = json.loads(browser.execute(js_code))
+        return result['startTime']/1000, result['loadEventEnd']/1000, result['webcat_executed']
+
+    benchmark.group = "manifest_scaling"
+    server.start()
+    try:
+        result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    finally:
+        server.stop()
+    benchmark.extra_info["bundle_bytes"] = bundle_bytes
+    benchmark.extra_info["extension_rss_delta"] = rss_deltas[benchmark.extra_info.get("warmup_rounds", 0):]
+    assert result
+
+third_party_js = """
+    JSON.stringify({
+        timing: performance.getEntriesByType('navigation')[0].toJSON(),
+        loaded: Array.from(document.images).filter((img) => img.complete && img.naturalWidth > 0).length,
+    });
+"""
+
+def third_party_page(hosts, port):
+    """A page embedding one image from each of `hosts` new hosts; every call
+    uses other names, so that no round finds them in the extension's
+    negative cache."""
+    rounds = iter(range(1 << 30))
+
+    def page():
+        n = next(rounds)
+        images = "".join(f'<img src="http://r{n}-{i}.localhost:{port}/pixel.svg">' for i in range(hosts))
+        return [f"<!DOCTYPE html><html><body>{images}</body></html>".encode()]
+    return page
+
+# A non-enrolled page pulling in many third-party hosts, as ad-heavy pages
+# do. Every host is looked up once in the enrollment list, almost always to
+# find it isn't there
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("hosts", [10, 100, 500])
+@pytest.mark.parametrize("addon_installed", [True, False], ids=["extension", "no_extension"])
+def test_third_party_hosts(root, update_server, network, hosts, addon_installed, addon_path, slot, request, benchmark):
+    def setup():
+        server = Server(root=root, port=slot.http_port, network=network, hooks={
+            "/third-party.html": Hook(third_party_page(hosts, slot.http_port), type="text/html"),
+            "/pixel.svg": Hook(b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>',
+                               type="image/svg+xml"),
+        })
+        server.start()
+        browser = Browser()
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        if addon_installed:
+            browser.install_extension(addon_path)
+            browser.attach_extension_console()
+            browser.wait_for_list()
+            browser.detach_extension_console()
+        return (), {'browser': browser, 'server': server}
+
+    def teardown(browser, server):
+        browser.destroy()
+        server.stop()
+
+    def run(_, browser, server):
+        browser.navigate(f"{server.url('localhost')}/third-party.html", wait=True, timeout=120)
+        result = json.loads(browser.execute(third_party_js))
+        return result["timing"]["startTime"]/1000, result["timing"]["loadEventEnd"]/1000, result["loaded"]
+
+    benchmark.group = "third_party_hosts"
+    result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    benchmark.extra_info["hosts"] = hosts
+    assert result == hosts
+
+large_asset_js = """
+    JSON.stringify(performance.getEntriesByType('resource')
+        .find((e) => /\\/large\\.[a-z]+$/.test(e.name) && e.responseEnd > 0) || null);
+"""
+
+# One large asset streamed through a Hook. The extension holds the response
+# until it is verified, so the page sees its first byte only after the whole
+# body was hashed. The js cases load a script, which gets the end marker; the
+# fetch cases fetch() a .wasm file, which Firefox reports as an
+# xmlhttprequest: a pass-through type, verified without the marker because it
+# is in the manifest
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("large_asset_app", [
+    (32 << 20, "wasm"), (256 << 20, "wasm"), (1 << 30, "wasm"), (32 << 20, "js"), (256 << 20, "js"),
+], ids=["fetch-32M", "fetch-256M", "fetch-1G", "js-32M", "js-256M"], indirect=True)
+def test_large_asset(root, update_server, large_asset_app, addon_path, slot, request, benchmark):
+    size, ext = request.node.callspec.params["large_asset_app"]
+    if ext == "wasm":
+        # Generated on the fly: the same bytes synthetic.py wrote for seed 0
+        hook = Hook(RandomBody(size, seed=0), type="application/wasm")
+    else:
+        hook = Hook(Path(large_asset_app, f"large.{ext}"), type="text/javascript")
+    samples = []
+    # One server for every round, as in test_manifest_scaling
+    server = Server(root=large_asset_app, headers={"content-security-policy": DEFAULT_CSP},
+                    hooks={f"/large.{ext}": hook}, port=slot.http_port)
+
+    def setup():
+        browser = Browser()
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        browser.install_extension(addon_path)
+        browser.attach_extension_console()
+        browser.wait_for_list()
+        browser.detach_extension_console()
+        return (), {'browser': browser}
+
+    def teardown(browser):
+        browser.destroy()
+
+    def run(_, browser):
+        baseline = peak = browser.process_memory().get("extension", 0)
+        browser.navigate(server.url())
+        deadline = monotonic() + 300
+        while not (entry := json.loads(browser.execute(large_asset_js))):
+            if monotonic() > deadline:
+                raise RuntimeError(f"large.{ext} did not load within 300s")
+            peak = max(peak, browser.process_memory().get("extension", 0))
+            sleep(0.1)
+        samples.append({
+            "ttfb_ms": entry["responseStart"] - entry["requestStart"],
+            "peak_extension_rss_delta": peak - baseline,
+        })
+        return entry["requestStart"]/1000, entry["responseEnd"]/1000, entry["decodedBodySize"]
+
+    benchmark.group = "large_asset"
+    server.start()
+    try:
+        result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    finally:
+        server.stop()
+    samples = samples[benchmark.extra_info.get("warmup_rounds", 0):]
+    for key in ("ttfb_ms", "peak_extension_rss_delta"):
+        benchmark.extra_info[key] = [sample[key] for sample in samples]
+    assert result == size
+
+# The same 64 KiB script cut into chunks of 1 B, 512 B and 64 KiB on the
+# wire. The extension reports how many chunks its response filter actually
+# received; the slope of load time over that count is the per-chunk cost.
+# The console stays attached for that report, equally for every chunk size
+@pytest.mark.parametrize("root", [("cases/testapp")], indirect=True)
+@pytest.mark.parametrize("large_asset_app", [(64 << 10, "js")], ids=["js-64K"], indirect=True)
+@pytest.mark.parametrize("chunk_size", [1, 512, 64 << 10], ids=["1B", "512B", "64K"])
+def test_chunk_overhead(root, update_server, large_asset_app, chunk_size, addon_path, slot, request, benchmark):
+    chunks = []
+
+    def setup():
+        server = Server(root=large_asset_app, headers={"content-security-policy": DEFAULT_CSP},
+                        port=slot.http_port, chunk_size=chunk_size)
+        server.start()
+        browser = Browser()
+        browser.start(request.config.getoption("--headless"), port=slot.debugger_port)
+        browser.install_extension(addon_path)
+        browser.attach_extension_console()
+        browser.wait_for_list()
+        return (), {'browser': browser, 'server': server}
+
+    def teardown(browser, server):
+        browser.destroy()
+        server.stop()
+
+    def run(_, browser, server):
+        verified = len(browser.extension_events("file_verified"))
+        browser.navigate(server.url(), wait=True, timeout=120)
+        event = browser.wait_until("file_verified", timeout=120, since=verified,
+                                   where=lambda e: e["url"].endswith("/large.js"))
+        chunks.append(event["chunks"])
+        entry = json.loads(browser.execute(large_asset_js))
+        return entry["requestStart"]/1000, entry["responseEnd"]/1000, event["bytes"]
+
+    benchmark.group = "chunk_overhead"
+    result = benchmark.adaptive(run, setup=setup, teardown=teardown)
+    benchmark.extra_info["chunk_size"] = chunk_size
+    benchmark.extra_info["filter_chunks"] = chunks[benchmark.extra_info.get("warmup_rounds", 0):]
+    assert result == 64 << 10
@@ -0,0 +1,272 @@
+"""Benchmark results kept across commits in a SQLite database, with a
+regression check between two commits and an HTML trend report.
+
+Runs are recorded by passing `--benchmark-store PATH` to pytest. Then:
+
+    python benchstore.py compare PATH BASE HEAD
+    python benchstore.py report PATH -o report.html
+
+Samples of every run of a commit are pooled. A scenario regressed when a
+two-sided Mann-Whitney U test rejects equal distributions and the bootstrap
+confidence interval of the median ratio lies entirely above 1 + threshold.
+"""
+
+import argparse
+import html
+import json
+import math
+import platform
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+from time import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    commit_id TEXT NOT NULL,
+    dirty INTEGER NOT NULL,
+    created REAL NOT NULL,
+    machine TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    browser TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    samples TEXT NOT NULL,
+    extra_info TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (browser, grp, scenario);
+"""
+
+
+def current_commit(cwd=None):
+    """(commit, dirty) of the checkout the tests run from."""
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=cwd, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd,
+                            check=True, capture_output=True, text=True).stdout
+    return commit, bool(status.strip())
+
+
+class BenchmarkStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, commit, dirty, benchmarks):
+        """Store one run; benchmarks are pytest-benchmark Metadata.as_dict()
+        results with their data."""
+        with self.db:
+            run_id = self.db.execute(
+                "INSERT INTO runs (commit_id, dirty, created, machine) VALUES (?, ?, ?, ?)",
+                (commit, int(dirty), time(), f"{socket.gethostname()} {platform.machine()}"),
+            ).lastrowid
+            for bench in benchmarks:
+                params = bench.get("params") or {}
+                self.db.execute(
+                    "INSERT INTO results (run_id, browser, grp, scenario, samples, extra_info) VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, params.get("browser") or "firefox", bench.get("group") or "",
+                     bench["name"], json.dumps(bench["stats"]["data"]),
+                     json.dumps(bench.get("extra_info") or {}, default=str)),
+                )
+        return run_id
+
+    def resolve(self, ref):
+        """Full commit id of a stored commit, given a prefix."""
+        rows = self.db.execute("SELECT DISTINCT commit_id FROM runs WHERE commit_id LIKE ?",
+                               (f"{ref}%",)).fetchall()
+        if len(rows) != 1:
+            raise KeyError(f"{ref!r} matches {len(rows)} stored commits")
+        return rows[0][0]
+
+    def samples(self, commit):
+        """{(browser, group, scenario): pooled samples} of a commit."""
+        pooled = {}
+        for browser, grp, scenario, samples in self.db.execute(
+                "SELECT browser, grp, scenario, samples FROM results JOIN runs ON runs.id = run_id "
+                "WHERE commit_id = ? ORDER BY run_id", (commit,)):
+            pooled.setdefault((browser, grp, scenario), []).extend(json.loads(samples))
+        return pooled
+
+    def history(self):
+        """{(browser, group, scenario): [(commit, first run time, samples)]}
+        in the order commits were first benchmarked."""
+        series = {}
+        for commit, created, browser, grp, scenario, samples in self.db.execute(
+                "SELECT commit_id, MIN(created) OVER (PARTITION BY commit_id), browser, grp, scenario, samples "
+                "FROM results JOIN runs ON runs.id = run_id ORDER BY 2, run_id"):
+            points = series.setdefault((browser, grp, scenario), [])
+            if points and points[-1][0] == commit:
+                points[-1][2].extend(json.loads(samples))
+            else:
+                points.append((commit, created, json.loads(samples)))
+        return series
+
+
+def mann_whitney_u(a, b):
+    """Two-sided p-value of the Mann-Whitney U test, with the normal
+    approximation and tie correction; enough for the tens of rounds a
+    benchmark has."""
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return 1.0
+    pooled = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    ranks = [0.0] * len(pooled)
+    ties = 0.0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    r1 = sum(rank for rank, (_, sample) in zip(ranks, pooled) if sample == 0)
+    u = r1 - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(variance)
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def student_t_quantile(p, df):
+    """Quantile p of Student's t distribution with df degrees of freedom.
+    Exact for df 1 and 2, otherwise the Cornish-Fisher expansion around the
+    normal quantile, within 0.004 of the exact value at df 3 and 0.001 from
+    df 4 on."""
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = statistics.NormalDist().inv_cdf(p)
+    terms = [
+        (z ** 3 + z) / 4,
+        (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96,
+        (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384,
+        (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160,
+    ]
+    return z + sum(term / df ** (i + 1) for i, term in enumerate(terms))
+
+
+def bootstrap_ratio(base, head, confidence=0.95, resamples=2000, seed=0):
+    """Confidence interval of median(head) / median(base)."""
+    rng = random.Random(seed)
+    ratios = sorted(
+        statistics.median(rng.choices(head, k=len(head))) / statistics.median(rng.choices(base, k=len(base)))
+        for _ in range(resamples)
+    )
+    tail = (1 - confidence) / 2
+    return ratios[int(tail * resamples)], ratios[min(int((1 - tail) * resamples), resamples - 1)]
+
+
+def compare(store, base, head, alpha=0.05, threshold=0.0):
+    """Compare the scenarios two commits have in common. Returns rows of
+    (key, base median, head median, p-value, CI, verdict)."""
+    base_samples, head_samples = store.samples(base), store.samples(head)
+    rows = []
+    for key in sorted(base_samples.keys() & head_samples.keys()):
+        a, b = base_samples[key], head_samples[key]
+        if min(a) <= 0:
+            continue
+        p = mann_whitney_u(a, b)
+        low, high = bootstrap_ratio(a, b)
+        if p < alpha and low > 1 + threshold:
+            verdict = "REGRESSION"
+        elif p < alpha and high < 1 - threshold:
+            verdict = "improvement"
+        else:
+            verdict = ""
+        rows.append((key, statistics.median(a), statistics.median(b), p, (low, high), verdict))
+    return rows
+
+
+def _chart(points, width=640, height=160, pad=24):
+    """Inline SVG of the median and interquartile range per commit."""
+    stats = [statistics.quantiles(samples, n=4) if len(samples) > 1 else [samples[0]] * 3
+             for _, _, samples in points]
+    top = max(q[2] for q in stats) * 1.1 or 1
+    step = (width - 2 * pad) / max(len(points) - 1, 1)
+    x = lambda i: pad + i * step
+    y = lambda v: height - pad - v / top * (height - 2 * pad)
+    band = " ".join(f"{x(i):.1f},{y(q[2]):.1f}" for i, q in enumerate(stats))
+    band += " " + " ".join(f"{x(i):.1f},{y(q[0]):.1f}" for i, q in reversed(list(enumerate(stats))))
+    line = " ".join(f"{x(i):.1f},{y(q[1]):.1f}" for i, q in enumerate(stats))
+    dots = "".join(
+        f'<circle cx="{x(i):.1f}" cy="{y(q[1]):.1f}" r="3"><title>{html.escape(commit[:10])}: '
+        f'median {q[1] * 1000:.1f} ms, n={len(samples)}</title></circle>'
+        for i, ((commit, _, samples), q) in enumerate(zip(points, stats))
+    )
+    return (
+        f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">'
+        f'<polygon points="{band}" fill="#cde" stroke="none"/>'
+        f'<polyline points="{line}" fill="none" stroke="#246" stroke-width="2"/>{dots}'
+        f'<text x="2" y="{pad - 8}" font-size="11">{top * 1000:.0f} ms</text>'
+        f'<text x="2" y="{height - 8}" font-size="11">0</text></svg>'
+    )
+
+
+def report(store):
+    """HTML page with one trend chart per scenario."""
+    sections = []
+    for (browser, grp, scenario), points in sorted(store.history().items()):
+        commits = ", ".join(html.escape(commit[:10]) for commit, _, _ in points)
+        sections.append(
+            f"<h2>{html.escape(browser)} / {html.escape(grp)} / {html.escape(scenario)}</h2>"
+            f"{_chart(points)}<p><small>{commits}</small></p>"
+        )
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>webcat benchmark trends</title>"
+        "<style>body{font-family:sans-serif;margin:2em}h2{font-size:1em;margin-top:2em}</style></head>"
+        "<body><h1>webcat benchmark trends</h1><p>Median and interquartile range per commit.</p>"
+        + "".join(sections) + "</body></html>"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmp = commands.add_parser("compare", help="flag regressions of HEAD against BASE")
+    cmp.add_argument("db")
+    cmp.add_argument("base")
+    cmp.add_argument("head")
+    cmp.add_argument("--alpha", type=float, default=0.05, help="significance level of the rank-sum test")
+    cmp.add_argument("--threshold", type=float, default=0.0,
+                     help="relative slowdown to ignore, e.g. 0.02 for 2%%")
+    rep = commands.add_parser("report", help="write an HTML trend report")
+    rep.add_argument("db")
+    rep.add_argument("-o", "--output", default="benchmark-report.html")
+    args = parser.parse_args(argv)
+
+    store = BenchmarkStore(args.db)
+    try:
+        if args.command == "report":
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(report(store))
+            print(f"Wrote {args.output}")
+            return 0
+        base, head = store.resolve(args.base), store.resolve(args.head)
+        regressions = 0
+        for (browser, grp, scenario), a, b, p, (low, high), verdict in compare(
+                store, base, head, args.alpha, args.threshold):
+            regressions += verdict == "REGRESSION"
+            print(f"{browser:8} {grp:16} {scenario:60} {a * 1000:9.1f} -> {b * 1000:9.1f} ms "
+                  f"x{b / a:5.2f} [{low:.2f}, {high:.2f}] p={p:.3f} {verdict}")
+        return 1 if regressions else 0
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
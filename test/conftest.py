@@ -4,10 +4,16 @@ import pytest
 import json
 import canonicaljson
 import hashlib
+import statistics
+from time import monotonic
 
-from helpers import Browser, UpdateServer, Server, TorBrowser, generate_ssl_cert
+from asyncserver import AsyncServer
+from benchstore import BenchmarkStore, current_commit, student_t_quantile
+from helpers import NETWORK_PRESETS, Browser, BrowserPool, UpdateServer, Server, Slot, TorBrowser, generate_ssl_cert
 from sigsum import BundleGenerator
-from pytest_benchmark.fixture import BenchmarkFixture
+from sigsum_log import LocalSigsumLog
+from synthetic import cached_app, cached_large_asset_app
+from pytest_benchmark.fixture import BenchmarkFixture, FixtureAlreadyUsed
 
 _firefox_skips = {
     "corrupted_serviceworker_test-in_frame": "ServiceWorkers disabled in frames",
@@ -51,6 +57,11 @@ _browser_skips = {
     "tbb_safest": {**_tbb_skips, **_tbb_safer_skips, **_tbb_safest_skips},
 }
 
+_browser_order = list(_browser_skips)
+
+def _browser_of(item):
+    return item.callspec.params.get("browser") if hasattr(item, "callspec") else None
+
 def pytest_collection_modifyitems(items):
     for item in items:
         if not hasattr(item, "callspec"):
@@ -61,6 +72,18 @@ def pytest_collection_modifyitems(items):
         for pattern, reason in skips.items():
             if pattern in test_case:
                 item.add_marker(pytest.mark.skip(reason=reason))
+        if browser_id in ("tbb", "tbb_safer", "tbb_safest"):
+            # Tor Browser instances share the install's tor daemon; with
+            # `--dist loadgroup` they all go to the same xdist worker
+            item.add_marker(pytest.mark.xdist_group("tor-browser"))
+    # Run all tests of a browser back to back, so the pool keeps reusing the
+    # same warm instance instead of switching kinds on every test
+    items.sort(key=lambda item: _browser_order.index(_browser_of(item)) + 1
+               if _browser_of(item) in _browser_order else 0)
+
+def pytest_configure(config):
+    # Registered here too so runs without pytest-xdist don't warn about it
+    config.addinivalue_line("markers", "xdist_group(name): run tests of a group on one xdist worker")
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -73,18 +96,82 @@ def pytest_addoption(parser):
     )
     parser.addoption(
         "--iterations", type=int, default=20,
-        help="Number of iterations per test"
+        help="Maximum number of measured rounds per benchmark"
+    )
+    parser.addoption(
+        "--min-iterations", type=int, default=5,
+        help="Rounds per benchmark before the confidence interval is checked"
+    )
+    parser.addoption(
+        "--ci-width", type=float, default=0.05,
+        help="Stop a benchmark once the 95%% confidence interval of its own mean round "
+             "time is narrower than this fraction of that mean; each benchmark, and so "
+             "each side of an overhead comparison, stops on its own. 0 always runs "
+             "--iterations rounds"
+    )
+    parser.addoption(
+        "--time-budget", type=float, default=600,
+        help="Seconds per benchmark after which no new round is started"
+    )
+    parser.addoption(
+        "--warmup-rounds", type=int, default=0,
+        help="Rounds run and discarded before measuring each benchmark"
+    )
+    parser.addoption(
+        "--server-mode", choices=["threaded", "asyncio"], default="threaded",
+        help="Test HTTP server implementation; asyncio adds keep-alive, HTTP/2 and streaming"
+    )
+    parser.addoption(
+        "--offline-sigsum", action="store_true",
+        help="Sign bundles with a local Sigsum log and witness instead of test.sigsum.org"
     )
+    parser.addoption(
+        "--network", action="store", default=None, metavar="PRESETS",
+        help="Comma-separated network presets (" + ", ".join(NETWORK_PRESETS) + ", or none) "
+             "to run every test using the servers under; see helpers.NetworkProfile"
+    )
+    parser.addoption(
+        "--benchmark-store", action="store", default=None, metavar="PATH",
+        help="Record benchmark results in a SQLite database, keyed by commit; see benchstore.py"
+    )
+
+def pytest_generate_tests(metafunc):
+    presets = metafunc.config.getoption("--network")
+    if presets and "network" in metafunc.fixturenames:
+        names = presets.split(",")
+        for name in names:
+            if name != "none" and name not in NETWORK_PRESETS:
+                raise pytest.UsageError(f"--network: unknown preset {name!r}")
+        metafunc.parametrize("network", names, ids=[f"net-{name}" for name in names], indirect=True)
+
+def pytest_sessionfinish(session):
+    path = session.config.getoption("--benchmark-store")
+    bs = getattr(session.config, "_benchmarksession", None)
+    if not path or bs is None:
+        return
+    results = [bench.as_dict(include_data=True) for bench in bs.benchmarks if bench]
+    if not results:
+        return
+    commit, dirty = current_commit(os.path.dirname(__file__))
+    store = BenchmarkStore(path)
+    try:
+        store.record(commit, dirty, results)
+    finally:
+        store.close()
+
+@pytest.fixture(scope="session")
+def slot(tmp_path_factory):
+    return Slot.for_worker(os.environ.get("PYTEST_XDIST_WORKER", ""), str(tmp_path_factory.mktemp("slot")))
 
 @pytest.fixture(scope="session")
-def addon_path(request):
+def addon_path(request, slot):
     raw_path = request.config.getoption("--addon")
     if not raw_path:
         pytest.exit("Error: --addon argument is required.")
     abs_path = os.path.abspath(raw_path)
     if not os.path.exists(abs_path):
         pytest.exit(f"Error: Addon path does not exist: {abs_path}")
-    return abs_path
+    return slot.addon(abs_path)
 
 @pytest.fixture(scope="session")
 def dnsnames():
@@ -99,15 +186,27 @@ def non_enrolled_dnsnames():
         "nonenrolled.localhost",
     ]
 
+# More enrolled-able names than the extension caches origins for
+@pytest.fixture(scope="session")
+def soak_dnsnames():
+    return [f"soak{i}.localhost" for i in range(40)]
+
 @pytest.fixture(scope="session")
-def ssl_cert(dnsnames, non_enrolled_dnsnames):
+def ssl_cert(dnsnames, non_enrolled_dnsnames, soak_dnsnames):
     tmpdir = tempfile.mkdtemp()
-    cert_path, key_path = generate_ssl_cert(tmpdir, dnsnames + non_enrolled_dnsnames)
+    cert_path, key_path = generate_ssl_cert(tmpdir, dnsnames + non_enrolled_dnsnames + soak_dnsnames)
     return cert_path, key_path
 
+# Name of the network preset the servers shape their responses with, or None
+# for the unshaped loopback; parametrized by --network
+@pytest.fixture(scope="session")
+def network(request):
+    name = getattr(request, "param", None)
+    return None if name == "none" else name
+
 @pytest.fixture(scope="function")
-def update_server(root, dnsnames):
-    us = UpdateServer()
+def update_server(root, dnsnames, slot, network):
+    us = UpdateServer(port=slot.update_port, network=network)
     us.start()
     with open(f'{root}/.well-known/webcat/bundle.json') as bundle:
         enrollment = json.load(bundle)["enrollment"]
@@ -119,11 +218,26 @@ def update_server(root, dnsnames):
     yield us
     us.stop()
 
+# Keys, enrollment and signed bundles persist in pytest's cache directory, so
+# unchanged trees aren't signed again; `--cache-clear` starts over
 @pytest.fixture(scope="session")
-def bundle_generator():
-    g = BundleGenerator()
+def bundle_generator(request, slot):
+    cache_dir = request.config.cache.mkdir("webcat-bundles")
+    log = None
+    if request.config.getoption("--offline-sigsum"):
+        # Keys persist next to the bundles, so the trust policy stays stable
+        log = LocalSigsumLog(slot.sigsum_port, key_dir=cache_dir)
+        log.start()
+    g = BundleGenerator(cache_dir=cache_dir, log=log)
+    # Sign every case root this session uses in one parallel pass, so the
+    # `root` fixture below only finds them in the cache
+    roots = {item.callspec.params["root"] for item in request.session.items
+             if "root" in getattr(getattr(item, "callspec", None), "params", {})}
+    g.sign_many(sorted(roots))
     yield g
     g.close()
+    if log:
+        log.stop()
 
 # Session-scoped so signing (a sigsum network round trip) happens once. A
 # function-scoped dependency here would tear this down after every test.
@@ -132,39 +246,66 @@ def root(request, bundle_generator):
     bundle_generator.sign(request.param)
     return request.param
 
+# A synthetic app of request.param files (see synthetic.py), generated once
+# into pytest's cache directory and signed like `root`
+@pytest.fixture(scope="session")
+def synthetic_app(request, bundle_generator):
+    path = cached_app(request.config.cache.mkdir("webcat-synthetic"), request.param)
+    bundle_generator.sign(path)
+    return path
+
+# Same, for an app loading one asset; request.param is (size, extension)
+@pytest.fixture(scope="session")
+def large_asset_app(request, bundle_generator):
+    path = cached_large_asset_app(request.config.cache.mkdir("webcat-synthetic"), *request.param)
+    bundle_generator.sign(path)
+    return path
+
 @pytest.fixture(scope="function")
-def server(root, headers, hooks, ssl_cert):
+def server(request, root, headers, hooks, ssl_cert, slot, network):
     cert_path, key_path = ssl_cert
-    s = Server(
+    server_class = AsyncServer if request.config.getoption("--server-mode") == "asyncio" else Server
+    s = server_class(
         root=root,
         headers=headers or {},
         hooks=hooks or {},
         ssl_cert=cert_path,
         ssl_key=key_path,
+        port=slot.https_port,
+        network=network,
     )
     s.start()
     yield s
     s.stop()
 
+@pytest.fixture(scope="session")
+def browser_pool(request, slot):
+    pool = BrowserPool({
+        "firefox": lambda: Browser(),
+        "tbb": lambda: TorBrowser(allowed_addons=["webcat@freedom.press"]),
+        "tbb_safer": lambda: TorBrowser(allowed_addons=["webcat@freedom.press"], security_level=TorBrowser.SecurityLevel.Safer),
+        "tbb_safest": lambda: TorBrowser(allowed_addons=["webcat@freedom.press"], security_level=TorBrowser.SecurityLevel.Safest),
+    }, headless=request.config.getoption("--headless"), debugger_port=slot.debugger_port)
+    yield pool
+    pool.close()
+
 @pytest.fixture(scope="function")
-def browser(request, ssl_cert, server, dnsnames, non_enrolled_dnsnames):
+def browser(request, browser_pool, ssl_cert, server, dnsnames, non_enrolled_dnsnames, soak_dnsnames):
     cert_path, _ = ssl_cert
-    if request.param == "firefox":
-        b = Browser()
-    elif request.param == "tbb":
-        b = TorBrowser(allowed_addons=["webcat@freedom.press"])
-    elif request.param == "tbb_safer":
-        b = TorBrowser(allowed_addons=["webcat@freedom.press"], security_level=TorBrowser.SecurityLevel.Safer)
-    elif request.param == "tbb_safest":
-        b = TorBrowser(allowed_addons=["webcat@freedom.press"], security_level=TorBrowser.SecurityLevel.Safest)
-    else:
-        raise RuntimeError(f'unrecognized browser \'{request.param}\'')
-    b.trust_cert(cert_path, server.port, dnsnames + non_enrolled_dnsnames)
-    b.start(request.config.getoption("--headless"))
+    b = browser_pool.acquire(request.param, prepare=lambda b: b.trust_cert(
+        cert_path, server.port, dnsnames + non_enrolled_dnsnames + soak_dnsnames))
     yield b
-    b.destroy()
+    browser_pool.release(request.param, b)
 
 class ExternallyTimedBenchmarkFixture(BenchmarkFixture):
+    # Defaults of adaptive(); the benchmark fixture takes them from the
+    # command line
+    ADAPTIVE_DEFAULTS = dict(max_rounds=20, min_rounds=5, ci_width=0.05, time_budget=600, warmup_rounds=0)
+
+    def __init__(self, *args, adaptive=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.adaptive_options = self.ADAPTIVE_DEFAULTS | (adaptive or {})
+
     def _make_runner(self, function_to_benchmark, args, kwargs):
         def runner(loops_range):
             start, end, result = function_to_benchmark(loops_range, *args, **kwargs)
@@ -172,6 +313,62 @@ class ExternallyTimedBenchmarkFixture(BenchmarkFixture):
 
         return runner
 
+    def adaptive(self, target, setup=None, teardown=None):
+        """Like pedantic(), but instead of a fixed number of rounds keep
+        sampling until the 95% confidence interval (Student's t) of this
+        benchmark's mean round time is narrower than ci_width times the mean,
+        or max_rounds or the time budget is reached. The rule applies to each
+        benchmark alone, not to the difference between, say, the extension
+        and no_extension scenarios of a comparison, which stop independently.
+        The first warmup_rounds rounds are discarded. How and when it stopped
+        ends up in extra_info."""
+        if self._mode:
+            self.has_error = True
+            raise FixtureAlreadyUsed(
+                "Fixture can only be used once. Previously it was used in %s mode." % self._mode)
+        self._mode = "benchmark.adaptive(...)"
+        options = self.adaptive_options
+        deadline = monotonic() + options["time_budget"]
+
+        def ci_width(samples):
+            t = student_t_quantile(0.975, len(samples) - 1)
+            return 2 * t * statistics.stdev(samples) / len(samples) ** 0.5
+
+        def round_():
+            args, kwargs = setup() if setup else ((), {})
+            try:
+                return self._make_runner(target, args, kwargs)(range(1))
+            finally:
+                if teardown:
+                    teardown(*args, **kwargs)
+
+        if self.disabled:
+            return round_()[1]
+
+        for _ in range(options["warmup_rounds"]):
+            round_()
+        stats = self._make_stats(1)
+        samples = []
+        reason = "max_rounds"
+        while len(samples) < options["max_rounds"]:
+            duration, result = round_()
+            samples.append(duration)
+            stats.update(duration)
+            if len(samples) >= max(options["min_rounds"], 2) and options["ci_width"]:
+                mean = statistics.fmean(samples)
+                if mean > 0 and ci_width(samples) / mean <= options["ci_width"]:
+                    reason = "ci_width"
+                    break
+            if monotonic() >= deadline:
+                reason = "time_budget"
+                break
+        self.extra_info["rounds"] = len(samples)
+        self.extra_info["warmup_rounds"] = options["warmup_rounds"]
+        self.extra_info["stopped_by"] = reason
+        if len(samples) > 1:
+            self.extra_info["ci_width"] = ci_width(samples) / statistics.fmean(samples)
+        return result
+
 @pytest.fixture
 def benchmark(request):
     bs = request.config._benchmarksession
@@ -183,8 +380,14 @@ def benchmark(request):
         warner=request.node.warn,
         disabled=bs.disabled,
         **dict(bs.options,
-               warmup=False,
-               min_rounds=123),
+               warmup=False),
+        adaptive=dict(
+            max_rounds=request.config.getoption("--iterations"),
+            min_rounds=request.config.getoption("--min-iterations"),
+            ci_width=request.config.getoption("--ci-width"),
+            time_budget=request.config.getoption("--time-budget"),
+            warmup_rounds=request.config.getoption("--warmup-rounds"),
+        ),
     )
     yield fixture
     fixture._cleanup()
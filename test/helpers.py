@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import atexit
+import collections
 import json
 import uuid
 import queue
@@ -15,16 +16,32 @@ import http.server
 import socketserver
 import hashlib
 import datetime
+import urllib.parse
 import ipaddress
+import email.utils
+import mimetypes
+import fcntl
+import functools
+import gzip
+import random
+import tempfile
+import zipfile
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from base64 import b64decode, b64encode
 from pathlib import Path
-from time import sleep, monotonic
+from time import sleep, monotonic, time
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # --- Patch subprocess.Popen to discard Firefox output ---
 _original_popen = subprocess.Popen
 def popen_no_output(args, **kwargs):
@@ -68,6 +85,55 @@ def kill_tree(proc, timeout=10):
         except psutil.NoSuchProcess:
             pass
 
+@contextmanager
+def profiles_lock():
+    """Serialize profiles.ini updates across parallel test workers. Firefox
+    resolves `-P name` through the default profiles.ini, so profiles cannot
+    move to a per-worker directory; their names are unique instead."""
+    with open(os.path.join(tempfile.gettempdir(), "webcat-geckordp-profiles.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+TEST_EVENT_PREFIX = "__WEBCAT_TEST_EVENT__"
+
+def chrome_trace(processes):
+    """Chrome trace-event JSON object (for about:tracing or Perfetto) from
+    {process name: [{"name", "start", "end", "args"}]}, times in wall-clock
+    seconds. Complete events on one thread have to nest, so overlapping spans
+    are spread over as many threads as needed."""
+    events = []
+    base = min((span["start"] for spans in processes.values() for span in spans), default=0)
+    for pid, (process, spans) in enumerate(processes.items(), 1):
+        events.append({"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": process}})
+        # Per thread, the ends of the spans still open at the current start
+        lanes = []
+        for span in sorted(spans, key=lambda span: (span["start"], -span["end"])):
+            for tid, open_ends in enumerate(lanes):
+                while open_ends and open_ends[-1] <= span["start"]:
+                    open_ends.pop()
+                if not open_ends or span["end"] <= open_ends[-1]:
+                    break
+            else:
+                tid = len(lanes)
+                lanes.append([])
+            lanes[tid].append(span["end"])
+            events.append({
+                "ph": "X", "name": span["name"], "pid": pid, "tid": tid,
+                "ts": (span["start"] - base) * 1e6, "dur": (span["end"] - span["start"]) * 1e6,
+                "args": span.get("args", {}),
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# Profile preferences keeping an extension's storage and internal UUID when
+# it's uninstalled, as temporary add-ons are on every quit
+KEEP_EXTENSION_DATA = {
+    "extensions.webextensions.keepStorageOnUninstall": True,
+    "extensions.webextensions.keepUuidOnUninstall": True,
+}
+
 class Browser:
     # geckordp profile creation takes ~15s; do it once and clone per browser
     _template_profiles: dict = {}
@@ -81,7 +147,8 @@ class Browser:
         template = Browser._template_profiles.get(template_key)
         if template is None:
             template = f"geckordp-template-{uuid.uuid4()}"
-            self.pm.create(template)
+            with profiles_lock():
+                self.pm.create(template)
             # geckordp initializes the profile by launching the browser; kill
             # any instance that survived it, or its leftovers (e.g. the tor
             # daemon) block every later browser start
@@ -89,8 +156,9 @@ class Browser:
                 if template in " ".join(p.info["cmdline"] or []):
                     kill_tree(p)
             Browser._template_profiles[template_key] = template
-            atexit.register(self.pm.remove, template)
-        self.pm.clone(template, self.profile_name, ignore_invalid_files=True)
+            atexit.register(self._remove_profile, self.pm, template)
+        with profiles_lock():
+            self.pm.clone(template, self.profile_name, ignore_invalid_files=True)
         profile = self.pm.get_profile_by_name(self.profile_name)
         self.profile_path = profile.path
         profile.set_required_configs()
@@ -103,8 +171,14 @@ class Browser:
         logging.info(f"Profile {self.profile_name} created.")
         subprocess.Popen(["pkill", "-f", f'\\-P {self.profile_name}']) # TBB hack
 
+    @staticmethod
+    def _remove_profile(pm, name):
+        with profiles_lock():
+            pm.remove(name)
+
     def start(self, headless=False, start="about:blank", flags=None, port=6000):
         self.port = port
+        self.headless, self.flags = headless, flags
         flags = list(flags or [])
         if headless:
             flags.append("-headless")
@@ -180,13 +254,91 @@ class Browser:
                     break
                 sleep(0.1)
         try:
-            self.pm.remove(self.profile_name)
+            Browser._remove_profile(self.pm, self.profile_name)
             logging.info(f"Profile {self.profile_name} removed.")
         except:
             pass
 
+    def restart(self, timeout=30):
+        """Quit the browser and start it again on the same profile, e.g. to
+        measure what survives a restart. Temporary add-ons don't: install
+        them again. Their storage does with KEEP_EXTENSION_DATA."""
+        # Deferred, so that the script can still report back
+        self._execute_chrome_async(
+            "setTimeout(() => Services.startup.quit(Ci.nsIAppStartup.eAttemptQuit), 100);")
+        self.client.disconnect()
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f"browser did not quit within {timeout}s, killing it")
+            kill_tree(self.proc)
+        deadline = monotonic() + 10
+        while True:
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.2).close()
+            except OSError:
+                break
+            if monotonic() > deadline:
+                raise RuntimeError(f"debugger port {self.port} still open after quitting")
+            sleep(0.1)
+        for attr in ("_ext_logs", "_ext_events", "_ext_logs_changed", "_ext_console_id", "_ext_watcher_actor",
+                     "_load_watch"):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        self.start(self.headless, flags=self.flags, port=self.port)
+
+    def reset(self, timeout=15):
+        """Bring a started browser back to a blank state so the next test can
+        reuse it: uninstall temporary addons, clear caches and site data of
+        the trusted test hosts, and close every tab but one."""
+        hosts = json.dumps(["127.0.0.1", *getattr(self, "_trusted_hosts", [])])
+        self._execute_chrome_async(f"""
+            const {{ AddonManager }} = ChromeUtils.importESModule(
+                "resource://gre/modules/AddonManager.sys.mjs");
+            for (const addon of await AddonManager.getAllAddons()) {{
+                if (addon.temporarilyInstalled) {{
+                    await addon.uninstall();
+                }}
+            }}
+            const flags = Ci.nsIClearDataService;
+            const caches = flags.CLEAR_ALL_CACHES ?? (flags.CLEAR_NETWORK_CACHE | flags.CLEAR_IMAGE_CACHE);
+            await new Promise(resolve => Services.clearData.deleteData(caches, resolve));
+            // Site data only for the test hosts: a global wipe would also
+            // reset other addons' storage, e.g. NoScript's security level
+            const site = (flags.CLEAR_ALL & ~flags.CLEAR_CERT_EXCEPTIONS) >>> 0;
+            for (const host of {hosts}) {{
+                await new Promise(resolve => Services.clearData.deleteDataFromSite
+                    ? Services.clearData.deleteDataFromSite(host, {{}}, true, site, resolve)
+                    : Services.clearData.deleteDataFromHost(host, true, site, resolve));
+            }}
+            const main = Services.wm.getMostRecentWindow("navigator:browser");
+            for (const win of Services.wm.getEnumerator("navigator:browser")) {{
+                if (win !== main) {{
+                    win.close();
+                }}
+            }}
+            main.gBrowser.removeAllTabsBut(main.gBrowser.selectedTab);
+        """, timeout)
+        for attr in ("_ext_logs", "_ext_events", "_ext_logs_changed", "_ext_console_id", "_ext_watcher_actor",
+                     "_load_watch"):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        self.navigate("about:blank")
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                if self.execute("location.href") == "about:blank":
+                    break
+            except Exception:
+                pass
+            if monotonic() > deadline:
+                raise RuntimeError(f"browser tab not blank within {timeout}s after reset")
+            sleep(0.1)
+        logging.info(f"Browser {self.profile_name} reset.")
+
     def trust_cert(self, cert_path, port, dnsnames = []):
         """Add a certificate override for 127.0.0.1:port via cert_override.txt."""
+        self._trusted_hosts = list(dnsnames)
         with open(cert_path, "rb") as f:
             cert = x509.load_pem_x509_certificate(f.read())
         der_data = cert.public_bytes(serialization.Encoding.DER)
@@ -229,6 +381,8 @@ class Browser:
 
     def attach_extension_console(self, addon_match="webcat"):
         # Subscribe to console-message resources from the extension's targets
+        if hasattr(self, "_ext_watcher_actor"):
+            return
         addons = self._list_addons()
         addon = next(
             (a for a in addons
@@ -245,11 +399,19 @@ class Browser:
             raise RuntimeError(f"no watcher actor in {watcher_resp!r}")
 
         self._ext_logs = []
+        self._ext_events = []
+        self._ext_logs_changed = threading.Condition()
         attached_targets = set()
         def on_resources(data):
             for entry in data.get("array", []):
                 if len(entry) >= 2 and entry[0] == "console-message":
-                    self._ext_logs.extend(entry[1])
+                    with self._ext_logs_changed:
+                        self._ext_logs.extend(entry[1])
+                        for message in entry[1]:
+                            args = message.get("message", message).get("arguments") or []
+                            if len(args) == 2 and args[0] == TEST_EVENT_PREFIX and isinstance(args[1], str):
+                                self._ext_events.append(json.loads(args[1]))
+                        self._ext_logs_changed.notify_all()
         def on_target(data):
             tg = data.get("target", {})
             actor = tg.get("actor")
@@ -272,17 +434,175 @@ class Browser:
         })
         self._ext_watcher_actor = watcher_actor
 
+    def detach_extension_console(self):
+        """Stop receiving extension console messages, e.g. so they don't
+        add debugger traffic to a measurement. What was received is kept."""
+        watcher_actor = getattr(self, "_ext_watcher_actor", None)
+        if watcher_actor is None:
+            return
+        self.client.send_receive({
+            "to": watcher_actor, "type": "unwatchResources",
+            "resourceTypes": ["console-message", "error-message"],
+        })
+        self.client.send_receive({
+            "to": watcher_actor, "type": "unwatchTargets", "targetType": "frame",
+        })
+        del self._ext_watcher_actor
+
+    def rss(self):
+        """Resident memory in bytes of the browser and its child processes."""
+        try:
+            parent = psutil.Process(self.proc.pid)
+            procs = [parent] + parent.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return 0
+        total = 0
+        for p in procs:
+            try:
+                total += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
     def extension_logs(self):
         return list(getattr(self, "_ext_logs", []))
 
-    def navigate(self, url):
+    def extension_events(self, name=None):
+        """Events reported by a testing build of the extension (see
+        extension/src/webcat/testing.ts), oldest first."""
+        return [e for e in list(getattr(self, "_ext_events", [])) if name is None or e.get("event") == name]
+
+    def wait_until(self, event, timeout=15, where=None, since=0):
+        """Block until the extension reports `event` and return it. Only
+        events after the first `since` of that name count, and with `where`
+        only those it accepts. Needs attach_extension_console()."""
+        if not hasattr(self, "_ext_logs_changed"):
+            raise RuntimeError("wait_until() needs attach_extension_console() first")
+        deadline = monotonic() + timeout
+        with self._ext_logs_changed:
+            while True:
+                for e in self.extension_events(event)[since:]:
+                    if where is None or where(e):
+                        return e
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f"no '{event}' event from the extension within {timeout}s")
+                self._ext_logs_changed.wait(remaining)
+
+    def wait_for_list(self, timeout=60):
+        """Wait until the extension applied an enrollment list from the
+        update server, as opposed to its bundled one."""
+        return self.wait_until("list_applied", timeout, where=lambda e: not e["local"])
+
+    def settle(self, timeout=5, quiet=0.05):
+        """Return once the extension reports no open response filters and
+        nothing changed for `quiet` seconds. Falls back to a fixed delay when
+        the extension console isn't attached."""
+        if not hasattr(self, "_ext_logs"):
+            sleep(0.5)
+            return
+        deadline = monotonic() + timeout
+        seen = -1
+        while monotonic() < deadline:
+            events = self.extension_events("filters")
+            if len(events) == seen and (not events or events[-1]["open"] == 0):
+                return
+            seen = len(events)
+            sleep(quiet)
+        logging.warning(f"extension still has open response filters after {timeout}s")
+
+    def navigate(self, url, wait=False, timeout=15):
+        """Navigate the current tab. With `wait`, return only once the new
+        document fired its load event. The wait is pushed by the debugger's
+        document events rather than polled, so it sends nothing to the page
+        while it loads."""
         current_tab = self.root.current_tab()
+        if wait:
+            watch = self._watch_loads(current_tab["actor"])
+            # Events carry the content process's wall clock; the events the
+            # watcher replays for the current document are older
+            started = time() * 1000
         tab = TabActor(self.client, current_tab["actor"])
         actor_ids = tab.get_target()
         web = WindowGlobalActor(self.client, actor_ids["actor"])
         logging.info(f"Navigating to {url}")
-        return web.navigate_to(url)
+        result = web.navigate_to(url)
+        if wait:
+            with watch["changed"]:
+                if not watch["changed"].wait_for(lambda: watch["completed"] >= started, timeout):
+                    raise RuntimeError(f"{url} did not finish loading within {timeout}s")
+        return result
+
+    def _watch_loads(self, tab_actor):
+        """Track when the last document of a tab reached readyState
+        "complete", which is set just before its load event is dispatched,
+        from the document-event resources of its watcher. Set up once per
+        tab."""
+        watch = getattr(self, "_load_watch", None)
+        if watch is not None and watch["tab"] == tab_actor:
+            return watch
+        watch = {"tab": tab_actor, "completed": 0, "changed": threading.Condition()}
+        watcher_actor = self.client.send_receive({"to": tab_actor, "type": "getWatcher"})["actor"]
+        attached_targets = set()
+
+        def on_resources(data):
+            for entry in data.get("array", []):
+                if len(entry) >= 2 and entry[0] == "document-event":
+                    times = [event.get("time", 0) for event in entry[1] if event.get("name") == "dom-complete"]
+                    if times:
+                        with watch["changed"]:
+                            watch["completed"] = max(watch["completed"], *times)
+                            watch["changed"].notify_all()
+
+        def on_target(data):
+            actor = data.get("target", {}).get("actor")
+            if actor and actor not in attached_targets:
+                attached_targets.add(actor)
+                self.client.add_event_listener(actor, Events.Watcher.RESOURCES_AVAILABLE_ARRAY, on_resources)
+
+        self.client.add_event_listener(watcher_actor, Events.Watcher.TARGET_AVAILABLE_FORM, on_target)
+        self.client.send_receive({"to": watcher_actor, "type": "watchTargets", "targetType": "frame"})
+        self.client.send_receive({"to": watcher_actor, "type": "watchResources", "resourceTypes": ["document-event"]})
+        self._load_watch = watch
+        return watch
     
+    def collect_extension_trace(self, url, path=None, server=None, timeout=15):
+        """Load `url` once with the extension's spans switched on (traced() in
+        extension/src/webcat/testing.ts) and return them, with the page load
+        and the requests `server` served meanwhile, as a Chrome trace-event
+        JSON object; also written to `path` if given. Needs a testing build
+        and attach_extension_console()."""
+        self.execute("globalThis.__WEBCAT_TRACE__ = true; performance.clearMeasures();", in_extension=True)
+        served = len(server.timings) if server else 0
+        try:
+            self.navigate(url, wait=True, timeout=timeout)
+            self.settle()
+            extension = json.loads(self.execute(
+                "JSON.stringify(performance.getEntriesByType('measure').map(m => ({"
+                "name: m.name, start: (performance.timeOrigin + m.startTime) / 1000,"
+                " end: (performance.timeOrigin + m.startTime + m.duration) / 1000, args: m.detail || {}})))",
+                in_extension=True,
+            ))
+        finally:
+            self.execute("globalThis.__WEBCAT_TRACE__ = false; performance.clearMeasures();", in_extension=True)
+        page = json.loads(self.execute(
+            "JSON.stringify((({name, startTime, loadEventEnd}) => [{name: 'navigation',"
+            " start: (performance.timeOrigin + startTime) / 1000,"
+            " end: (performance.timeOrigin + loadEventEnd) / 1000, args: {url: name}}])"
+            "(performance.getEntriesByType('navigation')[0]))"
+        ))
+        processes = {"page": page, "extension": extension}
+        if server:
+            processes["server"] = [
+                {"name": t["target"], "start": t["start"], "end": t["end"], "args": {}}
+                for t in server.timings[served:]
+            ]
+        trace = chrome_trace(processes)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(trace, f)
+        return trace
+
     def execute(self, javascript, in_extension=False):
         if in_extension:
             console_actor_id = self._ext_console_id
@@ -295,6 +615,52 @@ class Browser:
         logging.info(f"Executing js...")
         return self.evaluate_js_sync(console_actor_id, javascript)
 
+    def execute_chrome(self, javascript):
+        """Evaluate javascript in the parent process, with chrome privileges."""
+        if not hasattr(self, "_chrome_console_id"):
+            descriptor = self.client.send_receive({"to": "root", "type": "getProcess", "id": 0})
+            target = self.client.send_receive({
+                "to": descriptor["processDescriptor"]["actor"], "type": "getTarget",
+            })
+            self._chrome_console_id = target.get("process", target)["consoleActor"]
+        return self.evaluate_js_sync(self._chrome_console_id, javascript)
+
+    def _execute_chrome_async(self, body, timeout=15):
+        """Run body as an async function with chrome privileges and return
+        its JSON-serializable result."""
+        # The console hands back a grip for a Promise rather than awaiting it,
+        # so park the outcome in a global and poll it
+        token = f"__webcat_{uuid.uuid4().hex}"
+        self.execute_chrome(
+            f"globalThis.{token} = 'pending';"
+            f"(async () => {{ {body} }})().then("
+            f"v => globalThis.{token} = JSON.stringify({{ok: v ?? null}}),"
+            f" e => globalThis.{token} = JSON.stringify({{error: String(e)}}));"
+        )
+        deadline = monotonic() + timeout
+        while (state := self.execute_chrome(f"globalThis.{token}")) == "pending":
+            if monotonic() > deadline:
+                raise RuntimeError(f"chrome script did not finish within {timeout}s")
+            sleep(0.05)
+        self.execute_chrome(f"delete globalThis.{token}")
+        outcome = json.loads(state)
+        if "error" in outcome:
+            raise RuntimeError(f"chrome script failed: {outcome['error']}")
+        return outcome["ok"]
+
+    def process_memory(self):
+        """Resident memory in bytes per Firefox process type, e.g. "browser",
+        "extension" or "web", summed over the processes of a type."""
+        processes = self._execute_chrome_async("""
+            const info = await ChromeUtils.requestProcInfo();
+            return [{type: "browser", memory: info.memory},
+                    ...info.children.map(({type, memory}) => ({type, memory}))];
+        """)
+        memory = {}
+        for process in processes:
+            memory[process["type"]] = memory.get(process["type"], 0) + process["memory"]
+        return memory
+
     def evaluate_js_sync(self, console_actor_id, code, timeout=10):
         """
         Evaluates JavaScript asynchronously via the WebConsoleActor, waits for a result,
@@ -319,6 +685,51 @@ class Browser:
 
         return value
 
+class BrowserPool:
+    """Hands out started browsers and keeps one warm between tests, so a test
+    pays for a reset instead of profile cloning, startup and teardown. Only
+    one browser is kept: Tor Browser instances share their install's tor
+    daemon, so asking for another kind retires the warm one."""
+
+    def __init__(self, factories, headless=False, debugger_port=6000):
+        self.factories = factories
+        self.headless = headless
+        self.debugger_port = debugger_port
+        self._idle = None
+
+    def acquire(self, kind, prepare=None):
+        """Return a started browser of the given kind. `prepare` is called
+        with freshly created browsers before they start, e.g. to trust certs."""
+        if kind not in self.factories:
+            raise RuntimeError(f"unrecognized browser '{kind}'")
+        if self._idle is not None:
+            idle_kind, browser = self._idle
+            self._idle = None
+            if idle_kind == kind:
+                return browser
+            browser.destroy()
+        browser = self.factories[kind]()
+        if prepare is not None:
+            prepare(browser)
+        browser.start(self.headless, port=self.debugger_port)
+        return browser
+
+    def release(self, kind, browser):
+        """Reset the browser and keep it warm; a browser that cannot be reset
+        is destroyed and the next acquire starts a new one."""
+        try:
+            browser.reset()
+        except Exception as e:
+            logging.warning(f"Reset of {browser.profile_name} failed, recycling: {e}")
+            browser.destroy()
+            return
+        self._idle = (kind, browser)
+
+    def close(self):
+        if self._idle is not None:
+            self._idle[1].destroy()
+            self._idle = None
+
 class TorBrowser(Browser): 
     class SecurityLevel:
         Standard = 4
@@ -389,18 +800,182 @@ class TorBrowser(Browser):
             with open(self.profile_path.joinpath("extension-preferences.json"), "w") as file:
                 json.dump(prefs, file)
 
+# Named network conditions for NetworkProfile.get(). Tor figures are typical
+# for a three-hop circuit: around 600 ms RTT and a few Mbit/s
+NETWORK_PRESETS = {
+    "broadband": dict(latency=0.01, jitter=0.002, bandwidth=6_250_000),
+    "3g": dict(latency=0.1, jitter=0.02, bandwidth=200_000),
+    "tor-typical": dict(latency=0.3, jitter=0.08, bandwidth=250_000),
+    "tor-slow": dict(latency=0.8, jitter=0.3, bandwidth=60_000),
+}
+
+class NetworkProfile:
+    """Conditions of a simulated link for the test servers' responses: a
+    one-way `latency` with normally distributed `jitter` (seconds) per
+    packet of `mtu` bytes, and a token bucket of `burst` bytes refilled at
+    `bandwidth` bytes/s, shared by every response over the link. Requests
+    arrive after one latency and packets stay in order, as over TCP.
+    Connection and TLS handshakes aren't delayed."""
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, burst=16 * 1024, mtu=1460, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.burst = burst
+        self.mtu = mtu
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._refilled = monotonic()
+
+    @staticmethod
+    def get(profile):
+        """A NetworkProfile from a preset name, a profile, or None for none."""
+        if profile is None or isinstance(profile, NetworkProfile):
+            return profile
+        return NetworkProfile(**NETWORK_PRESETS[profile])
+
+    def delay(self):
+        with self._lock:
+            jitter = self._rng.gauss(0, self.jitter) if self.jitter else 0.0
+            return max(0.0, self.latency + jitter)
+
+    def depart(self, size):
+        """Reserve `size` bytes of bandwidth; returns when they may leave."""
+        now = monotonic()
+        if not self.bandwidth:
+            return now
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.bandwidth)
+            self._refilled = now
+            self._tokens -= size
+            return now + max(0.0, -self._tokens) / self.bandwidth
+
+    def writer(self, raw):
+        return _ShapedWriter(raw, self)
+
+class _ShapedWriter:
+    """Writes to `raw` over a NetworkProfile. write() only waits for
+    bandwidth; a delivery thread holds each packet back for its latency, so
+    consecutive writes pay the latency once, like packets in flight."""
+    closed = False
+
+    def __init__(self, raw, profile):
+        self.raw = raw
+        self.profile = profile
+        self._due = 0.0
+        self._packets = queue.Queue()
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        for offset in range(0, len(data), self.profile.mtu):
+            packet = bytes(data[offset:offset + self.profile.mtu])
+            depart = self.profile.depart(len(packet))
+            if (wait := depart - monotonic()) > 0:
+                sleep(wait)
+            # In order: a packet never arrives before the one sent earlier
+            self._due = max(self._due, depart + self.profile.delay())
+            self._packets.put((self._due, packet))
+        return len(data)
+
+    def _deliver(self):
+        broken = False
+        while (item := self._packets.get()) is not None:
+            due, packet = item
+            if broken:
+                continue
+            if (wait := due - monotonic()) > 0:
+                sleep(wait)
+            try:
+                self.raw.write(packet)
+            except OSError:
+                # The client went away; drop the rest
+                broken = True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Wait until everything written was delivered."""
+        self._packets.put(None)
+        self._thread.join()
+        self.closed = True
+
+@contextmanager
+def shaped(handler, profile):
+    """Run a request handler's response over `profile`, if any: the request
+    arrives one latency late and the response goes through a _ShapedWriter,
+    all of it delivered when the block exits."""
+    if profile is None:
+        yield
+        return
+    sleep(profile.delay())
+    raw, handler.wfile = handler.wfile, profile.writer(handler.wfile)
+    try:
+        yield
+    finally:
+        handler.wfile.close()
+        handler.wfile = raw
+
+class RandomBody:
+    """`size` pseudo-random bytes drawn from `seed`, generated chunk by chunk
+    every time the body is iterated, so that serving a huge response costs
+    no memory. Random.randbytes() output doesn't depend on how it is split
+    into chunks of whole 32-bit words, so a file written from the same seed
+    in larger pieces has the same content."""
+    def __init__(self, size, seed=0, chunk_size=64 * 1024):
+        if chunk_size % 4:
+            raise ValueError("chunk_size must be a multiple of 4")
+        self.size = size
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        remaining = self.size
+        while remaining > 0:
+            chunk = min(self.chunk_size, remaining)
+            yield rng.randbytes(chunk)
+            remaining -= chunk
+
+    @functools.cached_property
+    def sha256(self):
+        """SHA-256 digest of the body, computed once without serving it."""
+        h = hashlib.sha256()
+        for chunk in self:
+            h.update(chunk)
+        return h.digest()
+
 class Hook:
+    """A canned response for a path. `data` is the body: bytes, a path
+    (os.PathLike) streamed from disk, a RandomBody, a list of bytes chunks,
+    or a callable returning an iterable of chunks for every request. A plain
+    iterator can only be served once. With `chunk_delay`, the server pauses
+    that many seconds after every chunk; bytes and files are then sent in
+    chunks of `chunk_size`. A `network` (NetworkProfile or preset name)
+    shapes this response instead of the server's."""
     type = "text/plain"
     delay = None
     headers = {}
     status = 200
-    def __init__(self, data, type=None, base64=False, delay=None, headers={}, status=None):
+    chunk_size = 64 * 1024
+    chunk_delay = None
+    network = None
+    def __init__(self, data, type=None, base64=False, delay=None, headers={}, status=None,
+                 chunk_size=None, chunk_delay=None, network=None):
         if isinstance(data, Hook):
             self.data = data.data
             self.type = data.type
             self.delay = data.delay
             self.headers = data.headers
             self.status = data.status
+            self.chunk_size = data.chunk_size
+            self.chunk_delay = data.chunk_delay
+            self.network = data.network
         elif base64:
             self.data = b64decode(data)
         else:
@@ -411,64 +986,305 @@ class Hook:
             self.delay = delay
         if status is not None:
             self.status = status
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if chunk_delay is not None:
+            self.chunk_delay = chunk_delay
+        if network is not None:
+            self.network = NetworkProfile.get(network)
         self.headers = self.headers | headers
 
+    @property
+    def length(self):
+        """Content-Length of the body, or None if it is only known once sent."""
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview, RandomBody)):
+            return len(data)
+        if isinstance(data, os.PathLike):
+            return os.path.getsize(data)
+        if isinstance(data, (list, tuple)):
+            return sum(len(chunk) for chunk in data)
+        return None
+
+    def chunks(self):
+        """The body as an iterable of bytes, afresh for every request."""
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if not self.chunk_delay:
+                return [bytes(data)] if data else []
+            return (bytes(data[i:i + self.chunk_size]) for i in range(0, len(data), self.chunk_size))
+        if isinstance(data, os.PathLike):
+            return self._read(data)
+        if callable(data):
+            return data()
+        return data
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            while chunk := f.read(self.chunk_size):
+                yield chunk
+
+def guess_type(path):
+    _, ext = os.path.splitext(path)
+    extensions_map = http.server.SimpleHTTPRequestHandler.extensions_map
+    if ext in extensions_map:
+        return extensions_map[ext]
+    if ext.lower() in extensions_map:
+        return extensions_map[ext.lower()]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+# Response encodings the test servers offer, by preference. The bodies are
+# mostly hex hashes, where higher levels gain little but take seconds on
+# million-leaf lists.
+COMPRESSIONS = {"gzip": lambda body: gzip.compress(body, compresslevel=1, mtime=0)}
+if brotli is not None:
+    COMPRESSIONS = {"br": lambda body: brotli.compress(body, quality=1)} | COMPRESSIONS
+
+def etag_matches(etag, if_none_match):
+    """Whether an If-None-Match header value covers etag."""
+    if if_none_match is None:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+class FileCache:
+    """Snapshot of a server root, so that serving a file costs one stat()
+    instead of reading it. Files up to `max_inline` bytes are kept in memory;
+    larger ones are only hashed and get sent with sendfile. A file whose size
+    or mtime changed since, e.g. a re-signed bundle, is read again when it is
+    next served. The ETag is the file's SHA-256, so a rewritten file with the
+    same content revalidates. Use FileCache.of() to share snapshots between
+    the servers of a root."""
+
+    # Most recently used snapshots by root; see of()
+    _shared: "collections.OrderedDict[str,FileCache]" = collections.OrderedDict()
+    _shared_lock = threading.Lock()
+    SHARED_ROOTS = 4
+
+    class Entry:
+        def __init__(self, path, data, size, mtime, sha256, mtime_ns=None):
+            self.path = path
+            self.data = data
+            self.size = size
+            self.mtime_ns = mtime_ns
+            self.sha256 = sha256
+            self.etag = f'"{b64encode(sha256).decode()}"'
+            self.headers = {
+                "Content-Type": guess_type(path),
+                "Content-Length": str(size),
+                "Last-Modified": email.utils.formatdate(mtime, usegmt=True),
+                "ETag": self.etag,
+            }
+            self.mtime = int(mtime)
+
+        def not_modified(self, request_headers):
+            """Whether a conditional request can be answered with a 304."""
+            if_none_match = request_headers.get("if-none-match")
+            if if_none_match is not None:
+                return etag_matches(self.etag, if_none_match)
+            since = request_headers.get("if-modified-since")
+            if since is not None:
+                try:
+                    return self.mtime <= email.utils.parsedate_to_datetime(since).timestamp()
+                except (TypeError, ValueError, IndexError, OverflowError):
+                    pass
+            return False
+
+    def __init__(self, root, max_inline=1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_inline = max_inline
+        self.entries: dict[str,FileCache.Entry] = {}
+        self.directories: set[str] = set()
+        for dirpath, _, filenames in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root)
+            url_dir = "/" if rel == "." else "/" + rel.replace(os.sep, "/") + "/"
+            self.directories.add(url_dir)
+            for filename in filenames:
+                self.entries[url_dir + filename] = self._load(os.path.join(dirpath, filename))
+        for url_dir in self.directories:
+            if url_dir + "index.html" in self.entries:
+                self.entries[url_dir] = self.entries[url_dir + "index.html"]
+
+    @classmethod
+    def of(cls, root):
+        """The snapshot of root, taken on first use and shared by later
+        callers; only the SHARED_ROOTS most recently used roots are kept."""
+        root = os.path.abspath(root)
+        with cls._shared_lock:
+            cache = cls._shared.get(root)
+            if cache is None:
+                cache = cls._shared[root] = cls(root)
+                while len(cls._shared) > cls.SHARED_ROOTS:
+                    cls._shared.popitem(last=False)
+            cls._shared.move_to_end(root)
+            return cache
+
+    def _load(self, path, stat=None):
+        stat = stat or os.stat(path)
+        digest = hashlib.sha256()
+        data = b"" if stat.st_size <= self.max_inline else None
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+                if data is not None:
+                    data += chunk
+        return FileCache.Entry(path, data, stat.st_size, stat.st_mtime, digest.digest(), stat.st_mtime_ns)
+
+    def get(self, url_path):
+        """Return the entry for a URL path, or None for anything that needs
+        SimpleHTTPRequestHandler: missing files, files created after the
+        snapshot, directory redirects and listings."""
+        entry = self.entries.get(url_path)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(entry.path)
+        except FileNotFoundError:
+            self.entries.pop(url_path, None)
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime_ns):
+            entry = self.entries[url_path] = self._load(entry.path, stat)
+        return entry
+
 class Server:
     class MultiThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         allow_reuse_address = True
 
-    _served = threading.Condition()
-    _counts: dict[str,int] = {}
-
-    def __init__(self, root=".", headers=None, hooks=None, ssl_cert=None, ssl_key=None):
+    def __init__(self, root=".", headers=None, hooks=None, ssl_cert=None, ssl_key=None, port=None, chunk_size=None,
+                 network=None):
         self.root = os.path.abspath(root)
         self.headers = headers or {}
         self.hooks = hooks or {}
+        # When set, files and hooks are sent with chunked transfer-encoding
+        # in chunks of exactly this many bytes, each flushed on its own
+        # (TCP_NODELAY), to stress per-chunk costs in the browser
+        self.chunk_size = chunk_size
+        # NetworkProfile (or preset name) every response goes through,
+        # unless its hook has its own
+        self.network = NetworkProfile.get(network)
         self.ssl_cert = ssl_cert
         self.ssl_key = ssl_key
-        if self.ssl_cert and self.ssl_key:
+        if port is not None:
+            self.port = port
+        elif self.ssl_cert and self.ssl_key:
             self.port = 8443
         else:
             self.port = 8080
+        # path -> waiters still expecting it; see wait_for()
+        self._waiters: dict[str,list[Server._Waiter]] = {}
+        self._waiters_lock = threading.Lock()
+        self.files = FileCache.of(self.root)
+        # path -> number of conditional requests answered with a 304
+        self.revalidated: dict[str,int] = {}
+        # One entry per request, in completion order; see _served()
+        self.timings: list[dict] = []
 
     def start(self):
-        root, headers, hooks, served, counts = self.root, self.headers, self.hooks, self._served, self._counts
+        server = self
+        root, headers, hooks, served, files = self.root, self.headers, self.hooks, self._served, self.files
+        revalidated, chunk_size = self.revalidated, self.chunk_size
 
         class Handler(http.server.SimpleHTTPRequestHandler):
+            # Chunked transfer-encoding needs HTTP/1.1
+            protocol_version = "HTTP/1.1" if chunk_size else "HTTP/1.0"
+
+            def setup(self):
+                super().setup()
+                if chunk_size:
+                    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
             def translate_path(self, path):
                 return os.path.join(root, path.lstrip("/").split("?", 1)[0])
 
             def do_GET(self):
                 path = self.path.split("?", 1)[0]
+                hook = hooks.get(path)
+                network = getattr(hook, "network", None) or server.network
+                with shaped(self, network):
+                    start = time()
+                    self.respond(path)
+                served(path, self.path, start)
+
+            def respond(self, path):
                 if path in hooks:
                     hook = hooks[path]
                     if type(hook) is bytes:
                         self.send_response(200)
                         self.send_header("Content-Type", "text/plain")
-                        self.end_headers(hook)
-                        self.wfile.write(hook)
+                        self.end_headers(hook, body=True)
+                        self.write_body([hook])
                     else:
                         self.send_response(hook.status)
                         self.send_header("Content-Type", hook.type)
-                        self.end_headers(hook.data, hook.headers, hook.delay)
-                        self.wfile.write(hook.data)
+                        length = {} if hook.length is None else {"Content-Length": f"{hook.length}"}
+                        self.end_headers(override=length | hook.headers, delay=hook.delay, body=True)
+                        self.write_body(hook.chunks(), hook.chunk_delay)
+
+                elif entry := files.get(path):
+                    request_headers = {k.lower(): v for k, v in self.headers.items()}
+                    if entry.not_modified(request_headers):
+                        self.send_response(304)
+                        self.send_header("ETag", entry.etag)
+                        self.end_headers()
+                        revalidated[path] = revalidated.get(path, 0) + 1
+                    else:
+                        self.send_response(200)
+                        self.end_headers(override=entry.headers, body=True)
+                        if (chunk_size or self.shaped) and entry.data is None:
+                            with open(entry.path, "rb") as f:
+                                self.write_body(iter(functools.partial(f.read, 64 * 1024), b""))
+                        elif entry.data is not None:
+                            self.write_body([entry.data])
+                        else:
+                            with open(entry.path, "rb") as f:
+                                self.connection.sendfile(f)
 
                 else:
                     super().do_GET()
-                
-                with served:
-                    counts[path] = counts.get(path, 0) + 1
-                    served.notify_all()
 
-            def end_headers(self, data=None, override={}, delay=None):
+            @property
+            def shaped(self):
+                # sendfile() would bypass the shaped writer
+                return isinstance(self.wfile, _ShapedWriter)
+
+            def end_headers(self, data=None, override={}, delay=None, body=False):
                 h = {} if data is None else {"Content-Length": f"{len(data)}"}
                 h.update(headers)
                 h.update(override)
+                if body and chunk_size:
+                    h = {k: v for k, v in h.items() if k.lower() != "content-length"}
+                    h["Transfer-Encoding"] = "chunked"
+                if chunk_size:
+                    # One response per connection, as before HTTP/1.1
+                    h["Connection"] = "close"
                 for k, v in h.items(): self.send_header(k, v)
                 if delay is not None:
                     sleep(delay)
                 super().end_headers()
 
+            def write_body(self, chunks, delay=None):
+                """Write a body announced with end_headers(body=True); with a
+                chunk_size, re-cut into chunks of that size, one write each.
+                `delay` seconds pass after every chunk written."""
+                if not chunk_size:
+                    for chunk in chunks:
+                        self.wfile.write(chunk)
+                        if delay:
+                            sleep(delay)
+                    return
+                pending = b""
+                for chunk in chunks:
+                    data = pending + chunk
+                    end = len(data) - len(data) % chunk_size
+                    for i in range(0, end, chunk_size):
+                        self.wfile.write(b"%x\r\n%s\r\n" % (chunk_size, data[i:i + chunk_size]))
+                        if delay:
+                            sleep(delay)
+                    pending = data[end:]
+                if pending:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(pending), pending))
+                self.wfile.write(b"0\r\n\r\n")
+
             def log_message(self, *a): pass  # suppress logs
 
         self.httpd = Server.MultiThreadedServer(("127.0.0.1", self.port), Handler)
@@ -488,43 +1304,96 @@ class Server:
         scheme = "https" if self.ssl_cert else "http"
         return f"{scheme}://{hostname}:{self.port}"
     
-    class _Wait:
-        def __init__(self, server, paths):
-            self.server = server
-            self.paths = paths
-            self.timeout = False
-
-        def __enter__(self):
-            lock = threading.Lock()
-            lock.acquire()
-            self.thread = threading.Thread(target=self._wait, args=(lock,))
-            self.thread.start()
-            lock.acquire()
-
-        def __exit__(self, exc_type, exc, tb):
-            self.thread.join()
-            if self.timeout:
-                raise RuntimeError(f"timeout waiting for '{"', '".join(self.counts.keys())}'")
-            sleep(0.5) # minimal sleep to allow the browser to process the last response
-
-        def _wait(self, lock):
-            with self.server._served:
-                lock.release()
-                self.counts = {}
-                for path in self.paths:
-                    self.counts[path] = self.server._counts.get(path, 0)
-                while True:
-                    if not self.server._served.wait(15):
-                        self.timeout = True
-                        break
-                    for path, count in list(self.counts.items()):
-                        if self.server._counts.get(path, 0) > count:
-                            del self.counts[path]
-                    if len(self.counts) == 0:
-                        break
-    
-    def wait_for(self, paths):
-        return Server._Wait(self, paths)
+    class _Waiter:
+        def __init__(self, paths):
+            self.pending = set(paths)
+            self.future = Future()
+            if not self.pending:
+                self.future.set_result(None)
+
+        def served(self, path):
+            self.pending.discard(path)
+            if not self.pending and not self.future.done():
+                self.future.set_result(None)
+
+    def _served(self, path, target=None, start=None):
+        """Record a finished request for `target` (path and query) that
+        started at wall-clock time `start`, and wake up the waiters
+        interested in its path."""
+        if start is not None:
+            self.timings.append({"target": target, "start": start, "end": time()})
+        with self._waiters_lock:
+            for waiter in self._waiters.pop(path, ()):
+                waiter.served(path)
+
+    @contextmanager
+    def wait_for(self, paths, timeout=15, settle=0.5):
+        """Wait for every path in `paths` to be served at least once after
+        entering the block. `settle` runs once they were: either a delay in
+        seconds or a callable, such as Browser.settle, that returns when the
+        browser is done processing the responses."""
+        waiter = Server._Waiter(paths)
+        with self._waiters_lock:
+            for path in waiter.pending:
+                self._waiters.setdefault(path, []).append(waiter)
+        try:
+            yield waiter.future
+            try:
+                waiter.future.result(timeout)
+            except FutureTimeoutError:
+                with self._waiters_lock:
+                    missing = "', '".join(sorted(waiter.pending))
+                raise RuntimeError(f"timeout waiting for '{missing}'") from None
+        finally:
+            with self._waiters_lock:
+                for path in waiter.pending:
+                    if waiter in self._waiters.get(path, ()):
+                        self._waiters[path].remove(waiter)
+        if callable(settle):
+            settle()
+        elif settle:
+            sleep(settle)
+
+class Slot:
+    """Ports and files owned by one test worker, so that pytest-xdist workers
+    can run side by side. Slot 0 keeps the historical ports, which are also
+    the testing addon's defaults."""
+
+    def __init__(self, index, base_dir):
+        self.index = index
+        self.base_dir = base_dir
+        self.http_port = 8080 + 10 * index
+        self.https_port = 8443 + 10 * index
+        self.update_port = 1234 + index
+        self.debugger_port = 6000 + index
+        self.sigsum_port = 4800 + index
+
+    @staticmethod
+    def for_worker(worker_id, base_dir):
+        """Slot for a pytest-xdist worker id ("gw0", "gw1", ...); anything
+        else, such as a run without xdist, gets slot 0."""
+        index = int(worker_id[2:]) if worker_id.startswith("gw") else 0
+        return Slot(index, base_dir)
+
+    def update_endpoint(self):
+        return f"http://localhost:{self.update_port}/"
+
+    def addon(self, addon_path):
+        """Return a copy of the testing addon that talks to this slot's ports.
+        The extension reads data/test-slot.json at startup in testing builds."""
+        if self.index == 0:
+            return addon_path
+        path = os.path.join(self.base_dir, f"slot{self.index}-{os.path.basename(addon_path)}")
+        with zipfile.ZipFile(addon_path) as src, zipfile.ZipFile(path, "w") as dst:
+            for info in src.infolist():
+                if info.filename != "data/test-slot.json":
+                    dst.writestr(info, src.read(info))
+            dst.writestr("data/test-slot.json", json.dumps({
+                "endpoint": self.update_endpoint(),
+                "httpPort": str(self.http_port),
+                "httpsPort": str(self.https_port),
+            }))
+        return path
 
 def generate_ssl_cert(output_dir, dnsnames=[]):
     """Generate a self-signed certificate for 127.0.0.1."""
@@ -562,93 +1431,122 @@ class UpdateServer:
         parts.reverse()
         return f"canonical/.{".".join(parts)}"
     
-    def __init__(us):
+    def __init__(us, port=1234, network=None):
+        us.port = port
+        # NetworkProfile of the responses, set with a preset name or a
+        # profile; may be changed between requests
+        us.network = network
         us._reschedule_in = None
         us._reschedule_once = False
         us._update_served = threading.Condition()
         us._update_count = 0
         us._hosts = {}
+        # Encoded leaves, canonicalized once in set()
+        us._leaves: dict[str,bytes] = {}
+        us._synthetic = b""
+        us._synthetic_count = 0
+        us._list_body = None
+        # Every change to the hosts is published as a new block height the
+        # next time a client polls; the hosts of each height are kept so that
+        # deltas can be served against any of them
+        us._publish_lock = threading.Lock()
+        us._changed = True
+        us._height = 0
+        us._history: dict[int,dict[str,bytes]] = {}
+        us._block_time: dict[int,int] = {}
+        us._salt = os.urandom(8)
+        # Compressed list bodies by (ETag, encoding)
+        us._variants: dict[tuple[str,str],bytes] = {}
+        # Response bytes written, headers included, and requests per path
+        us.bytes_served = 0
+        us.requests: dict[str,int] = {}
+
+    @property
+    def network(us):
+        return us._network
+
+    @network.setter
+    def network(us, profile):
+        us._network = NetworkProfile.get(profile)
 
     def start(us):
         class Handler(http.server.SimpleHTTPRequestHandler):
             def do_GET(self):
-                if self.path == "/list.json":
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    leaves = []
-                    for host, hash in us._hosts.items():
-                        leaves.append([UpdateServer.canonicalize(host), f"0A{len(hash):x}{hash}"])
-                    list = {
-                        "leaves": leaves,
-                        "proof": {
-                            "app_hash": "00"*32,
-                            "canonical_root_hash": "00"*32,
-                        }
-                    }
-                    self.wfile.write(json.dumps(list).encode())
+                with shaped(self, us.network):
+                    self.respond()
+
+            def respond(self):
+                url = urllib.parse.urlsplit(self.path)
+                us.requests[url.path] = us.requests.get(url.path, 0) + 1
+                if url.path == "/list.json":
+                    us._publish()
+                    body, etag = us._encoded_list()
+                    self.reply(body, etag)
                     with us._update_served:
                         us._update_count += 1
                         us._update_served.notify_all()
-                elif self.path == "/block.json":
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    block = {
-                        "signed_header": {
-                            "header": {
-                                "height": "0",
-                                "app_hash": "",
-                                "last_block_id": {
-                                    "hash": "00"*32,
-                                    "parts": {
-                                        "hash": "00"*32,
-                                        "total": 1,
-                                    },
-                                },
-                                "last_commit_hash": "00"*32,
-                                "data_hash": "00"*32,
-                                "validators_hash": "00"*32,
-                                "next_validators_hash": "00"*32,
-                                "consensus_hash": "00"*32,
-                                "app_hash": "00"*32,
-                                "last_results_hash": "00"*32,
-                                "evidence_hash": "00"*32,
-                                "proposer_address": "00"*20,
-                                "time": datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
-                            },
-                            "commit": {
-                                "height": "0",
-                                "round": 0,
-                                "block_id": {
-                                    "hash": "00"*32,
-                                    "parts": {
-                                        "hash": "00"*32,
-                                        "total": 1,
-                                    }
-                                },
-                                "signatures": [
-                                    {
-                                        "block_id_flag": 0,
-                                        "validator_address": "00"*20,
-                                        "signature": "AA"*43+"==",
-                                    },
-                                ],
-                            },
-                        },
-                    }
+                elif url.path == "/list-delta.json":
+                    us._publish()
+                    since = urllib.parse.parse_qs(url.query).get("since", [""])[0]
+                    body = us._encoded_delta(int(since)) if since.isdigit() else None
+                    if body is None:
+                        self.send_response(404)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.reply(body)
+                    with us._update_served:
+                        us._update_count += 1
+                        us._update_served.notify_all()
+                elif url.path == "/block.json":
+                    body = us._encoded_block(us._publish())
+                    headers = {}
                     if us._reschedule_in:
-                        block["__WEBCAT_TEST_SCHEDULE_UPDATE__"] = us._reschedule_in
+                        # A header, so that it also reaches the extension
+                        # with a 304
+                        headers["X-Webcat-Test-Schedule-Update"] = str(us._reschedule_in)
                         if us._reschedule_once:
                             us._reschedule_in = None
-                    self.wfile.write(json.dumps(block).encode())
+                    self.reply(body, f'"{hashlib.sha256(body).hexdigest()}"', headers)
                 else:
                     self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+            def reply(self, body, etag=None, headers={}):
+                """Send a JSON body, or a 304 if the client has `etag`, in
+                the best encoding the client accepts."""
+                if etag is not None and etag_matches(etag, self.headers.get("If-None-Match")):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
                     self.end_headers()
+                    return
+                encoding, body = us._compressed(body, etag, self.headers.get("Accept-Encoding", ""))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Vary", "Accept-Encoding")
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                view = memoryview(body)
+                for offset in range(0, len(body), 1024 * 1024):
+                    self.wfile.write(view[offset:offset + 1024 * 1024])
+                us.bytes_served += len(body)
+
+            def end_headers(self):
+                us.bytes_served += sum(len(line) for line in getattr(self, "_headers_buffer", [])) + 2
+                super().end_headers()
 
             def log_message(self, *a): pass  # suppress logs
 
-        us.httpd = socketserver.TCPServer(("127.0.0.1", 1234), Handler, False)
+        us.httpd = socketserver.TCPServer(("127.0.0.1", us.port), Handler, False)
         us.httpd.allow_reuse_address = True
         us.httpd.server_bind()
         us.httpd.server_activate()
@@ -660,19 +1558,174 @@ class UpdateServer:
         us.httpd.server_close()
         us.thread.join()
 
+    @staticmethod
+    def _leaf(host, hash):
+        return json.dumps([UpdateServer.canonicalize(host), f"0A{len(hash):x}{hash}"]).encode()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4)
+    def _synthetic_leaves(n, seed):
+        rng = random.Random(seed)
+        leaves = []
+        for i in range(n):
+            # Same encoding as _leaf(), without json.dumps: names and hashes
+            # need no escaping
+            host = f"{rng.getrandbits(32):08x}.{i:x}"
+            leaves.append(f'["canonical/.test.synthetic.{host}", "0A40{rng.randbytes(32).hex()}"]')
+        return ", ".join(leaves).encode()
+
+    def _encoded_block(us, height):
+        block_time = datetime.datetime.fromtimestamp(us._block_time[height], datetime.timezone.utc)
+        block = {
+            "signed_header": {
+                "header": {
+                    "height": str(height),
+                    "app_hash": "",
+                    "last_block_id": {
+                        "hash": "00"*32,
+                        "parts": {
+                            "hash": "00"*32,
+                            "total": 1,
+                        },
+                    },
+                    "last_commit_hash": "00"*32,
+                    "data_hash": "00"*32,
+                    "validators_hash": "00"*32,
+                    "next_validators_hash": "00"*32,
+                    "consensus_hash": "00"*32,
+                    "app_hash": us._app_hash(height),
+                    "last_results_hash": "00"*32,
+                    "evidence_hash": "00"*32,
+                    "proposer_address": "00"*20,
+                    "time": block_time.isoformat().replace("+00:00", "Z")
+                },
+                "commit": {
+                    "height": str(height),
+                    "round": 0,
+                    "block_id": {
+                        "hash": "00"*32,
+                        "parts": {
+                            "hash": "00"*32,
+                            "total": 1,
+                        }
+                    },
+                    "signatures": [
+                        {
+                            "block_id_flag": 0,
+                            "validator_address": "00"*20,
+                            "signature": "AA"*43+"==",
+                        },
+                    ],
+                },
+            },
+        }
+        return json.dumps(block).encode()
+
+    def _app_hash(us, height):
+        # Differs per height, since the extension skips the list when it
+        # doesn't change, and per server, since heights restart with it
+        return hashlib.sha256(us._salt + str(height).encode()).hexdigest()
+
+    def _proof(us):
+        return json.dumps({
+            "app_hash": us._app_hash(us._height),
+            "canonical_root_hash": "00"*32,
+        }).encode()
+
+    def _encoded_list(us):
+        """The list of the current height and its ETag."""
+        if us._list_body is None:
+            leaves = [us._synthetic] if us._synthetic else []
+            leaves += us._leaves.values()
+            body = b'{"leaves": [' + b", ".join(leaves) + b'], "proof": ' + us._proof() + b"}"
+            us._list_body = body, f'"{hashlib.sha256(body).hexdigest()}"'
+            us._variants.clear()
+        return us._list_body
+
+    def _compressed(us, body, etag, accept_encoding):
+        """Pick the first of brotli and gzip that the client accepts, and
+        return (encoding, encoded body). Encodings of bodies with an ETag are
+        cached until the list changes."""
+        accepted = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+        for encoding in COMPRESSIONS:
+            if encoding not in accepted or len(body) < 256:
+                continue
+            key = (etag, encoding)
+            if etag is not None and key in us._variants:
+                return encoding, us._variants[key]
+            encoded = COMPRESSIONS[encoding](body)
+            if etag is not None:
+                us._variants[key] = encoded
+            return encoding, encoded
+        return None, body
+
+    def _publish(us):
+        """Start a new block height if the hosts changed since the last one,
+        and return the current height. Block times only move forward, by at
+        least a second, so the extension applies every new height."""
+        with us._publish_lock:
+            if us._changed:
+                previous = us._block_time.get(us._height, 0)
+                us._height += 1
+                us._history[us._height] = dict(us._leaves)
+                us._block_time[us._height] = max(int(datetime.datetime.now().timestamp()), previous + 1)
+                us._changed = False
+            return us._height
+
+    def _encoded_delta(us, since):
+        """Leaves changed and canonical names removed between height `since`
+        and the current one, with the proof of the current list; None if the
+        height was never published."""
+        with us._publish_lock:
+            old = us._history.get(since)
+            new = us._history[us._height]
+        if old is None:
+            return None
+        changed = [leaf for host, leaf in new.items() if old.get(host) != leaf]
+        removed = [UpdateServer.canonicalize(host) for host in old if host not in new]
+        return (b'{"since": %d, "height": %d, "changed": [' % (since, us._height) + b", ".join(changed)
+                + b'], "removed": ' + json.dumps(removed).encode() + b', "proof": ' + us._proof() + b"}")
+
     def set(us, host, hash):
         us._hosts[host] = hash
+        us._leaves[host] = UpdateServer._leaf(host, hash)
+        us._list_body = None
+        us._changed = True
+
+    def remove(us, host):
+        """Unenroll a host; the next height no longer lists it."""
+        us._hosts.pop(host, None)
+        us._leaves.pop(host, None)
+        us._list_body = None
+        us._changed = True
+
+    def synthesize(us, n, seed=0):
+        """Serve n deterministic synthetic enrollments in addition to the ones
+        from set(). The encoded leaves are cached per (n, seed), so repeated
+        rounds and servers don't encode them again."""
+        us._synthetic = UpdateServer._synthetic_leaves(n, seed) if n else b""
+        us._synthetic_count = n
+        us._list_body = None
+        # Deltas only cover hosts from set(), so earlier heights can't be
+        # diffed against anymore
+        with us._publish_lock:
+            us._history.clear()
+        us._changed = True
+
+    def leaf_count(us):
+        return us._synthetic_count + len(us._leaves)
 
     def reschedule(us, time_in_seconds: float, once=False):
         us._reschedule_in = time_in_seconds
         us._reschedule_once = once
 
-    def wait_for_update(us, timeout=60, settle=1.0):
+    def wait_for_update(us, timeout=60, settle=None):
         """Block until list.json has been served at least once; returns
         immediately if it already was, so an early fetch cannot cause a
-        missed wakeup. `settle` then gives the extension time to finish
-        applying the update: a page load overlapping that tail can wedge
-        response filtering and freeze the page mid-load."""
+        missed wakeup. `settle` then lets the extension finish applying the
+        update, since a page load overlapping that tail can wedge response
+        filtering and freeze the page mid-load: either a delay in seconds or
+        a callable, such as Browser.wait_for_list."""
         deadline = monotonic() + timeout
         with us._update_served:
             while us._update_count < 1:
@@ -680,4 +1733,7 @@ class UpdateServer:
                 if remaining <= 0:
                     raise RuntimeError(f"no update fetch within {timeout}s")
                 us._update_served.wait(remaining)
-        sleep(settle)
+        if callable(settle):
+            settle()
+        elif settle:
+            sleep(settle)
@@ -1,7 +1,13 @@
-from os import makedirs
-from os.path import abspath, dirname, join
-from tempfile import TemporaryDirectory
+import fcntl
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import close, makedirs, replace, stat, walk
+from os.path import abspath, dirname, exists, join, relpath
+from shutil import copyfile
+from tempfile import TemporaryDirectory, mkstemp
 from subprocess import run
+from time import time
 
 TRUST_POLICY = (
     "log 4644af2abd40f4895a003bca350f9d5912ab301a49c77f13e5b6d905c20a5fe6 https://test.sigsum.org/barreleye\n"
@@ -13,30 +19,159 @@ TRUST_POLICY = (
     "quorum demo-quorum-rule\n"
 )
 
+ENROLLMENT_MAX_AGE = 15552000
+# Cached bundles are re-signed well before their log timestamps get older than
+# the enrollment's max-age
+BUNDLE_CACHE_MAX_AGE = ENROLLMENT_MAX_AGE // 2
+
+
+def tree_hash(source_path, exclude=()):
+    """SHA-256 over the relative paths and contents of a directory tree."""
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in walk(source_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = join(dirpath, filename)
+            if path in exclude:
+                continue
+            h.update(relpath(path, source_path).encode() + b"\0")
+            with open(path, "rb") as f:
+                h.update(hashlib.file_digest(f, "sha256").digest())
+    return h.hexdigest()
+
 
 class BundleGenerator:
-    """Holds keys and enrollment so multiple bundles can share one enrollment."""
+    """Holds keys and enrollment so multiple bundles can share one enrollment.
+
+    With a cache_dir, keys, enrollment and signed bundles are kept there across
+    sessions, and a tree is only sent to the log again when its content,
+    config, enrollment or trust policy changed.
+
+    With a log (sigsum_log.LocalSigsumLog), bundles are logged and cosigned
+    locally under a trust policy generated for it instead of TRUST_POLICY.
+    """
 
-    def __init__(self):
+    def __init__(self, cache_dir=None, log=None):
         self._tmp_ctx = TemporaryDirectory()
         self.tmp = self._tmp_ctx.name
-        run(["sigsum-key", "generate", "-o", "key1"], cwd=self.tmp, check=True)
+        self.trust_policy = log.trust_policy() if log else TRUST_POLICY
+        self.env = log.env() if log else None
+        if cache_dir:
+            # One enrollment per trust policy, since it is part of it
+            policy_hash = hashlib.sha256(self.trust_policy.encode()).hexdigest()[:16]
+            self.state_dir = join(abspath(cache_dir), policy_hash)
+        else:
+            self.state_dir = self.tmp
+        self.bundles_dir = join(self.state_dir, "bundles")
+        makedirs(self.state_dir, exist_ok=True)
+        makedirs(self.bundles_dir, exist_ok=True)
+        with self._lock():
+            if not exists(join(self.state_dir, "enrollment.json")):
+                self._enroll()
+
+    @contextmanager
+    def _lock(self):
+        # Parallel test workers share the cache directory
+        with open(join(self.state_dir, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _enroll(self):
+        cwd = self.state_dir
+        run(["sigsum-key", "generate", "-o", "key1"], cwd=cwd, check=True)
         hex1 = run(["sigsum-key", "to-hex", "-k", "key1.pub"],
-                   cwd=self.tmp, check=True, capture_output=True, text=True)
-        run(["sigsum-key", "generate", "-o", "key2"], cwd=self.tmp, check=True)
+                   cwd=cwd, check=True, capture_output=True, text=True)
+        run(["sigsum-key", "generate", "-o", "key2"], cwd=cwd, check=True)
         hex2 = run(["sigsum-key", "to-hex", "-k", "key2.pub"],
-                   cwd=self.tmp, check=True, capture_output=True, text=True)
-        with open(join(self.tmp, "trust_policy"), "w", encoding="utf-8") as f:
-            f.write(TRUST_POLICY)
+                   cwd=cwd, check=True, capture_output=True, text=True)
+        with open(join(cwd, "trust_policy"), "w", encoding="utf-8") as f:
+            f.write(self.trust_policy)
         run(["webcat", "enrollment", "create",
              "--policy-file", "trust_policy",
              "--threshold", "1",
-             "--max-age", "15552000",
+             "--max-age", str(ENROLLMENT_MAX_AGE),
              "--cas-url", "https://cas.demoelement.com",
              "--signer", hex1.stdout,
              "--signer", hex2.stdout,
-             "--output", "enrollment.json"],
-            cwd=self.tmp, check=True)
+             "--output", "enrollment.json.tmp"],
+            cwd=cwd, check=True)
+        # Written last: its presence marks a complete enrollment
+        replace(join(cwd, "enrollment.json.tmp"), join(cwd, "enrollment.json"))
+
+    def _job(self, source_path, config_path=None, output_path=None):
+        source_path = abspath(source_path)
+        config_path = abspath(config_path) if config_path else join(source_path, "webcat.config.json")
+        output_path = abspath(output_path) if output_path else join(source_path, ".well-known/webcat/bundle.json")
+        return source_path, config_path, output_path
+
+    def cache_key(self, source_path, config_path=None, output_path=None):
+        """Key of the bundle for a tree: its content, minus the bundle being
+        written, plus the config, enrollment and trust policy it's signed
+        with."""
+        source_path, config_path, output_path = self._job(source_path, config_path, output_path)
+        h = hashlib.sha256()
+        h.update(tree_hash(source_path, exclude={output_path}).encode())
+        for path in (config_path, join(self.state_dir, "enrollment.json"), join(self.state_dir, "trust_policy")):
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        return h.hexdigest()
+
+    def _cached(self, key):
+        path = join(self.bundles_dir, f"{key}.json")
+        try:
+            if time() - stat(path).st_mtime < BUNDLE_CACHE_MAX_AGE:
+                return path
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _sign_uncached(self, key, source_path, config_path):
+        state = self.state_dir
+        with TemporaryDirectory(dir=self.tmp) as work:
+            run(["webcat", "manifest", "generate",
+                 "--policy-file", join(state, "trust_policy"),
+                 "--config", config_path,
+                 "--directory", source_path,
+                 "--output", "manifest_unsigned.json"],
+                cwd=work, check=True)
+            run(["webcat", "manifest", "sign",
+                 "--policy-file", join(state, "trust_policy"),
+                 "-i", "manifest_unsigned.json",
+                 "-k", join(state, "key1"),
+                 "-o", "manifest.json"],
+                cwd=work, env=self.env, check=True)
+            run(["webcat", "bundle", "create",
+                 "--enrollment", join(state, "enrollment.json"),
+                 "--manifest", "manifest.json",
+                 "--output", "bundle.json"],
+                cwd=work, check=True)
+            replace(join(work, "bundle.json"), join(self.bundles_dir, f"{key}.json"))
+
+    def sign_many(self, jobs, max_workers=8):
+        """Sign several trees in one pass. Each job is a source_path or a
+        (source_path, config_path, output_path) tuple, with the same defaults
+        as sign(). Trees with identical content are signed once, and only
+        trees missing from the cache reach the log, in parallel."""
+        jobs = [self._job(*((job,) if isinstance(job, str) else job)) for job in jobs]
+        keys = [self.cache_key(*job) for job in jobs]
+        missing = {}
+        for key, (source_path, config_path, _) in zip(keys, jobs):
+            if key not in missing and not self._cached(key):
+                missing[key] = (source_path, config_path)
+        if missing:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for result in [pool.submit(self._sign_uncached, key, *job) for key, job in missing.items()]:
+                    result.result()
+        for key, (_, _, output_path) in zip(keys, jobs):
+            makedirs(dirname(output_path), exist_ok=True)
+            # Other workers may be reading or writing the same output
+            fd, tmp_path = mkstemp(dir=dirname(output_path), suffix=".tmp")
+            close(fd)
+            copyfile(join(self.bundles_dir, f"{key}.json"), tmp_path)
+            replace(tmp_path, output_path)
 
     def sign(self, source_path, config_path=None, output_path=None):
         """Generate manifest and bundle for content under source_path.
@@ -44,27 +179,7 @@ class BundleGenerator:
         config_path: webcat.config.json to use (default: source_path/webcat.config.json).
         output_path: bundle.json destination (default: source_path/.well-known/webcat/bundle.json).
         """
-        source_path = abspath(source_path)
-        config_path = abspath(config_path) if config_path else join(source_path, "webcat.config.json")
-        output_path = abspath(output_path) if output_path else join(source_path, ".well-known/webcat/bundle.json")
-        run(["webcat", "manifest", "generate",
-             "--policy-file", "trust_policy",
-             "--config", config_path,
-             "--directory", source_path,
-             "--output", "manifest_unsigned.json"],
-            cwd=self.tmp, check=True)
-        run(["webcat", "manifest", "sign",
-             "--policy-file", "trust_policy",
-             "-i", "manifest_unsigned.json",
-             "-k", "key1",
-             "-o", "manifest.json"],
-            cwd=self.tmp, check=True)
-        makedirs(dirname(output_path), exist_ok=True)
-        run(["webcat", "bundle", "create",
-             "--enrollment", "enrollment.json",
-             "--manifest", "manifest.json",
-             "--output", output_path],
-            cwd=self.tmp, check=True)
+        self.sign_many([(source_path, config_path, output_path)])
 
     def close(self):
         self._tmp_ctx.cleanup()
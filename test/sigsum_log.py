@@ -0,0 +1,191 @@
+"""Local stand-in for a Sigsum log and one witness, so that bundles can be
+signed without network access. It implements the parts of the log API that
+submitting a leaf needs: add-leaf, get-tree-head (cosigned by the local
+witness) and get-inclusion-proof.
+
+The trust policy names the log by a fixed URL rather than its port, so that
+every test worker shares one policy, enrollment and set of cached bundles.
+The signing tools reach it through HTTP_PROXY instead (see env())."""
+
+import hashlib
+import http.server
+import os
+import threading
+from base64 import b64encode
+from time import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+
+LEAF_NAMESPACE = b"sigsum.org/v1/tree-leaf\0"
+WITNESS_NAME = "local-witness"
+LOG_URL = "http://sigsum-log.test"
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+def _raw_public(key):
+    return key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def _load_or_generate(key_dir, name):
+    if key_dir is None:
+        return Ed25519PrivateKey.generate()
+    path = os.path.join(key_dir, name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return Ed25519PrivateKey.from_private_bytes(f.read())
+    key = Ed25519PrivateKey.generate()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                  serialization.NoEncryption()))
+    try:
+        # Another worker may have generated it meanwhile: theirs wins
+        os.link(tmp_path, path)
+    except FileExistsError:
+        return _load_or_generate(key_dir, name)
+    finally:
+        os.remove(tmp_path)
+    return key
+
+def merkle_root(hashes):
+    """RFC 6962 tree hash over leaf hashes."""
+    if len(hashes) == 1:
+        return hashes[0]
+    k = 1 << ((len(hashes) - 1).bit_length() - 1)
+    return sha256(b"\x01" + merkle_root(hashes[:k]) + merkle_root(hashes[k:]))
+
+def inclusion_path(index, hashes):
+    """RFC 6962 audit path for the leaf at index, leaf to root."""
+    if len(hashes) <= 1:
+        return []
+    k = 1 << ((len(hashes) - 1).bit_length() - 1)
+    if index < k:
+        return inclusion_path(index, hashes[:k]) + [merkle_root(hashes[k:])]
+    return inclusion_path(index - k, hashes[k:]) + [merkle_root(hashes[:k])]
+
+
+class LocalSigsumLog:
+    def __init__(self, port, key_dir=None):
+        self.port = port
+        self.log_key = _load_or_generate(key_dir, "log.key")
+        self.witness_key = _load_or_generate(key_dir, "witness.key")
+        self.log_key_hash = sha256(_raw_public(self.log_key))
+        self.witness_key_hash = sha256(_raw_public(self.witness_key))
+        self._lock = threading.Lock()
+        self._leaf_hashes = []
+        self._leaf_index = {}
+        # Inclusion proofs need a tree of at least two leaves
+        seed = Ed25519PrivateKey.generate()
+        message = sha256(b"webcat test log seed")
+        self._add_leaf(message, seed.sign(LEAF_NAMESPACE + sha256(message)), _raw_public(seed))
+
+    def url(self):
+        return LOG_URL
+
+    def env(self):
+        """Environment for the signing tools, routing LOG_URL to this
+        worker's log, which also answers absolute-URI proxy requests."""
+        proxy = f"http://127.0.0.1:{self.port}"
+        return {**os.environ, "HTTP_PROXY": proxy, "http_proxy": proxy, "NO_PROXY": "", "no_proxy": ""}
+
+    def trust_policy(self):
+        return (
+            f"log {_raw_public(self.log_key).hex()} {self.url()}\n"
+            "\n"
+            f"witness {WITNESS_NAME} {_raw_public(self.witness_key).hex()}\n"
+            "\n"
+            f"group  local-quorum-rule any {WITNESS_NAME}\n"
+            "quorum local-quorum-rule\n"
+        )
+
+    def _add_leaf(self, message, signature, public_key):
+        checksum = sha256(message)
+        Ed25519PublicKey.from_public_bytes(public_key).verify(signature, LEAF_NAMESPACE + checksum)
+        leaf_hash = sha256(b"\x00" + checksum + signature + sha256(public_key))
+        with self._lock:
+            if leaf_hash not in self._leaf_index:
+                self._leaf_index[leaf_hash] = len(self._leaf_hashes)
+                self._leaf_hashes.append(leaf_hash)
+
+    def _tree_head(self):
+        with self._lock:
+            size = len(self._leaf_hashes)
+            root_hash = merkle_root(self._leaf_hashes)
+        checkpoint = (
+            f"sigsum.org/v1/tree/{self.log_key_hash.hex()}\n"
+            f"{size}\n"
+            f"{b64encode(root_hash).decode()}\n"
+        )
+        timestamp = int(time())
+        cosigned = f"cosignature/v1\ntime {timestamp}\n{checkpoint}"
+        return (
+            f"size={size}\n"
+            f"root_hash={root_hash.hex()}\n"
+            f"signature={self.log_key.sign(checkpoint.encode()).hex()}\n"
+            f"cosignature={self.witness_key_hash.hex()} {timestamp} "
+            f"{self.witness_key.sign(cosigned.encode()).hex()}\n"
+        )
+
+    def _inclusion_proof(self, size, leaf_hash):
+        with self._lock:
+            index = self._leaf_index.get(leaf_hash)
+            if index is None or index >= size or size > len(self._leaf_hashes) or size < 2:
+                return None
+            path = inclusion_path(index, self._leaf_hashes[:size])
+        return f"leaf_index={index}\n" + "".join(f"node_hash={h.hex()}\n" for h in path)
+
+    def start(self):
+        log = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def reply(self, status, body=""):
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[-1] == "get-tree-head":
+                    self.reply(200, log._tree_head())
+                elif len(parts) >= 3 and parts[-3] == "get-inclusion-proof":
+                    try:
+                        proof = log._inclusion_proof(int(parts[-2]), bytes.fromhex(parts[-1]))
+                    except ValueError:
+                        return self.reply(400, "malformed request\n")
+                    if proof is None:
+                        return self.reply(404, "no such leaf\n")
+                    self.reply(200, proof)
+                else:
+                    self.reply(404, "unknown endpoint\n")
+
+            def do_POST(self):
+                if self.path.strip("/").split("/")[-1] != "add-leaf":
+                    return self.reply(404, "unknown endpoint\n")
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+                fields = dict(line.split("=", 1) for line in body.splitlines() if "=" in line)
+                try:
+                    log._add_leaf(bytes.fromhex(fields["message"]), bytes.fromhex(fields["signature"]),
+                                  bytes.fromhex(fields["public_key"]))
+                except (KeyError, ValueError):
+                    return self.reply(400, "malformed request\n")
+                except InvalidSignature:
+                    return self.reply(403, "invalid leaf signature\n")
+                # Leaves are sequenced immediately
+                self.reply(200)
+
+            def log_message(self, *a): pass  # suppress logs
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
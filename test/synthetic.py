@@ -0,0 +1,181 @@
+"""Synthetic web apps of a given number of files, to measure how manifest
+size affects the extension, or with one large asset, to measure how the
+extension copes with big responses. Trees are deterministic for their
+parameters, so their bundles stay cached across sessions.
+
+    python synthetic.py PATH --files 10000 [--seed 0] [--sign]
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import sys
+from os import makedirs, replace
+from os.path import exists, join
+from shutil import rmtree
+
+DEFAULT_CSP = ("object-src 'none'; default-src 'self'; script-src 'self' 'wasm-unsafe-eval'; "
+               "style-src 'self'; frame-src 'none'; worker-src 'self';")
+
+# Roughly what a bundled SPA ships: (extension, share of files, median size)
+FILE_KINDS = [
+    ("js", 0.34, 2048),
+    ("map", 0.10, 4096),
+    ("json", 0.15, 512),
+    ("svg", 0.15, 768),
+    ("png", 0.12, 2048),
+    ("css", 0.06, 1024),
+    ("woff2", 0.02, 16384),
+    ("html", 0.03, 1024),
+    ("wasm", 0.01, 16384),
+]
+# Spread of sizes around the median; the log-normal tail gives a few large
+# chunks among many small files. On average a file is about 3 KiB
+SIZE_SIGMA = 0.9
+MAX_SIZE = 512 * 1024
+DIRECTORIES = ["assets", "static", "js", "css", "img", "icons", "fonts", "locales", "vendor",
+               "chunks", "modules", "components", "themes", "workers", "i18n", "media"]
+# Scripts and stylesheets the index loads, independent of the file count,
+# so that a load verifies the same work however large the manifest is
+ENTRY_SCRIPTS = 4
+ENTRY_STYLESHEETS = 2
+
+
+def _path(rng, index, ext):
+    # Mostly two to four levels deep, like bundler output
+    depth = min(int(rng.expovariate(0.5)) + 1, 6)
+    dirs = [rng.choice(DIRECTORIES) for _ in range(depth)]
+    return "/".join(dirs + [f"{rng.choice(DIRECTORIES)}-{index:06x}.{ext}"])
+
+
+def _body(rng, ext, size):
+    if ext in ("png", "woff2", "wasm"):
+        return rng.randbytes(size)
+    filler = rng.randbytes(size // 2 + 1).hex()[:size]
+    if ext in ("js", "css"):
+        return f"/* {filler} */\n".encode()
+    if ext in ("json", "map"):
+        return json.dumps({"version": 3, "data": filler}).encode()
+    if ext == "svg":
+        return f'<svg xmlns="http://www.w3.org/2000/svg"><!-- {filler} --></svg>\n'.encode()
+    return f"<!DOCTYPE html><html><body><!-- {filler} --></body></html>\n".encode()
+
+
+def generate_app(path, files, seed=0, csp=DEFAULT_CSP):
+    """Write a synthetic app of `files` files (index.html and
+    webcat.config.json included) to `path`, replacing what is there. Paths,
+    kinds and sizes are drawn from `seed`."""
+    if files < 2:
+        raise ValueError("an app has at least index.html and webcat.config.json")
+    rng = random.Random(seed)
+    if exists(path):
+        rmtree(path)
+    makedirs(path)
+    weights = [share for _, share, _ in FILE_KINDS]
+    entries = {"js": [], "css": []}
+    for index in range(files - 2):
+        ext, _, median = rng.choices(FILE_KINDS, weights)[0]
+        size = min(int(rng.lognormvariate(math.log(median), SIZE_SIGMA)), MAX_SIZE)
+        relative = _path(rng, index, ext)
+        makedirs(join(path, relative.rsplit("/", 1)[0]), exist_ok=True)
+        with open(join(path, relative), "wb") as f:
+            f.write(_body(rng, ext, size))
+        if ext in entries:
+            entries[ext].append(relative)
+    scripts = "".join(f'\t<script src="/{p}"></script>\n' for p in entries["js"][:ENTRY_SCRIPTS])
+    styles = "".join(f'\t<link rel="stylesheet" href="/{p}">\n' for p in entries["css"][:ENTRY_STYLESHEETS])
+    with open(join(path, "index.html"), "w", encoding="utf-8") as f:
+        f.write(f'<!DOCTYPE html>\n<html lang="en">\n<head>\n{styles}{scripts}</head>\n'
+                f"<body><h1>Synthetic app, {files} files</h1></body>\n</html>\n")
+    _write_config(path, f"https://example.com/synthetic/{files}", csp)
+
+
+def _write_config(path, app, csp):
+    with open(join(path, "webcat.config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "app": app,
+            "version": "0.1",
+            "default_index": "/index.html",
+            "default_fallback": "/index.html",
+            "wasm": [],
+            "default_csp": csp,
+            "extra_csp": {},
+        }, f, indent=4)
+
+
+def generate_large_asset_app(path, size, ext="wasm", seed=0, csp=DEFAULT_CSP):
+    """Write an app whose page loads one asset of `size` bytes,
+    /large.<ext>, to `path`. A script is loaded by a script element, as a
+    comment so that it parses; anything else, such as wasm, is fetched."""
+    rng = random.Random(seed)
+    if exists(path):
+        rmtree(path)
+    makedirs(path)
+    with open(join(path, f"large.{ext}"), "wb") as f:
+        # In pieces, to keep the generator's own memory flat
+        remaining = size
+        if ext == "js":
+            f.write(b"/*")
+            remaining -= 4
+        while remaining > 0:
+            piece = min(remaining, 1 << 24)
+            f.write(rng.randbytes(piece // 2 + 1).hex()[:piece].encode() if ext == "js" else rng.randbytes(piece))
+            remaining -= piece
+        if ext == "js":
+            f.write(b"*/")
+    if ext == "js":
+        loader = '\t<script src="/large.js"></script>\n'
+    else:
+        with open(join(path, "load.js"), "w", encoding="utf-8") as f:
+            f.write(f'fetch("/large.{ext}").then((response) => response.arrayBuffer());\n')
+        loader = '\t<script src="/load.js"></script>\n'
+    with open(join(path, "index.html"), "w", encoding="utf-8") as f:
+        f.write(f'<!DOCTYPE html>\n<html lang="en">\n<head>\n{loader}</head>\n'
+                f"<body><h1>Synthetic app, {size} byte {ext}</h1></body>\n</html>\n")
+    _write_config(path, f"https://example.com/synthetic/large-{ext}-{size}", csp)
+
+
+def _cached(path, generate):
+    done = f"{path}.done"
+    if not exists(done):
+        generate(path)
+        # Written last: its presence marks a complete tree
+        with open(f"{done}.tmp", "w") as f:
+            f.write("")
+        replace(f"{done}.tmp", done)
+    return path
+
+
+def cached_app(base_dir, files, seed=0, csp=DEFAULT_CSP):
+    """Path of the app for (files, seed, csp) under base_dir, generated on
+    first use. Generation is slow for the largest apps, and signing is only
+    skipped for trees that did not change."""
+    path = join(base_dir, f"{files}-{seed}-{hashlib.sha256(csp.encode()).hexdigest()[:12]}")
+    return _cached(path, lambda path: generate_app(path, files, seed, csp))
+
+
+def cached_large_asset_app(base_dir, size, ext="wasm", seed=0, csp=DEFAULT_CSP):
+    """Like cached_app(), for generate_large_asset_app()."""
+    path = join(base_dir, f"large-{ext}-{size}-{seed}-{hashlib.sha256(csp.encode()).hexdigest()[:12]}")
+    return _cached(path, lambda path: generate_large_asset_app(path, size, ext, seed, csp))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path")
+    parser.add_argument("--files", type=int, required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sign", action="store_true", help="sign the app with a temporary enrollment")
+    args = parser.parse_args(argv)
+    generate_app(args.path, args.files, args.seed)
+    if args.sign:
+        from sigsum import generate_bundle
+        generate_bundle(args.path)
+    print(f"Wrote {args.files} files to {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,6 @@ import os
 import shutil
 import tempfile
 import pytest
-from time import sleep
 from helpers import Browser, TorBrowser, Server, Hook, UpdateServer
 import logging
 import json
@@ -10,6 +9,7 @@ import canonicaljson
 import hashlib
 from pytest_check import check
 import urllib.parse
+from pathlib import Path
 
 class Fatal(Exception):
     pass
@@ -110,8 +110,8 @@ def setdiff(a: list, b: list):
     pytest.param("tbb_safest", True, id="tbb_safest"),
 ], indirect=["browser"])
 @pytest.mark.parametrize("in_frame, first_party", [
-    pytest.param(False, "https://site1.localhost:8443", id="plain"),
-    pytest.param(True, "https://nonenrolled.localhost:8443", id="in_frame"),
+    pytest.param(False, "site1.localhost", id="plain"),
+    pytest.param(True, "nonenrolled.localhost", id="in_frame"),
 ])
 @pytest.mark.parametrize("root, headers, hooks, expected, logs, errors, rejections, paths_to_wait, origin_cached", [
 
@@ -232,8 +232,8 @@ def test_webcat(browser, in_frame, server: Server, update_server: UpdateServer,
                 paths_to_wait, origin_cached, first_party, incognito, addon_path, dnsnames, non_enrolled_dnsnames):
     logs, errors, rejections = logs.copy(), errors.copy(), rejections.copy()
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
     browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
     if isinstance(browser, TorBrowser) or in_frame:
         # ServiceWorkers are disabled in TBB by NoScript and in frames by WEBCAT
         paths_to_wait = paths_to_wait-SERVICEWORKER_PATHS
@@ -241,7 +241,7 @@ def test_webcat(browser, in_frame, server: Server, update_server: UpdateServer,
         url = f"{server.url(non_enrolled_dnsnames[0])}/framehost.html?url={server.url(dnsnames[0])}"
     else:
         url = server.url(dnsnames[0])
-    with server.wait_for(paths_to_wait):
+    with server.wait_for(paths_to_wait, settle=browser.settle):
         browser.navigate(url)
     if not in_frame:
         res = browser.execute("document.body.textContent")
@@ -268,6 +268,7 @@ def test_webcat(browser, in_frame, server: Server, update_server: UpdateServer,
         check.is_none(err, "Expected rejection should be present in actual rejections")
 
     cache_keys = json.loads(browser.execute("JSON.stringify(state.origins.keys())", in_extension=True))
+    first_party = server.url(first_party)
     if origin_cached:
         assert [f"{dnsnames[0]}?firstParty={urllib.parse.quote(first_party, safe="")},incognito={"true" if incognito else "false"}"] == cache_keys
     else:
@@ -280,15 +281,36 @@ def test_webcat(browser, in_frame, server: Server, update_server: UpdateServer,
     }, {"/console_log.png": WEBCAT_ICON}, "ERR_WEBCAT_FILE_MISMATCH"),
 ], indirect=["root"])
 def test_in_memory_cache(browser, server: Server, update_server: UpdateServer, expected, addon_path):
-    with server.wait_for({"/console_log.png"}):
-        browser.navigate(f'{server.url()}/console_log.png')
+    with server.wait_for({"/console_log.png"}, settle=None):
+        browser.navigate(f'{server.url()}/console_log.png', wait=True)
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    browser.navigate(f'{server.url()}/console_log.png')
-    sleep(2) # loading from cache, so can't use server.wait_for
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    # loading from cache, so can't use server.wait_for
+    browser.navigate(f'{server.url()}/console_log.png', wait=True)
+    browser.settle()
     res = browser.execute("document.body.textContent")
     assert expected in res
 
+# no-cache makes the browser revalidate every load, so the second navigation is
+# answered with 304s and WEBCAT has to validate the cached responses
+@pytest.mark.parametrize("browser", ["firefox", "tbb", "tbb_safer", "tbb_safest"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks, expected", [
+    pytest.param("cases/testapp", EXPECTED_CSP | {"cache-control": "no-cache"}, {}, "Hello!",
+        id="revalidated_test"),
+], indirect=["root"])
+def test_revalidation(browser: Browser, server: Server, update_server: UpdateServer, expected, addon_path, dnsnames):
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for({"/", "/js/alert.js"}, settle=browser.settle):
+        browser.navigate(server.url(dnsnames[0]))
+    assert expected in browser.execute("document.body.textContent")
+    with server.wait_for({"/", "/js/alert.js"}, settle=browser.settle):
+        browser.navigate(f"{server.url(dnsnames[0])}/?reload")
+    assert server.revalidated.get("/js/alert.js", 0) >= 1
+    assert expected in browser.execute("document.body.textContent")
+
 @pytest.mark.parametrize("browser", ["firefox", "tbb", "tbb_safer", "tbb_safest"], indirect=True)
 @pytest.mark.parametrize("root, headers, hooks, expected", [
     pytest.param("cases/testapp", EXPECTED_CSP, {
@@ -300,8 +322,9 @@ def test_in_memory_cache(browser, server: Server, update_server: UpdateServer, e
 ], indirect=["root"])
 def test_multiple_tabs(browser: Browser, server: Server, update_server: UpdateServer, expected, addon_path):
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    with server.wait_for({"/js/alert.js"}):
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
         browser.execute(
             f"window.open('{server.url()}');"
             f"setTimeout(() => location.href = '{server.url()}/x', 1000)"
@@ -330,12 +353,42 @@ def test_non_enrolled_subresource(browser: Browser, server: Server, update_serve
         headers={"content-security-policy": "script-src *"},
     )
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    with server.wait_for({"/js/alert.js"}):
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
         browser.navigate(non_enrolled_url)
     res = browser.execute("document.body.textContent")
     assert expected in res
 
+CONCURRENT_SUBRESOURCES = 300
+
+# Most useful with --server-mode asyncio, where the subresources are
+# multiplexed over HTTP/2 instead of the browser's six connections per host
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {}, id="concurrent_subresources_test"),
+], indirect=["root"])
+def test_concurrent_subresources(browser: Browser, server: Server, update_server: UpdateServer, addon_path, dnsnames, non_enrolled_dnsnames):
+    enrolled_url = server.url(dnsnames[0]).encode()
+    server.hooks["/"] = Hook(
+        b'<!DOCTYPE html><html><body>' +
+        b"".join(
+            b'<script async src="%s/js/alert.js?i=%d"></script>' % (enrolled_url, i)
+            for i in range(CONCURRENT_SUBRESOURCES)
+        ) +
+        b'</body></html>',
+        type="text/html",
+        headers={"content-security-policy": "script-src *"},
+    )
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
+        browser.navigate(server.url(non_enrolled_dnsnames[0]))
+    browser.wait_until("file_verified", timeout=60, since=CONCURRENT_SUBRESOURCES - 1)
+    logs_blob = json.dumps(browser.extension_logs())
+    assert logs_blob.count("/js/alert.js verified.") == CONCURRENT_SUBRESOURCES
+
 @pytest.mark.parametrize("browser", ["firefox", "tbb", "tbb_safer", "tbb_safest"], indirect=True)
 @pytest.mark.parametrize("root, headers, hooks, expected", [
     pytest.param("cases/testapp", EXPECTED_CSP, {
@@ -346,8 +399,9 @@ def test_non_enrolled_subresource(browser: Browser, server: Server, update_serve
 ], indirect=["root"])
 def test_cache_eviction(browser: Browser, server: Server, update_server: UpdateServer, expected, addon_path, dnsnames):
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    with server.wait_for({"/js/alert.js"}):
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
         browser.execute(
             "const w = window.open();"
             f"window.open('{server.url()}');"
@@ -383,10 +437,11 @@ def test_cache_eviction(browser: Browser, server: Server, update_server: UpdateS
 ], indirect=["root"])
 def test_delegation(browser: Browser, server: Server, update_server: UpdateServer, delegated_fqdn, should_verify, paths_to_wait, addon_path, dnsnames):
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    # Subscribe before navigation so we don't miss the "Setting ok icon" line
+    # Subscribe before the list update and navigation so we don't miss the
+    # "Setting ok icon" line
     browser.attach_extension_console()
-    with server.wait_for(paths_to_wait):
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for(paths_to_wait, settle=browser.settle):
         browser.navigate(f"{server.url(dnsnames[0])}/")
 
     # Page loads successfully in both cases
@@ -418,8 +473,9 @@ def test_delegation(browser: Browser, server: Server, update_server: UpdateServe
 def test_version_refresh(browser: Browser, server: Server, update_server: UpdateServer, bundle_generator, expected, paths_to_wait, addon_path, root):
     # Load v0.1: server serves the bundle that the `root` fixture signed.
     browser.install_extension(addon_path)
-    update_server.wait_for_update()
-    with server.wait_for(paths_to_wait):
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    with server.wait_for(paths_to_wait, settle=browser.settle):
         browser.navigate(server.url())
     assert "Hello!" in browser.execute("document.body.textContent")
 
@@ -458,7 +514,7 @@ def test_version_refresh(browser: Browser, server: Server, update_server: Update
         v2_bundle, type="application/json",
         headers={"cache-control": "no-store"})
 
-    with server.wait_for(paths_to_wait):
+    with server.wait_for(paths_to_wait, settle=browser.settle):
         browser.execute("location.reload()")
     assert expected in browser.execute("document.body.textContent")
 
@@ -470,23 +526,177 @@ def test_version_refresh(browser: Browser, server: Server, update_server: Update
 ], indirect=["root"])
 def test_in_memory_cache_on_update(browser, server: Server, update_server: UpdateServer, expected, addon_path, root, non_enrolled_dnsnames):
     browser.install_extension(addon_path)
+    browser.attach_extension_console()
     update_server.reschedule(2, once=True)
-    update_server.wait_for_update()
+    update_server.wait_for_update(settle=browser.wait_for_list)
 
     # load a non-enrolled site into browser cache
-    with server.wait_for({"/console_log.png"}):
+    with server.wait_for({"/console_log.png"}, settle=browser.settle):
         browser.navigate(f'{server.url(non_enrolled_dnsnames[0])}/console_log.png')
 
     # enroll the site
+    updates = len(browser.extension_events("list_applied"))
     with open(f'{root}/.well-known/webcat/bundle.json') as bundle:
         enrollment = json.load(bundle)["enrollment"]
         canonical_enrollment = canonicaljson.encode_canonical_json(enrollment)
         enrollment_hash = hashlib.sha256(canonical_enrollment).hexdigest()
         update_server.set(non_enrolled_dnsnames[0], enrollment_hash)
     
-    sleep(2) # wait for the rescheduled update
+    browser.wait_until("list_applied", since=updates)
     server.hooks["/console_log.png"] = WEBCAT_ICON
-    with server.wait_for({"/console_log.png"}):
+    with server.wait_for({"/console_log.png"}, settle=browser.settle):
         browser.navigate(f'{server.url(non_enrolled_dnsnames[0])}/console_log.png')
     res = browser.execute("document.body.textContent")
     assert expected in res
+
+# Once the extension knows the height of its list, updates only carry the
+# enrollments that changed, and only the cache entries of those hosts go
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {}, id="delta_update_test"),
+], indirect=["root"])
+def test_delta_update(browser: Browser, server: Server, update_server: UpdateServer, addon_path, root, dnsnames, non_enrolled_dnsnames):
+    update_server.reschedule(2)
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
+        browser.navigate(server.url(dnsnames[0]))
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
+        browser.navigate(server.url(non_enrolled_dnsnames[0]))
+    assert any(key.startswith(non_enrolled_dnsnames[0]) for key in
+               json.loads(browser.execute("JSON.stringify(state.nonOrigins.values())", in_extension=True)))
+
+    with open(f'{root}/.well-known/webcat/bundle.json') as bundle:
+        enrollment = json.load(bundle)["enrollment"]
+        enrollment_hash = hashlib.sha256(canonicaljson.encode_canonical_json(enrollment)).hexdigest()
+    update_server.set(non_enrolled_dnsnames[0], enrollment_hash)
+    update_server.remove(dnsnames[1])
+
+    delta = browser.wait_until("list_applied", timeout=30, where=lambda e: e["delta"])
+    assert delta["changed"] == 1
+    assert delta["removed"] == 1
+    assert delta["leaves"] == update_server.leaf_count()
+
+    origins = json.loads(browser.execute("JSON.stringify(state.origins.keys())", in_extension=True))
+    non_origins = json.loads(browser.execute("JSON.stringify(state.nonOrigins.values())", in_extension=True))
+    assert any(key.startswith(dnsnames[0]) for key in origins)
+    assert not any(key.startswith(non_enrolled_dnsnames[0]) for key in non_origins)
+
+# Polls while nothing changed are answered with a 304 for the block alone:
+# no list is downloaded and only headers cross the wire
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {}, id="no_change_poll_test"),
+], indirect=["root"])
+def test_no_change_poll(browser: Browser, server: Server, update_server: UpdateServer, addon_path):
+    update_server.reschedule(1)
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+
+    not_modified = lambda e: e["reason"] == "not_modified"
+    browser.wait_until("update_skipped", timeout=30, where=not_modified)
+
+    lists = update_server.requests.get("/list.json", 0)
+    deltas = update_server.requests.get("/list-delta.json", 0)
+    bytes_served = update_server.bytes_served
+    polls = update_server.requests["/block.json"]
+    browser.wait_until("update_skipped", timeout=30, where=not_modified,
+                       since=len(browser.extension_events("update_skipped")) + 2)
+    polls = update_server.requests["/block.json"] - polls
+    assert polls >= 3
+    assert update_server.requests.get("/list.json", 0) == lists
+    assert update_server.requests.get("/list-delta.json", 0) == deltas
+    assert (update_server.bytes_served - bytes_served) / polls < 512
+
+# A traced cold load shows the extension's hot path next to the requests it
+# delayed, e.g. to tell whether CSP validation or Sigsum verification dominates
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {}, id="extension_trace_test"),
+], indirect=["root"])
+def test_extension_trace(browser: Browser, server: Server, update_server: UpdateServer, addon_path, tmp_path):
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+
+    trace = browser.collect_extension_trace(server.url(), tmp_path / "trace.json", server=server)
+    assert json.loads((tmp_path / "trace.json").read_text()) == trace
+    processes = {e["pid"]: e["args"]["name"] for e in trace["traceEvents"] if e["ph"] == "M"}
+    spans = {}
+    for e in trace["traceEvents"]:
+        if e["ph"] == "X":
+            spans.setdefault(processes[e["pid"]], []).append(e)
+    names = {e["name"] for e in spans["extension"]}
+    assert {"validateHeaders", "verifyEnrollment", "verifyManifest", "verifySigsumManifest",
+            "validateCSP", "validateContent", "validateContent.onstop"} <= names
+    assert any(e["name"] == "/" for e in spans["server"])
+    assert [e["name"] for e in spans["page"]] == ["navigation"]
+
+# A response trickling in as many small chunks is verified like one that
+# arrives at once
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {
+        "/js/alert.js": Hook(Path("cases/testapp/js/alert.js"), type="text/javascript", chunk_size=4, chunk_delay=0.05),
+    }, id="trickled_response_test"),
+], indirect=["root"])
+def test_trickled_response(browser: Browser, server: Server, update_server: UpdateServer, addon_path):
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+
+    with server.wait_for({"/js/alert.js"}, settle=browser.settle):
+        browser.navigate(server.url())
+    # Only reported once the content matched the manifest
+    assert browser.wait_until("file_verified", where=lambda e: e["url"].endswith("/js/alert.js"))
+
+# More enrolled origins than the cache holds, visited round-robin: the cache
+# stays within its byte budget, evicts, and still serves the origin used last
+@pytest.mark.parametrize("browser", ["firefox"], indirect=True)
+@pytest.mark.parametrize("root, headers, hooks", [
+    pytest.param("cases/testapp", EXPECTED_CSP, {}, id="origin_cache_soak_test"),
+], indirect=["root"])
+def test_origin_cache_soak(browser: Browser, server: Server, update_server: UpdateServer, addon_path, root, soak_dnsnames):
+    with open(f'{root}/.well-known/webcat/bundle.json') as bundle:
+        enrollment = json.load(bundle)["enrollment"]
+        enrollment_hash = hashlib.sha256(canonicaljson.encode_canonical_json(enrollment)).hexdigest()
+    for name in soak_dnsnames:
+        update_server.set(name, enrollment_hash)
+    browser.install_extension(addon_path)
+    browser.attach_extension_console()
+    update_server.wait_for_update(settle=browser.wait_for_list)
+    stats = lambda: json.loads(browser.execute("JSON.stringify(state.origins.stats())", in_extension=True))
+
+    def visit(name):
+        verified = len(browser.extension_events("origin_verified"))
+        browser.navigate(server.url(name), wait=True)
+        browser.settle()
+        return len(browser.extension_events("origin_verified")) > verified
+
+    assert visit(soak_dnsnames[0])
+    entry_bytes = stats()["bytes"]
+    # Lift the testing build's entry cap, so that the byte budget decides:
+    # room for a quarter of the origins
+    capacity = len(soak_dnsnames) // 4
+    browser.execute(f"state.origins.maxEntries = 1000; state.origins.maxBytes = {entry_bytes * capacity};",
+                    in_extension=True)
+
+    reverified = 0
+    for _ in range(2):
+        for name in soak_dnsnames:
+            reverified += visit(name)
+            current = stats()
+            assert current["bytes"] <= current["maxBytes"]
+            assert current["entries"] <= capacity
+    final = stats()
+    # Round-robin over more origins than fit defeats the cache, whatever
+    # it prefers to keep
+    assert reverified > len(soak_dnsnames)
+    assert final["evictions"] >= reverified - capacity
+    assert final["misses"] > 0
+
+    assert not visit(soak_dnsnames[-1])
+    assert stats()["hits"] > final["hits"]